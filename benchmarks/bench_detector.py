@@ -0,0 +1,150 @@
+"""实时检测基准：测量滑动窗口检测的吞吐量，并确认注入的暴力登录能触发告警
+
+在合成日志末尾追加两段 POST /users/sign_in 请求：一段来自BURST_IP；另一段来自EVASION_IP，
+每行的referrer中伪造轮换的"client: "（想把请求分摊到许多假IP上躲过阈值）。然后：
+  1. 用统计流程的解析（process_buffer）和实时检测（detect_chunk）分别处理同样的数据，报告每秒行数；
+     检测的吞吐量须达到日志写入高峰 --peak-rate 行/秒的 --margin 倍，否则高峰时检测会越来越落后
+     （检测与刷新在同一进程中运行，余量留给同时进行的刷新和读文件）
+  2. 用follow_log_files从头跟随整个文件（含读文件），确认两个注入的IP都触发了login_bruteforce告警，
+     伪造的IP没有触发告警，并且每条规则跟踪的IP数不超过DETECT_MAX_KEYS
+
+用法：python benchmarks/bench_detector.py [--burst 请求数] [--peak-rate 行/秒] [--margin 倍数] [--max-keys N]
+      [--repeat 次数] [数据参数...]
+数据参数见 benchmarks/synthetic.py（默认只生成1个.log）
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import synthetic  # noqa: E402
+import nginx_ip_geo_stats as geo_stats  # noqa: E402
+
+BURST_IP = '203.0.113.7'
+EVASION_IP = '203.0.113.8'
+SPOOFED_PREFIX = '198.51.100.'  # 伪造的client取自此网段（合成日志的referrer中也使用此网段）
+
+
+def append_burst(file_path, count, ip, minutes, spoof=False):
+    """追加count行同一IP在约一分钟内的登录请求（从现在起minutes分钟后开始，晚于已有日志）；
+    spoof为True时每行的referrer中伪造一个不同的"client: "（且带有完整的", server: "）"""
+    start = datetime.datetime.now() + datetime.timedelta(minutes=minutes)
+    with open(file_path, 'a', encoding='utf-8') as f:
+        for i in range(count):
+            log_time = start + datetime.timedelta(seconds=i * 50 / count)
+            referrer = f', referrer: "http://evil.example/, client: {SPOOFED_PREFIX}{i % 250}, server: x"' if spoof else ''
+            f.write(f'{log_time:%Y/%m/%d %H:%M:%S} [error] 2817#0: *{i} open() '
+                    f'"/opt/gitlab/embedded/service/gitlab-rails/public/favicon.ico" failed '
+                    f'(2: No such file or directory), client: {ip}, server: gitlab.example.com, '
+                    f'request: "POST /users/sign_in HTTP/1.1", host: "gitlab.example.com"{referrer}\n')
+
+
+def read_chunks(file_path):
+    with open(file_path, 'rb') as f:
+        return list(iter(lambda: f.read(geo_stats.READ_CHUNK_SIZE), b''))
+
+
+def time_parse(chunks):
+    summary, ip_hits = geo_stats.new_summary(), {}
+    carry = b'\n'
+    for chunk in chunks:
+        carry = geo_stats.process_buffer(carry, chunk, summary, ip_hits)
+
+
+def time_detect(chunks):
+    detector = geo_stats.new_detector()
+    carry = b'\n'
+    for chunk in chunks:
+        data = carry + chunk
+        end = data.rfind(b'\n')
+        geo_stats.detect_chunk(detector, data, end)
+        carry = data[end:]
+
+
+def best_of(func, chunks, repeat):
+    best = None
+    for _ in range(repeat):
+        geo_stats.MINUTE_CACHE.clear()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func(chunks)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='测量实时检测的吞吐量并检查告警')
+    parser.add_argument('--burst', type=int, default=100, help='每段注入的登录请求数（约一分钟内）')
+    parser.add_argument('--peak-rate', type=float, default=10000,
+                        help='日志写入高峰的行数/秒（访问日志每小时数千万行约为1万行/秒）')
+    parser.add_argument('--margin', type=float, default=3, help='检测吞吐量相对高峰的最低倍数')
+    parser.add_argument('--max-keys', type=int, default=geo_stats.DETECT_MAX_KEYS, help='DETECT_MAX_KEYS')
+    parser.add_argument('--repeat', type=int, default=3, help='每种方式运行次数（取最快一次）')
+    synthetic.add_arguments(parser)
+    parser.set_defaults(files=1, gz_files=0)
+    args = vars(parser.parse_args())
+    burst, repeat = args.pop('burst'), args.pop('repeat')
+    required_rate = args.pop('peak_rate') * args.pop('margin')
+    geo_stats.DETECT_MAX_KEYS = args.pop('max_keys')
+
+    temp_dir = tempfile.mkdtemp(prefix='geo_stats_detector_')
+    try:
+        _, log_dir, log_files = synthetic.generate(temp_dir, **args)
+        append_burst(log_files[0], burst, BURST_IP, 1)
+        append_burst(log_files[0], burst, EVASION_IP, 3, spoof=True)
+        lines = args['lines'] + burst * 2
+        chunks = read_chunks(log_files[0])
+
+        parse_seconds = best_of(time_parse, chunks, repeat)
+        detect_seconds = best_of(time_detect, chunks, repeat)
+        print(f"{lines} 行，{len(geo_stats.DETECT_RULES)} 条规则，DETECT_MAX_KEYS={geo_stats.DETECT_MAX_KEYS}")
+        print(f"{'处理':<16}{'耗时(秒)':>10}{'行/秒':>14}")
+        print(f"{'统计流程解析':<16}{parse_seconds:>10.3f}{lines / parse_seconds:>14,.0f}")
+        print(f"{'实时检测':<16}{detect_seconds:>10.3f}{lines / detect_seconds:>14,.0f}")
+
+        # 从头跟随整个文件（包括读文件），检查告警
+        geo_stats.LOG_DIR = log_dir
+        geo_stats.MINUTE_CACHE.clear()
+        detector = geo_stats.new_detector()
+        detector['started'] = True  # 已有内容也参与检测
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            alerts = geo_stats.follow_log_files(detector)
+        follow_seconds = time.perf_counter() - started
+        print(f"{'跟随文件':<16}{follow_seconds:>10.3f}{lines / follow_seconds:>14,.0f}")
+        tracked = [len(counter) for counter in detector['counters']]
+        print(f"告警 {len(alerts)} 条，各规则跟踪的IP数 {tracked}")
+        for alert in alerts[:10]:
+            print(f"  {alert['time']} {alert['rule']} {alert['ip']} {alert['count']}次/{alert['window']}秒")
+
+        failed = False
+        for ip in (BURST_IP, EVASION_IP):
+            if not any(alert['ip'] == ip and alert['rule'] == 'login_bruteforce' for alert in alerts):
+                print(f"❌ 注入的暴力登录（{ip}）没有触发告警")
+                failed = True
+        if any(alert['ip'].startswith(SPOOFED_PREFIX) for alert in alerts):
+            print("❌ referrer中伪造的client触发了告警")
+            failed = True
+        if max(tracked) > geo_stats.DETECT_MAX_KEYS:
+            print("❌ 计数器数量超过DETECT_MAX_KEYS")
+            failed = True
+        if lines / detect_seconds < required_rate:
+            print(f"❌ 实时检测低于要求的 {required_rate:,.0f} 行/秒")
+            failed = True
+        if failed:
+            sys.exit(1)
+        print(f"✅ 检测达到 {required_rate:,.0f} 行/秒，暴力登录（含伪造client的）已告警")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""多节点部署基准：本机启动一个collector和多个agent进程，测量完整推送与增量推送的数据量，并检查合并结果
+
+每个agent使用各自的合成数据（种子不同）。依次运行以下几轮，每轮所有agent并行推送一次（--agent --once）：
+  full    首次推送完整汇总
+  append  向每个agent的gitlab_error.log追加若干行后推送增量
+  idle    日志没有变化时的推送
+  resync  清空collector已合并的数据（模拟collector重启），agent收到409后重新推送完整汇总
+每轮结束后把collector合并的结果与本进程内逐个解析各agent数据再直接合并的结果比较，必须完全一致，
+并报告该轮collector发布全局统计的次数（推送只合并增量，最多每FLEET_PUBLISH_INTERVAL秒发布一次）。
+最后检查没有令牌的推送返回403、解压后超过FLEET_MAX_PUSH_BYTES的推送返回413。
+
+用法：python benchmarks/bench_fleet.py [--agents N] [--append 行数] [--data 数据目录] [数据参数...]
+数据参数见 benchmarks/synthetic.py（默认每个agent 10万行，1个.log和1个.gz）
+"""
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import synthetic  # noqa: E402
+import nginx_ip_geo_stats as geo_stats  # noqa: E402
+
+TOKEN = 'bench-fleet-token'
+
+AGENT = '''
+import json, sys
+sys.path.insert(0, %r)
+import nginx_ip_geo_stats as geo_stats
+for name, value in json.loads(sys.argv[1]).items():
+    setattr(geo_stats, name, value)
+geo_stats.FLEET_ROLE = 'agent'
+geo_stats.run_agent(once=True)
+''' % (ROOT,)
+
+
+def agent_config(agent_dir, agent_id, collector_url):
+    return {
+        'LOG_DIR': os.path.join(agent_dir, 'logs'),
+        'BIN_INDEX_PATH': os.path.join(agent_dir, 'map', 'dbip_index.bin'),
+        'GEO_TEXT_PATH': os.path.join(agent_dir, 'map', 'dbip_geo.txt'),
+        'STATE_PATH': os.path.join(agent_dir, 'state', 'ingest_state.pkl'),
+        'SUMMARY_CACHE_DIR': os.path.join(agent_dir, 'state', 'summary_cache'),
+        'AGENT_STATE_PATH': os.path.join(agent_dir, 'state', 'agent_state.pkl'),
+        'COLLECTOR_URL': collector_url,
+        'AGENT_ID': agent_id,
+        'FLEET_TOKEN': TOKEN
+    }
+
+
+def start_collector():
+    """在本进程内启动collector（随机端口），返回 (服务器, 推送地址)"""
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # 不输出每个请求的访问日志
+    geo_stats.FLEET_ROLE = 'collector'
+    geo_stats.FLEET_TOKEN = TOKEN
+    geo_stats.CHART_PRERENDER = False
+    with contextlib.redirect_stdout(io.StringIO()):
+        geo_stats.init_collector()
+        app = geo_stats.build_app()
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/fleet/push'
+
+
+def push_round(configs):
+    """所有agent并行推送一次，返回耗时"""
+    started = time.perf_counter()
+    processes = [subprocess.Popen([sys.executable, '-c', AGENT, json.dumps(config)],
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+                 for config in configs]
+    for config, process in zip(configs, processes):
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            print(output)
+            raise SystemExit(f"agent {config['AGENT_ID']} 推送失败")
+    return time.perf_counter() - started
+
+
+def wait_published():
+    """等待collector在后台发布完本轮推送"""
+    while geo_stats.FLEET_DIRTY.is_set():
+        time.sleep(0.05)
+    time.sleep(0.1)  # 发布线程先清除标记再取锁
+    with geo_stats.FLEET_LOCK:
+        pass
+
+
+def append_lines(agent_dir, count):
+    """把gitlab_error.log的最后count行再追加一遍，模拟新写入的日志"""
+    path = os.path.join(agent_dir, 'logs', 'gitlab_error.log')
+    with open(path, 'rb') as f:
+        lines = f.read().splitlines(keepends=True)[-count:]
+    with open(path, 'ab') as f:
+        f.writelines(lines)
+
+
+def reference_summaries(configs):
+    """在本进程内逐个完整解析各agent的数据（不使用检查点和归档缓存）"""
+    summaries = []
+    saved = {name: getattr(geo_stats, name) for name in ('INCREMENTAL_REFRESH', 'SUMMARY_CACHE_ENABLED')}
+    geo_stats.INCREMENTAL_REFRESH = geo_stats.SUMMARY_CACHE_ENABLED = False
+    try:
+        for config in configs:
+            geo_stats.LOG_DIR = config['LOG_DIR']
+            geo_stats.BIN_INDEX_PATH, geo_stats.GEO_TEXT_PATH = config['BIN_INDEX_PATH'], config['GEO_TEXT_PATH']
+            geo_stats.GEO_INDEX = None
+            geo_stats.SUMMARY_CACHE.clear()
+            with contextlib.redirect_stdout(io.StringIO()):
+                summaries += geo_stats.collect_summaries()[0]
+    finally:
+        for name, value in saved.items():
+            setattr(geo_stats, name, value)
+    return summaries
+
+
+def push_status(collector_url, body, token):
+    """直接向collector发送一次推送，返回HTTP状态码"""
+    headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    request = urllib.request.Request(collector_url, data=gzip.compress(body), headers=headers, method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def rejects_bad_pushes(collector_url):
+    """没有令牌返回403；解压后超过上限（临时调小为1MB）返回413，collector不必解压完整个请求"""
+    saved = geo_stats.FLEET_MAX_PUSH_BYTES
+    geo_stats.FLEET_MAX_PUSH_BYTES = 1 << 20
+    try:
+        return (push_status(collector_url, b'{}', None) == 403
+                and push_status(collector_url, b' ' * (8 << 20), TOKEN) == 413)
+    finally:
+        geo_stats.FLEET_MAX_PUSH_BYTES = saved
+
+
+def same_stats(expected, actual):
+    """比较各时间窗口的总数和各计数器（合并顺序不同，排行榜中同次数项的先后可能不同，不比较顺序）"""
+    for time_name, stats in expected.items():
+        other = actual[time_name]
+        if stats['total'] != other['total']:
+            return False
+        for key in geo_stats.FREQ_KEYS:
+            if dict(stats[key]) != dict(other[key]):
+                return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本机多个agent与一个collector的推送基准')
+    parser.add_argument('--agents', type=int, default=3, help='agent数量')
+    parser.add_argument('--append', type=int, default=1000, help='增量轮次每个agent追加的日志行数')
+    parser.add_argument('--data', help='合成数据目录（默认使用临时目录，运行结束后删除）')
+    synthetic.add_arguments(parser)
+    parser.set_defaults(lines=100000, files=1, gz_files=1)
+    args = vars(parser.parse_args())
+    agents, append, data_dir = args.pop('agents'), args.pop('append'), args.pop('data')
+    seed = args.pop('seed')
+
+    temp_dir = None
+    if data_dir is None:
+        temp_dir = data_dir = tempfile.mkdtemp(prefix='geo_stats_fleet_')
+    server = None
+    try:
+        agent_dirs = []
+        for k in range(agents):
+            agent_dir = os.path.join(data_dir, f'agent{k}')
+            shutil.rmtree(agent_dir, ignore_errors=True)
+            synthetic.generate(agent_dir, seed=seed + k, **args)
+            agent_dirs.append(agent_dir)
+        server, collector_url = start_collector()
+        configs = [agent_config(agent_dir, f'agent{k}', collector_url) for k, agent_dir in enumerate(agent_dirs)]
+
+        print(f"{agents} 个agent，每个 {args['lines']} 行日志")
+        print(f"{'轮次':<10}{'耗时(秒)':>10}{'推送字节数':>14}{'变化时间桶':>12}{'发布次数':>10}{'结果一致':>10}")
+        for name in ('full', 'append', 'idle', 'resync'):
+            if name == 'append':
+                for agent_dir in agent_dirs:
+                    append_lines(agent_dir, append)
+            elif name == 'resync':
+                with geo_stats.FLEET_LOCK:
+                    geo_stats.FLEET.clear()
+            generation = geo_stats.STATS_GENERATION
+            seconds = push_round(configs)
+            wait_published()
+            publishes = geo_stats.STATS_GENERATION - generation
+            fleet = dict(geo_stats.FLEET)
+            cutoffs = geo_stats.compute_window_cutoffs()
+            expected = geo_stats.build_window_stats(
+                geo_stats.build_rollup_store(reference_summaries(configs)), cutoffs)
+            actual = geo_stats.build_window_stats(
+                geo_stats.build_rollup_store([agent['summary'] for agent in fleet.values()]), cutoffs)
+            same = len(fleet) == agents and same_stats(expected, actual)
+            print(f"{name:<10}{seconds:>10.2f}{sum(agent['bytes'] for agent in fleet.values()):>14,}"
+                  f"{sum(agent['buckets'] for agent in fleet.values()):>12}{publishes:>10}{'是' if same else '否':>10}")
+            if not same:
+                sys.exit(1)
+        rejected = rejects_bad_pushes(collector_url)
+        print(f"无令牌403、超大推送413：{'是' if rejected else '否'}")
+        if not rejected:
+            sys.exit(1)
+    finally:
+        if server is not None:
+            server.shutdown()
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""日志格式基准：同一批请求分别写成nginx错误日志、访问日志（combined）和GitLab JSON日志，测量各格式的解析吞吐量
+
+每种格式按LOG_SOURCES的文件名前缀找到对应的解析器（与正式刷新相同的process_log_file路径，含读文件和地理查询），
+报告每秒行数、每秒MB数和单进程每小时可处理的行数，并检查三种格式得到的时间桶汇总完全一致。
+JSON日志按UTC记录、另两种按本地时间记录，默认在非整点时差的时区（--tz）下运行，
+同一请求在各格式中必须落在同一个时间桶和同一小时，时区换算有误时结果不一致。
+访问日志的量约为错误日志的百倍，每小时数千万行需要约1万行/秒以上的持续吞吐。
+
+用法：python benchmarks/bench_formats.py [--formats nginx_error,combined,gitlab_json] [--repeat 次数] [--tz 时区] [数据参数...]
+数据参数见 benchmarks/synthetic.py（默认100万行，每种格式1个.log和1个.gz）
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import synthetic  # noqa: E402
+import nginx_ip_geo_stats as geo_stats  # noqa: E402
+
+
+def parse_files(log_files, ip_index, geo_lines):
+    """与刷新时一样逐个完整解析文件（按文件名选择日志格式）"""
+    summary = geo_stats.new_summary()
+    for file_path in log_files:
+        geo_stats.process_log_file(file_path, ip_index, geo_lines, summary)
+    return summary
+
+
+def comparable(summary):
+    """转为与计数器插入顺序无关的可比较结构"""
+    return {start: {key: dict(value) if isinstance(value, dict) else value for key, value in bucket.items()}
+            for start, bucket in summary['buckets'].items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对比各日志格式的解析吞吐量')
+    parser.add_argument('--formats', default=','.join(synthetic.FORMAT_FILES), help='逗号分隔的日志格式')
+    parser.add_argument('--repeat', type=int, default=3, help='每种格式运行次数（取最快一次）')
+    parser.add_argument('--tz', default='IST-5:30', help='运行时使用的本地时区（TZ环境变量格式，默认UTC+5:30）')
+    synthetic.add_arguments(parser)
+    parser.set_defaults(lines=1000000, files=1, gz_files=1)
+    args = vars(parser.parse_args())
+    formats, repeat = args.pop('formats').split(','), args.pop('repeat')
+    args.pop('log_format')
+    os.environ['TZ'] = args.pop('tz')
+    time.tzset()
+
+    temp_dir = tempfile.mkdtemp(prefix='geo_stats_formats_')
+    now = datetime.datetime.now()
+    try:
+        results = {}
+        print(f"{args['lines']} 行/格式，时区 {os.environ['TZ']}（UTC{time.strftime('%z')}）")
+        print(f"{'格式':<14}{'大小(MB)':>10}{'耗时(秒)':>10}{'行/秒':>12}{'MB/秒':>9}{'每小时(百万行)':>16}{'结果一致':>10}")
+        for log_format in formats:
+            map_dir, log_dir, log_files = synthetic.generate(os.path.join(temp_dir, log_format), now=now,
+                                                             log_format=log_format, **args)
+            geo_stats.BIN_INDEX_PATH = os.path.join(map_dir, 'dbip_index.bin')
+            geo_stats.GEO_TEXT_PATH = os.path.join(map_dir, 'dbip_geo.txt')
+            geo_stats.GEO_INDEX = None
+            geo_stats.LOG_DIR = log_dir
+            geo_stats.LOG_SOURCES = [(synthetic.FORMAT_FILES[log_format], log_format, None)]
+            log_files = sorted(geo_stats.list_log_files())
+            size = sum(os.path.getsize(path) for path in log_files) / 1048576
+            with contextlib.redirect_stdout(io.StringIO()):
+                ip_index, geo_lines = geo_stats.load_bin_index()
+
+            best = None
+            for _ in range(repeat):
+                geo_stats.MINUTE_CACHE.clear()
+                started = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    summary = parse_files(log_files, ip_index, geo_lines)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            results[log_format] = comparable(summary)
+            same = results[log_format] == results[formats[0]]
+            rate = args['lines'] / best
+            print(f"{log_format:<14}{size:>10.1f}{best:>10.2f}{rate:>12,.0f}{size / best:>9.1f}"
+                  f"{rate * 3600 / 1e6:>16,.0f}{'是' if same else '否':>10}")
+            if not same:
+                sys.exit(1)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
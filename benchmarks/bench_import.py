@@ -0,0 +1,62 @@
+"""导入耗时预算检查：在新的解释器中导入主程序，测量耗时并确认没有加载绘图库和Flask
+
+只解析日志的进程（--headless刷新进程、多进程解析的工作进程）不应为绘图库付出启动时间和内存；
+超出预算或加载了不该加载的模块时以非0状态退出，可放在CI中运行。
+
+用法：python benchmarks/bench_import.py [--budget 秒数] [--runs 次数]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# 导入主程序时不应加载的模块（第一次生成图表或创建Web应用时才导入）
+HEAVY_MODULES = ('matplotlib', 'seaborn', 'pandas', 'folium', 'flask')
+
+PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import nginx_ip_geo_stats
+elapsed = time.perf_counter() - started
+print(json.dumps({'seconds': elapsed, 'modules': sorted(name for name in %r if name in sys.modules)}))
+''' % (HEAVY_MODULES,)
+
+
+def measure(runs):
+    """每次都在新的解释器中导入，返回 (最短耗时, 各次耗时, 已加载的重模块)"""
+    timings = []
+    loaded = set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, check=True,
+                                capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result['seconds'])
+        loaded.update(result['modules'])
+    return min(timings), timings, sorted(loaded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='检查主程序的导入耗时预算')
+    parser.add_argument('--budget', type=float, default=0.5, help='导入耗时上限（秒），取多次中的最短耗时比较')
+    parser.add_argument('--runs', type=int, default=5, help='测量次数')
+    args = parser.parse_args()
+
+    best, timings, loaded = measure(args.runs)
+    print(f"导入耗时: 最短 {best:.3f} 秒（{', '.join(f'{t:.3f}' for t in timings)}），预算 {args.budget} 秒")
+    failed = False
+    if loaded:
+        print(f"❌ 导入时加载了重模块: {', '.join(loaded)}")
+        failed = True
+    if best > args.budget:
+        print("❌ 超出导入耗时预算")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("✅ 导入耗时在预算内，未加载绘图库和Flask")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""日志解析微基准：对比旧的逐行解析与正式刷新使用的字节解析的吞吐量（行/秒）
+
+旧路径：parse_log_time（每次编译正则 + strptime）+ is_in_time_range（每行调用now()）+ IP、URL两次正则搜索
+文本基线：process_lines（逐行str正则 + 按分钟前缀缓存的时间解析），见 benchmarks/legacy_parser.py
+新路径：process_buffer（整块未解码数据上用字节正则findall，与刷新时相同）
+
+日志由 benchmarks/synthetic.py 生成（nginx_error格式，只生成1个.log），其中带有伪造"client:"的referrer和URL，
+三种解析的 (时段, URL, IP) 计数必须一致。旧路径只识别IPv4客户端，因此默认 --v6-ratio 0。
+
+用法：python benchmarks/bench_parser.py [数据参数...]
+数据参数见 benchmarks/synthetic.py（默认20万行、300个IP、500个URL、7天）
+"""
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import legacy_parser  # noqa: E402
+import synthetic  # noqa: E402
+import nginx_ip_geo_stats as geo_stats  # noqa: E402
+
+LEGACY_IP_PATTERN = re.compile(r'client:\s*(\d+\.\d+\.\d+\.\d+)')
+LEGACY_URL_PATTERN = re.compile(r'request: "(GET|POST|PUT|DELETE|HEAD|OPTIONS|PATCH) ([^ ]+)')
+
+
+def legacy_parse(lines, days=3650):
+    """旧的逐行解析流程（不含地理查询）：client和request各自取行内第一次出现的位置，返回 (时段, URL, IP) 计数"""
+    hour_freq, url_freq, ip_freq = defaultdict(int), defaultdict(int), defaultdict(int)
+    for line in lines:
+        log_time = legacy_parser.parse_log_time(line)
+        if not legacy_parser.is_in_time_range(log_time, days):
+            continue
+        hour_freq[log_time.hour] += 1
+        url_match = LEGACY_URL_PATTERN.search(line)
+        if url_match:
+            url_freq[url_match.group(2)] += 1
+        ip_match = LEGACY_IP_PATTERN.search(line)
+        if ip_match:
+            ip_freq[ip_match.group(1)] += 1
+    return dict(hour_freq), dict(url_freq), dict(ip_freq)
+
+
+def text_parse(lines):
+    """文本基线：逐行单正则解析（不含地理查询）"""
+    summary = geo_stats.new_summary()
+    ip_hits = {}
+    legacy_parser.process_lines(lines, summary, ip_hits)
+    return legacy_parser.summary_counts(summary, ip_hits)
+
+
+def bytes_parse(data):
+    """字节解析：整块数据一次findall（不含地理查询），与刷新时一样从换行符开头的carry开始"""
+    summary = geo_stats.new_summary()
+    ip_hits = {}
+    carry = geo_stats.process_buffer(b'\n', data, summary, ip_hits)
+    if len(carry) > 1:
+        geo_stats.process_buffer(carry, b'', summary, ip_hits)
+    return legacy_parser.summary_counts(summary, ip_hits)
+
+
+def measure(func, data, count):
+    """返回 (每秒行数, 解析结果)"""
+    geo_stats.MINUTE_CACHE.clear()
+    start = time.perf_counter()
+    result = func(data)
+    return count / (time.perf_counter() - start), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对比旧的逐行解析、文本基线与字节解析的吞吐量')
+    synthetic.add_arguments(parser)
+    parser.set_defaults(lines=200000, ips=300, urls=500, days=7, ranges=1000, v6_ranges=0, v6_ratio=0.0,
+                        files=1, gz_files=0)
+    args = vars(parser.parse_args())
+    if args['log_format'] != 'nginx_error':
+        parser.error('只支持 --log-format nginx_error')
+
+    temp_dir = tempfile.mkdtemp(prefix='geo_stats_parser_')
+    try:
+        _, _, log_files = synthetic.generate(temp_dir, **args)
+        with open(log_files[0], encoding='utf-8') as f:
+            lines = f.readlines()
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    count = len(lines)
+    data = ''.join(lines).encode('utf-8')
+    legacy, expected = measure(legacy_parse, lines, count)
+    text, text_result = measure(text_parse, lines, count)
+    fast, fast_result = measure(bytes_parse, data, count)
+    same = text_result == expected and fast_result == expected
+    print(f"行数: {count}")
+    print(f"旧解析: {legacy:,.0f} 行/秒")
+    print(f"文本基线: {text:,.0f} 行/秒")
+    print(f"字节解析: {fast:,.0f} 行/秒")
+    print(f"提速: {fast / legacy:.1f}x（相对文本基线 {fast / text:.1f}x）")
+    print(f"结果与旧解析一致（含伪造client的行）: {'是' if same else '否'}")
+    if not same:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""整条统计流程的基准：用合成数据分阶段测量耗时、吞吐量和峰值内存，结果保存为JSON便于对比
+
+阶段：load_index（加载地理库）→ parse（解析日志）→ resolve（批量查询IP，另按IPv4/IPv6分别测一次）
+      → aggregate（展开到小时桶并生成各时间窗口）→ render / render_js（以png或js方式生成图表）
+每个阶段先不开tracemalloc计时，再开tracemalloc单独跑一遍测峰值内存（tracemalloc会拖慢执行）。
+
+用法：python benchmarks/bench_pipeline.py [--output 结果.json] [--compare 旧结果.json] [--data 数据目录] [数据参数...]
+数据参数见 benchmarks/synthetic.py；--data 目录中已有相同参数生成的数据时直接复用
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import synthetic  # noqa: E402
+import nginx_ip_geo_stats as geo_stats  # noqa: E402
+
+
+def prepare_data(data_dir, params):
+    """生成或复用合成数据，返回日志文件列表"""
+    params_path = os.path.join(data_dir, 'params.json')
+    if os.path.exists(params_path):
+        with open(params_path, encoding='utf-8') as f:
+            if json.load(f) == params:
+                log_dir = os.path.join(data_dir, 'logs')
+                return sorted(os.path.join(log_dir, name) for name in os.listdir(log_dir))
+    shutil.rmtree(data_dir, ignore_errors=True)
+    _, _, log_files = synthetic.generate(data_dir, **params)
+    with open(params_path, 'w', encoding='utf-8') as f:
+        json.dump(params, f)
+    return log_files
+
+
+def stage_load_index(ctx):
+    geo_stats.GEO_INDEX = None
+    ctx['ip_index'], ctx['geo_lines'] = geo_stats.load_bin_index()
+    return len(ctx['ip_index']['v4'][0]) + len(ctx['ip_index']['v6'][0])
+
+
+def stage_parse(ctx):
+    summary = geo_stats.new_summary()
+    ip_hits = {}
+    for file_path in ctx['log_files']:
+        carry = b'\n'
+        for chunk in geo_stats.read_log_chunks(file_path):
+            carry = geo_stats.process_buffer(carry, chunk, summary, ip_hits)
+        if len(carry) > 1:
+            geo_stats.process_buffer(carry, b'', summary, ip_hits)
+    ctx['summary'], ctx['ip_hits'] = summary, ip_hits
+    return ctx['lines']
+
+
+def stage_resolve(ctx):
+    ip_strs = {ip_str for hits in ctx['ip_hits'].values() for ip_str in hits}
+    ctx['resolved'] = geo_stats.resolve_ips(ip_strs, ctx['ip_index'], ctx['geo_lines'])
+    return len(ip_strs)
+
+
+def stage_resolve_family(ctx, is_v6):
+    ip_strs = [ip_str for ip_str in {ip_str for hits in ctx['ip_hits'].values() for ip_str in hits}
+               if (':' in ip_str) == is_v6]
+    geo_stats.resolve_ips(ip_strs, ctx['ip_index'], ctx['geo_lines'])
+    return len(ip_strs)
+
+
+def stage_aggregate(ctx):
+    # 解析阶段的结果会被修改，每次运行都在副本上展开
+    summary = {'buckets': {start: geo_stats.copy_bucket(bucket) for start, bucket in ctx['summary']['buckets'].items()},
+               'daily': {}, 'geo': {}}
+    geo_stats.apply_ip_hits(ctx['ip_hits'], summary, ctx['ip_index'], ctx['geo_lines'], ctx['resolved'])
+    summary = geo_stats.compact_summary(summary, geo_stats.rollup_compact_cutoff())
+    store = geo_stats.build_rollup_store([summary])
+    ctx['time_stats'] = geo_stats.build_window_stats(store, geo_stats.compute_window_cutoffs())
+    return sum(len(hits) for hits in ctx['ip_hits'].values())
+
+
+def stage_render(ctx, renderer):
+    geo_stats.CHART_RENDERER = renderer
+    time_name = list(geo_stats.TIME_GRANS)[-1]
+    geo_stats.generate_charts(time_name, ctx['time_stats'][time_name])
+    return 1
+
+
+STAGES = [
+    # (阶段名, 函数, 吞吐量单位)
+    ('load_index', stage_load_index, 'IP段/秒'),
+    ('parse', stage_parse, '行/秒'),
+    ('resolve', stage_resolve, 'IP/秒'),
+    # 两个地址族分别查询，对比IPv6与IPv4的查询吞吐量
+    ('resolve_v4', lambda ctx: stage_resolve_family(ctx, False), 'IP/秒'),
+    ('resolve_v6', lambda ctx: stage_resolve_family(ctx, True), 'IP/秒'),
+    ('aggregate', stage_aggregate, '(桶,IP)/秒'),
+    # png：服务器用matplotlib渲染图片；js：只生成Top N数据和地图，图表由浏览器绘制
+    ('render', lambda ctx: stage_render(ctx, 'png'), '次/秒'),
+    ('render_js', lambda ctx: stage_render(ctx, 'js'), '次/秒'),
+]
+
+
+def run_stage(func, ctx, trace):
+    """运行一个阶段（屏蔽主程序的控制台输出），返回 (耗时秒数, 处理量, 峰值内存字节)"""
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        amount = func(ctx)
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, amount, peak
+
+
+def max_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1048576 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run(params, data_dir):
+    log_files = prepare_data(data_dir, params)
+    geo_stats.BIN_INDEX_PATH = os.path.join(data_dir, 'map', 'dbip_index.bin')
+    geo_stats.GEO_TEXT_PATH = os.path.join(data_dir, 'map', 'dbip_geo.txt')
+    geo_stats.MINUTE_CACHE.clear()
+    geo_stats.load_plotting()  # 绘图库在第一次生成图表时才导入，提前导入以免计入render阶段
+    ctx = {'log_files': log_files, 'lines': params['lines']}
+    stages = {}
+    for name, func, unit in STAGES:
+        elapsed, amount, _ = run_stage(func, ctx, trace=False)
+        _, _, peak = run_stage(func, ctx, trace=True)
+        stages[name] = {
+            'seconds': round(elapsed, 4),
+            'amount': amount,
+            'throughput': round(amount / elapsed, 1) if elapsed else None,
+            'unit': unit,
+            'peak_mb': round(peak / 1048576, 2)
+        }
+    return {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'log_mb': round(sum(os.path.getsize(path) for path in log_files) / 1048576, 2),
+        'stages': stages,
+        'max_rss_mb': max_rss_mb()
+    }
+
+
+def print_result(result, baseline=None):
+    print(f"日志: {result['params']['lines']} 行，{result['log_mb']} MB（{len(result['stages'])} 个阶段）")
+    header = f"{'阶段':<12}{'耗时(秒)':>10}{'吞吐量':>16}  {'单位':<12}{'峰值内存(MB)':>12}"
+    if baseline:
+        header += f"{'对比基线':>10}"
+    print(header)
+    for name, stage in result['stages'].items():
+        line = (f"{name:<12}{stage['seconds']:>10.3f}{stage['throughput'] or 0:>16,.1f}  "
+                f"{stage['unit']:<12}{stage['peak_mb']:>12.1f}")
+        old = (baseline or {}).get('stages', {}).get(name)
+        if old and stage['seconds']:
+            line += f"{old['seconds'] / stage['seconds']:>9.2f}x"
+        print(line)
+    if result['max_rss_mb'] is not None:
+        print(f"进程最大常驻内存: {result['max_rss_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='分阶段测量统计流程的耗时和内存')
+    parser.add_argument('--data', help='合成数据目录（默认使用临时目录，运行结束后删除）')
+    parser.add_argument('--output', help='结果JSON保存路径')
+    parser.add_argument('--compare', help='与之前保存的结果JSON对比（显示提速倍数）')
+    synthetic.add_arguments(parser)
+    args = vars(parser.parse_args())
+    data_dir, output, compare = args.pop('data'), args.pop('output'), args.pop('compare')
+
+    temp_dir = None
+    if data_dir is None:
+        temp_dir = data_dir = tempfile.mkdtemp(prefix='geo_stats_bench_')
+    try:
+        result = run(args, data_dir)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    baseline = None
+    if compare:
+        with open(compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_result(result, baseline)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""排行榜视图基准：对比刷新时完整排序各计数器与只选出前RANKING_VIEW_SIZE名的耗时，并检查结果一致
+
+用合成数据生成各时间窗口的统计结果，对每个窗口：
+  1. 分别用完整排序（旧方式）和build_rankings（部分选择）生成五个排行榜，比较耗时
+  2. 视图必须与完整排序的前N名完全相同（包括同次数项的先后）
+  3. API的降序首页、视图之外的页和升序首页必须与按完整排序切出的结果相同
+
+用法：python benchmarks/bench_rankings.py [--view-size N] [--repeat 次数] [数据参数...]
+数据参数见 benchmarks/synthetic.py（默认50万行、20万个URL，只生成1个.log）
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import synthetic  # noqa: E402
+import nginx_ip_geo_stats as geo_stats  # noqa: E402
+
+PAGE_SIZE = 100
+
+
+def window_stats(log_files):
+    """解析日志并生成各固定时间窗口的统计结果"""
+    geo_stats.GEO_INDEX = None
+    ip_index, geo_lines = geo_stats.load_bin_index()
+    summary, ip_hits = geo_stats.new_summary(), {}
+    for file_path in log_files:
+        carry = b'\n'
+        for chunk in geo_stats.read_log_chunks(file_path):
+            carry = geo_stats.process_buffer(carry, chunk, summary, ip_hits)
+        if len(carry) > 1:
+            geo_stats.process_buffer(carry, b'', summary, ip_hits)
+    geo_stats.apply_ip_hits(ip_hits, summary, ip_index, geo_lines)
+    store = geo_stats.build_rollup_store([summary])
+    return geo_stats.build_window_stats(store, geo_stats.compute_window_cutoffs())
+
+
+def sorted_rankings(stats):
+    """旧方式：每个计数器完整排序"""
+    return {
+        name: [(geo_stats.ranking_label(key), count)
+               for key, count in sorted(stats[freq_key].items(), key=lambda x: -x[1])]
+        for name, freq_key in geo_stats.RANKINGS.items()
+    }
+
+
+def timed(func, stats, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(stats)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def expected_page(full, page, order):
+    ordered = full if order == 'desc' else full[::-1]
+    start = (page - 1) * PAGE_SIZE
+    return [(item[0], item[1]) for item in ordered[start:start + PAGE_SIZE]]
+
+
+def pages_match(stats, full, scope):
+    """在视图内、视图之外和升序三种情况下，API翻页结果与完整排序切出的结果相同（第二轮走完整排名缓存），
+    且翻页不修改统计结果中的视图"""
+    views = {name: list(ranking) for name, ranking in stats['rankings'].items()}
+    for name, ranking in full.items():
+        last_view_page = max(len(stats['rankings'][name]) // PAGE_SIZE, 1)
+        for _ in range(2):
+            for page, order in ((1, 'desc'), (last_view_page + 1, 'desc'), (1, 'asc')):
+                result = geo_stats.ranking_page(stats, name, page, PAGE_SIZE, order, scope)
+                items = [(item['name'], item['count']) for item in result['items']]
+                if items != expected_page(ranking, page, order) or result['count'] != len(ranking):
+                    return False
+    return stats['rankings'] == views
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对比完整排序与部分选择生成排行榜的耗时')
+    parser.add_argument('--view-size', type=int, default=geo_stats.RANKING_VIEW_SIZE, help='RANKING_VIEW_SIZE')
+    parser.add_argument('--repeat', type=int, default=3, help='每种方式运行次数（取最快一次）')
+    synthetic.add_arguments(parser)
+    parser.set_defaults(urls=200000, files=1, gz_files=0)
+    args = vars(parser.parse_args())
+    repeat = args.pop('repeat')
+    geo_stats.RANKING_VIEW_SIZE = args.pop('view_size')
+
+    temp_dir = tempfile.mkdtemp(prefix='geo_stats_rankings_')
+    try:
+        map_dir, _, log_files = synthetic.generate(temp_dir, **args)
+        geo_stats.BIN_INDEX_PATH = os.path.join(map_dir, 'dbip_index.bin')
+        geo_stats.GEO_TEXT_PATH = os.path.join(map_dir, 'dbip_geo.txt')
+        with contextlib.redirect_stdout(io.StringIO()):
+            time_stats = window_stats(log_files)
+
+        print(f"{args['lines']} 行，RANKING_VIEW_SIZE={geo_stats.RANKING_VIEW_SIZE}")
+        print(f"{'时间窗口':<10}{'URL数':>10}{'IP数':>10}{'完整排序(毫秒)':>16}{'部分选择(毫秒)':>16}{'提速':>8}{'结果一致':>10}")
+        for time_name, stats in time_stats.items():
+            sort_seconds, full = timed(sorted_rankings, stats, repeat)
+            view_seconds, views = timed(geo_stats.build_rankings, stats, repeat)
+            stats['rankings'] = views
+            same = all(views[name] == ranking[:len(views[name])] for name, ranking in full.items())
+            same = same and pages_match(stats, full, (geo_stats.STATS_GENERATION, time_name))
+            print(f"{time_name:<10}{len(stats['url_freq']):>10}{len(stats['ip_freq']):>10}"
+                  f"{sort_seconds * 1000:>16.1f}{view_seconds * 1000:>16.1f}"
+                  f"{sort_seconds / view_seconds:>7.1f}x{'是' if same else '否':>10}")
+            if not same:
+                sys.exit(1)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
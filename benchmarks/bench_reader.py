@@ -0,0 +1,109 @@
+"""日志读取基准：对比文本模式读取（逐行解码后用str正则）与字节模式读取（整块数据用字节正则，只解码URL和IP）
+
+分别在未压缩的.log和.gz归档上测量读取+解析的吞吐量，并检查两种方式的解析结果完全一致，
+且与最初的字段提取方式（client、request各自取行内第一次出现，见legacy_parser.first_match_counts）计数相同；
+合成日志中带有伪造"client:"的referrer和URL，一行内有多个"client:"。
+字节模式的缓冲区大小取主程序的READ_CHUNK_SIZE、GZIP_READ_SIZE，可用参数覆盖。
+
+用法：python benchmarks/bench_reader.py [--data 数据目录] [--read-chunk 字节数] [--gzip-read 字节数] [数据参数...]
+数据参数见 benchmarks/synthetic.py（默认只生成1个.log和1个.gz）
+"""
+import argparse
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import legacy_parser  # noqa: E402
+import synthetic  # noqa: E402
+import nginx_ip_geo_stats as geo_stats  # noqa: E402
+
+
+def parse_text(file_path):
+    """旧的文本模式：逐行解码后匹配（基线实现见 benchmarks/legacy_parser.py）"""
+    summary, ip_hits = geo_stats.new_summary(), {}
+    open_func = gzip.open if file_path.endswith('.gz') else open
+    with open_func(file_path, 'rt', encoding='utf-8', errors='ignore') as f:
+        legacy_parser.process_lines(f, summary, ip_hits)
+    return summary, ip_hits
+
+
+def parse_bytes(file_path):
+    """字节模式：大块读取（.gz边读边解压），对整块数据用字节正则一次取出各行字段"""
+    summary, ip_hits = geo_stats.new_summary(), {}
+    carry = b'\n'
+    for chunk in geo_stats.read_log_chunks(file_path):
+        carry = geo_stats.process_buffer(carry, chunk, summary, ip_hits)
+    if len(carry) > 1:
+        geo_stats.process_buffer(carry, b'', summary, ip_hits)
+    return summary, ip_hits
+
+
+def first_match_result(file_path):
+    open_func = gzip.open if file_path.endswith('.gz') else open
+    with open_func(file_path, 'rt', encoding='utf-8', errors='ignore') as f:
+        return legacy_parser.first_match_counts(f)
+
+
+def comparable(result):
+    """转为可比较的结构（含各计数器的插入顺序，排行榜同次数时按插入顺序排列）"""
+    summary, ip_hits = result
+    buckets = [(start, [(key, list(value.items()) if isinstance(value, dict) else value)
+                        for key, value in bucket.items()])
+               for start, bucket in summary['buckets'].items()]
+    return buckets, [(start, list(hits.items())) for start, hits in ip_hits.items()]
+
+
+def timed(func, file_path, repeat):
+    best = None
+    for _ in range(repeat):
+        geo_stats.MINUTE_CACHE.clear()
+        start = time.perf_counter()
+        result = func(file_path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对比文本模式与字节模式读取日志的吞吐量')
+    parser.add_argument('--data', help='合成数据目录（默认使用临时目录，运行结束后删除）')
+    parser.add_argument('--read-chunk', type=int, default=geo_stats.READ_CHUNK_SIZE, help='READ_CHUNK_SIZE')
+    parser.add_argument('--gzip-read', type=int, default=geo_stats.GZIP_READ_SIZE, help='GZIP_READ_SIZE')
+    parser.add_argument('--repeat', type=int, default=3, help='每种方式运行次数（取最快一次）')
+    synthetic.add_arguments(parser)
+    parser.set_defaults(files=1, gz_files=1)
+    args = vars(parser.parse_args())
+    data_dir, repeat = args.pop('data'), args.pop('repeat')
+    geo_stats.READ_CHUNK_SIZE, geo_stats.GZIP_READ_SIZE = args.pop('read_chunk'), args.pop('gzip_read')
+
+    temp_dir = None
+    if data_dir is None:
+        temp_dir = data_dir = tempfile.mkdtemp(prefix='geo_stats_reader_')
+    try:
+        _, _, log_files = synthetic.generate(data_dir, **args)
+        plain = next(path for path in log_files if not path.endswith('.gz'))
+        archive = next(path for path in log_files if path.endswith('.gz'))
+        print(f"READ_CHUNK_SIZE={geo_stats.READ_CHUNK_SIZE}，GZIP_READ_SIZE={geo_stats.GZIP_READ_SIZE}")
+        print(f"{'文件':<10}{'大小(MB)':>10}{'文本模式(秒)':>14}{'字节模式(秒)':>14}{'提速':>8}{'结果一致':>10}{'与最初提取一致':>16}")
+        for label, file_path in (('.log', plain), ('.gz', archive)):
+            text_seconds, text_result = timed(parse_text, file_path, repeat)
+            bytes_seconds, bytes_result = timed(parse_bytes, file_path, repeat)
+            same = comparable(text_result) == comparable(bytes_result)
+            original = legacy_parser.summary_counts(*bytes_result) == first_match_result(file_path)
+            print(f"{label:<10}{os.path.getsize(file_path) / 1048576:>10.1f}{text_seconds:>14.3f}"
+                  f"{bytes_seconds:>14.3f}{text_seconds / bytes_seconds:>7.2f}x{'是' if same else '否':>10}"
+                  f"{'是' if original else '否':>16}")
+            if not same or not original:
+                sys.exit(1)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
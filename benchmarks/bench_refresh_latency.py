@@ -0,0 +1,163 @@
+"""刷新期间的请求延迟：检查后台刷新进行时页面请求仍能及时得到响应
+
+两种部署方式分别测量：
+  thread   刷新在Web进程的后台线程中运行（单进程运行或gunicorn gthread worker中负责刷新的worker）
+  process  刷新在单独的 --headless 进程中运行，Web进程只加载它写入的快照（Dockerfile的部署方式）
+先完成一次刷新发布统计结果，再完整重新解析一遍日志，期间通过真实的HTTP服务器不断请求排行榜API，
+报告刷新期间完成的请求数和延迟；刷新期间没有请求完成或最大延迟超过 --max-latency 秒时以非零状态退出。
+刷新结束后的第一个请求单独报告：process方式下Web进程在该请求前加载新快照，耗时随快照大小增长。
+
+用法：python benchmarks/bench_refresh_latency.py [--modes thread,process] [--max-latency 秒] [数据参数...]
+数据参数见 benchmarks/synthetic.py（默认100万行，只生成1个.log）
+"""
+import argparse
+import contextlib
+import io
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import synthetic  # noqa: E402
+import nginx_ip_geo_stats as geo_stats  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+API_PATH = '/api/' + urllib.parse.quote('最近一天') + '/urls?page=1&size=20'
+HEADLESS_SCRIPT = '''import sys
+sys.path.insert(0, sys.argv[1])
+import nginx_ip_geo_stats as geo_stats
+geo_stats.BIN_INDEX_PATH, geo_stats.GEO_TEXT_PATH, geo_stats.LOG_DIR = sys.argv[2:5]
+geo_stats.INCREMENTAL_REFRESH = False
+geo_stats.run_headless(once=True)
+'''
+
+
+def configure(map_dir, log_dir):
+    geo_stats.BIN_INDEX_PATH = os.path.join(map_dir, 'dbip_index.bin')
+    geo_stats.GEO_TEXT_PATH = os.path.join(map_dir, 'dbip_geo.txt')
+    geo_stats.LOG_DIR = log_dir
+    geo_stats.GEO_INDEX = None
+    geo_stats.CHART_PRERENDER = False
+    geo_stats.INCREMENTAL_REFRESH = False  # 每次刷新都完整解析，保证刷新持续足够长的时间
+
+
+def start_server(app):
+    """在后台线程启动多线程HTTP服务器（与开发服务器相同，每个请求一个线程），返回地址"""
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def timed_request(base_url):
+    started = time.perf_counter()
+    with urllib.request.urlopen(base_url + API_PATH, timeout=60) as response:
+        response.read()
+    return time.perf_counter() - started
+
+
+def poll_until(base_url, finished):
+    """刷新结束前不断请求排行榜API，返回刷新期间每次请求的延迟（秒）和刷新结束后第一个请求的延迟"""
+    latencies = []
+    while not finished():
+        latency = timed_request(base_url)
+        if not finished():  # 与刷新结束重叠的请求不计入刷新期间
+            latencies.append(latency)
+        time.sleep(0.01)
+    return latencies, timed_request(base_url)
+
+
+def run_thread_mode(map_dir, log_dir):
+    """刷新在本进程的后台线程中运行"""
+    configure(map_dir, log_dir)
+    geo_stats.SHARED_SNAPSHOT = False
+    with contextlib.redirect_stdout(io.StringIO()):
+        geo_stats.start_refresh()['done'].wait()
+        app = geo_stats.build_app()
+    server, base_url = start_server(app)
+    try:
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            job = geo_stats.start_refresh()
+            latencies, after = poll_until(base_url, job['done'].is_set)
+        return time.perf_counter() - started, latencies, after
+    finally:
+        server.shutdown()
+
+
+def run_process_mode(map_dir, log_dir):
+    """刷新在单独的无界面进程中运行，本进程像gunicorn worker一样只在请求前加载快照"""
+    configure(map_dir, log_dir)
+    command = [sys.executable, '-c', HEADLESS_SCRIPT, ROOT, geo_stats.BIN_INDEX_PATH, geo_stats.GEO_TEXT_PATH, log_dir]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    geo_stats.SHARED_SNAPSHOT = True
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = geo_stats.build_app()
+    app.before_request(geo_stats.sync_snapshot)
+    server, base_url = start_server(app)
+    try:
+        timed_request(base_url)  # 第一个请求加载已有快照，相当于已在运行的worker
+        started = time.perf_counter()
+        published = os.stat(geo_stats.SNAPSHOT_PATH).st_mtime_ns
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+        def finished():
+            # 新快照写入后即视为刷新结束（之后的请求会先加载新快照）
+            return process.poll() is not None or os.stat(geo_stats.SNAPSHOT_PATH).st_mtime_ns != published
+
+        latencies, after = poll_until(base_url, finished)
+        if process.wait() != 0:
+            raise SystemExit(f"无界面刷新进程异常退出：{process.returncode}")
+        return time.perf_counter() - started, latencies, after
+    finally:
+        server.shutdown()
+
+
+MODES = {'thread': run_thread_mode, 'process': run_process_mode}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='测量后台刷新期间的请求延迟')
+    parser.add_argument('--modes', default=','.join(MODES), help='逗号分隔：thread、process')
+    parser.add_argument('--max-latency', type=float, default=1.0, help='刷新期间允许的最大请求延迟（秒）')
+    synthetic.add_arguments(parser)
+    parser.set_defaults(lines=1000000, files=1, gz_files=0)
+    args = vars(parser.parse_args())
+    modes, max_latency = args.pop('modes').split(','), args.pop('max_latency')
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # 不逐条输出请求日志
+    temp_dir = tempfile.mkdtemp(prefix='geo_stats_latency_')
+    cwd = os.getcwd()
+    try:
+        map_dir, log_dir, _ = synthetic.generate(temp_dir, **args)
+        os.chdir(temp_dir)  # state/下的快照、锁和状态文件都写在临时目录中
+        print(f"{args['lines']} 行")
+        print(f"{'刷新方式':<10}{'刷新耗时(秒)':>14}{'期间请求数':>12}{'中位延迟(毫秒)':>16}{'最大延迟(毫秒)':>16}"
+              f"{'刷新后首个请求(毫秒)':>22}{'通过':>6}")
+        failed = False
+        for mode in modes:
+            shutil.rmtree(os.path.join(temp_dir, 'state'), ignore_errors=True)
+            seconds, latencies, after = MODES[mode](map_dir, log_dir)
+            ok = bool(latencies) and max(latencies) <= max_latency
+            failed = failed or not ok
+            median = sorted(latencies)[len(latencies) // 2] * 1000 if latencies else float('nan')
+            worst = max(latencies) * 1000 if latencies else float('nan')
+            print(f"{mode:<10}{seconds:>14.2f}{len(latencies):>12}{median:>16.1f}{worst:>16.1f}"
+                  f"{after * 1000:>22.1f}{'是' if ok else '否':>6}")
+        if failed:
+            sys.exit(1)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""旧的文本解析路径，只作为基准测试的对照基线（正式刷新只使用主程序中的字节解析process_buffer）
+
+  parse_log_time + is_in_time_range：最初的逐行解析（每次编译正则 + strptime，每行调用now()）
+  first_match_counts：最初的字段提取方式，client和request各自搜索行内第一次出现的位置，作为解析结果的对照
+  process_lines：逐行解码后用单条str正则匹配，按分钟前缀缓存时间解析（字节解析之前的实现）
+"""
+import datetime
+import os
+import re
+import sys
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import nginx_ip_geo_stats as geo_stats  # noqa: E402
+
+# 单条正则一次提取：时间（分钟前缀、秒）、客户端IP（IPv4或IPv6）、请求URL，IP和URL可缺失
+# 与主程序的LINE_PATTERN_BYTES相同：取行内第一个", client: IP, server: "和其后第一个", request: "
+LINE_PATTERN = re.compile(
+    r'(\d{4}/\d{2}/\d{2} \d{2}:\d{2}):(\d{2})'
+    r'(?:[^,\n]*(?:,(?! client: )[^,\n]*)*, client: (\d+\.\d+\.\d+\.\d+|[0-9A-Fa-f]*:[0-9A-Fa-f:.]+), server: )?'
+    r'(?:[^,\n]*(?:,(?! request: ")[^,\n]*)*, request: "(?:GET|POST|PUT|DELETE|HEAD|OPTIONS|PATCH) ([^ \n]+))?'
+)
+
+
+def parse_log_time(log_line):
+    """从日志行提取时间戳（适配格式：2025/09/03 01:16:09）"""
+    # 正则匹配：2025/09/03 01:16:09
+    time_pattern = re.compile(r'^(\d{4}/\d{2}/\d{2}\s+\d{2}:\d{2}:\d{2})')
+    match = time_pattern.search(log_line)
+    if not match:
+        return None  # 未找到时间戳
+    time_str = match.group(1)
+    try:
+        # 解析为datetime对象（格式：年/月/日 时:分:秒）
+        return datetime.datetime.strptime(time_str, "%Y/%m/%d %H:%M:%S")
+    except ValueError as e:
+        print(f"时间解析失败：{time_str}，错误：{e}")
+        return None
+
+
+def is_in_time_range(log_time, days):
+    """判断日志时间是否在最近N天内"""
+    if not log_time:
+        return False
+    delta = datetime.datetime.now() - log_time
+    return delta.days < days
+
+
+# 最初的字段提取：两条正则各自search，取行内第一次出现的"client:"和"request: "（nginx自己写的字段总在前面）；
+# IP部分与主程序一样同时接受IPv6，否则IPv6行会越过真实字段匹配到后面伪造的IPv4
+FIRST_IP_PATTERN = re.compile(r'client:\s*(\d+\.\d+\.\d+\.\d+|[0-9A-Fa-f]*:[0-9A-Fa-f:.]+)')
+FIRST_URL_PATTERN = re.compile(r'request: "(GET|POST|PUT|DELETE|HEAD|OPTIONS|PATCH) ([^ ]+)')
+
+
+def first_match_counts(lines):
+    """按最初的方式逐行提取字段，返回 (时段, URL, IP) 计数（不筛选时间范围）"""
+    hour_freq, url_freq, ip_freq = defaultdict(int), defaultdict(int), defaultdict(int)
+    for line in lines:
+        log_time = parse_log_time(line)
+        if not log_time:
+            continue
+        hour_freq[log_time.hour] += 1
+        url_match = FIRST_URL_PATTERN.search(line)
+        if url_match:
+            url_freq[url_match.group(2)] += 1
+        ip_match = FIRST_IP_PATTERN.search(line)
+        if ip_match:
+            ip_freq[ip_match.group(1)] += 1
+    return dict(hour_freq), dict(url_freq), dict(ip_freq)
+
+
+def summary_counts(summary, ip_hits):
+    """把各小时桶的计数合并为与first_match_counts相同的 (时段, URL, IP) 计数"""
+    hour_freq, url_freq, ip_freq = defaultdict(int), defaultdict(int), defaultdict(int)
+    for bucket in summary['buckets'].values():
+        for key, freq in (('hour_freq', hour_freq), ('url_freq', url_freq)):
+            for item, count in bucket[key].items():
+                freq[item] += count
+    for hits in ip_hits.values():
+        for ip_str, count in hits.items():
+            ip_freq[ip_str] += count
+    return dict(hour_freq), dict(url_freq), dict(ip_freq)
+
+
+def process_lines(lines, summary, ip_hits):
+    """逐行解析日志，计入所属小时桶；客户端IP只计数，地理信息在整批解析后统一查询"""
+    buckets = summary['buckets']
+    match_line = LINE_PATTERN.match
+    current_minute = minute_start = hour = None
+    bucket_start = hour_freq = url_freq = bucket_ips = None
+    for line in lines:
+        # 1. 一次匹配提取时间戳、客户端IP和URL
+        match = match_line(line)
+        if not match:
+            continue
+        minute_prefix, second, ip_str, url = match.groups()
+        if minute_prefix != current_minute:
+            minute = geo_stats.MINUTE_CACHE.get(minute_prefix)
+            if minute is None:
+                minute = geo_stats.parse_minute(minute_prefix)
+            if not minute:
+                continue
+            current_minute = minute_prefix
+            minute_start, hour = minute
+        if second > '61':
+            continue
+        seconds = minute_start + int(second)
+        start = seconds - seconds % geo_stats.BUCKET_SECONDS
+        if start != bucket_start:
+            # 日志基本按时间顺序写入，只在跨桶时才查找/创建小时桶
+            bucket = buckets.get(start)
+            if bucket is None:
+                bucket = buckets[start] = geo_stats.new_bucket()
+            bucket_start = start
+            hour_freq = bucket['hour_freq']
+            url_freq = bucket['url_freq']
+            bucket_ips = ip_hits.get(start)
+            if bucket_ips is None:
+                bucket_ips = ip_hits[start] = defaultdict(int)
+
+        # 添加时段统计
+        hour_freq[hour] += 1
+        # 2. URL
+        if url:
+            url_freq[url] += 1
+        # 3. 客户端IP，按小时桶分别计数
+        if ip_str:
+            bucket_ips[ip_str] += 1
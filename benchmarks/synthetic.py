@@ -0,0 +1,188 @@
+"""基准测试用的合成数据：gitlab_error日志（.log和.gz，也可生成访问日志或JSON日志）以及与之匹配的dbip_index.bin / dbip_geo.txt
+
+客户端IP从生成的地理库IPv4/IPv6段中抽取（可设置IPv6比例和未命中比例），URL按长尾分布抽取，
+解析、地理查询、聚合各阶段都有与真实数据相近的工作量。同样的参数和种子总是生成同样的数据。
+
+用法：python benchmarks/synthetic.py 输出目录 [--lines N] [--ips N] [--urls N] [--days N] [--ranges N] ...
+生成 输出目录/map/dbip_index.bin、输出目录/map/dbip_geo.txt 和 输出目录/logs/gitlab_error.log*
+（--log-format combined 生成gitlab_access.log*，gitlab_json 生成production_json.log*；同样的参数和种子在各格式下是同一批请求）
+"""
+import argparse
+import datetime
+import gzip
+import ipaddress
+import itertools
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import nginx_ip_geo_stats as geo_stats  # noqa: E402  只用到索引写入，不会导入绘图库
+
+DEFAULTS = {
+    'lines': 500000,  # 日志总行数
+    'ips': 20000,  # 不同客户端IP数
+    'urls': 50000,  # 不同URL数
+    'days': 30,  # 日志时间跨度（天），最新一行接近当前时间
+    'ranges': 100000,  # 地理库IPv4段数
+    'v6_ranges': 20000,  # 地理库IPv6段数
+    'v6_ratio': 0.1,  # 客户端IP中IPv6的比例
+    'locations': 5000,  # 地理库地点数
+    'files': 2,  # 未压缩日志文件数（gitlab_error.log、gitlab_error.log.1……）
+    'gz_files': 2,  # 压缩归档数（gitlab_error.log.N.gz）
+    'miss_ratio': 0.05,  # 不在任何IP段内的IP比例
+    'log_format': 'nginx_error',  # 日志格式：nginx_error、combined或gitlab_json
+    'seed': 1
+}
+FORMAT_FILES = {'nginx_error': 'gitlab_error', 'combined': 'gitlab_access', 'gitlab_json': 'production_json'}
+
+COUNTRIES = ['CN', 'US', 'DE', 'RU', 'BR', 'IN', 'JP', 'FR', 'GB', 'KR', 'NL', 'SG', 'VN', 'ID', 'UA']
+
+
+def generate_geo(map_dir, ranges, v6_ranges, locations, rng):
+    """生成IP段索引和地名文本，返回 (IPv4段列表, IPv6段列表)，每项为 (起始IP, 结束IP)"""
+    os.makedirs(map_dir, exist_ok=True)
+    geo_offsets = []
+    with open(os.path.join(map_dir, 'dbip_geo.txt'), 'w', encoding='utf-8') as f:
+        for i in range(locations):
+            geo_offsets.append(i)
+            f.write(f"{rng.choice(COUNTRIES)}|Region{i % 400}|City{i}|"
+                    f"{rng.uniform(-60, 60):.4f}|{rng.uniform(-170, 170):.4f}\n")
+
+    # IP段之间留有空隙，部分IP查不到地理信息
+    span = (1 << 32) // ranges
+    ip_ranges = []
+    for i in range(ranges):
+        start = i * span + rng.randrange(span // 4)
+        ip_ranges.append((start, start + rng.randrange(span // 2)))
+    # IPv6段分布在2000::/3内，与真实数据一样大多是/32到/64的前缀，少数段的起点共享高64位
+    span6 = (1 << 125) // max(v6_ranges, 1)
+    v6_ip_ranges = []
+    for i in range(v6_ranges):
+        start = (1 << 125) + i * span6
+        if rng.random() < 0.9:
+            start -= start % (1 << 64)
+            end = start + (1 << rng.choice((64, 80, 96))) - 1
+        else:
+            start += rng.randrange(1 << 48)
+            end = start + rng.randrange(1 << 40)
+        v6_ip_ranges.append((start, end))
+    geo_stats.write_bin_index(os.path.join(map_dir, 'dbip_index.bin'),
+                              [(start, end, rng.choice(geo_offsets)) for start, end in ip_ranges],
+                              [(start, end, rng.choice(geo_offsets)) for start, end in v6_ip_ranges])
+    return ip_ranges, v6_ip_ranges
+
+
+def sample_ips(ip_ranges, v6_ip_ranges, count, v6_ratio, miss_ratio, rng):
+    """从IP段中抽取count个不同的IP，其中约v6_ratio比例为IPv6，约miss_ratio比例不在任何IP段内"""
+    ips = set()
+    while len(ips) < count:
+        use_v6 = v6_ip_ranges and rng.random() < v6_ratio
+        family_ranges = v6_ip_ranges if use_v6 else ip_ranges
+        start, end = family_ranges[rng.randrange(len(family_ranges))]
+        if rng.random() < miss_ratio:
+            value = end + 1  # 紧挨在IP段之后的空隙
+        else:
+            value = rng.randint(start, end)
+        ips.add(str(ipaddress.IPv6Address(value) if use_v6 else ipaddress.IPv4Address(value)))
+    return sorted(ips)
+
+
+def log_lines(count, ips, urls, start_time, end_time, rng, log_format='nginx_error'):
+    """按时间顺序逐行生成日志；URL按1/排名的长尾分布抽取，约一成的行没有请求（错误日志无request字段，
+    访问日志为"-"，JSON日志无path字段）。随机数的使用与格式无关，各格式的行对应同样的请求；
+    时间按本地时间生成，访问日志带本地时区偏移，JSON日志与GitLab一样按UTC记录"""
+    url_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(urls))))
+    step = (end_time - start_time).total_seconds() / max(count, 1)
+    for i in range(count):
+        log_time = start_time + datetime.timedelta(seconds=i * step)
+        method = url = None
+        if rng.random() < 0.9:
+            url = rng.choices(urls, cum_weights=url_weights)[0]
+            method = rng.choice(("GET", "POST"))
+        ip = rng.choice(ips)
+        if log_format == 'combined':
+            request = f'{method} {url} HTTP/1.1' if url else '-'
+            # 每10行有一行的用户名（客户端可控）中伪造时间，统计时必须取nginx自己写的时间字段
+            user = '[01/Jan/2020:00:00:00' if i % 10 == 9 else '-'
+            yield (f'{ip} - {user} [{log_time.astimezone():%d/%b/%Y:%H:%M:%S %z}] "{request}" {404 if url else 400} '
+                   f'{(i * 37) % 5000} "-" "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+                   f'(KHTML, like Gecko) Chrome/120.0 Safari/537.36" "-"\n')
+        elif log_format == 'gitlab_json':
+            request = f'"method":"{method}","path":"{url}","format":"html",' if url else ''
+            yield (f'{{{request}"controller":"ApplicationController","status":404,'
+                   f'"time":"{log_time.astimezone(datetime.timezone.utc):%Y-%m-%dT%H:%M:%S}.{i % 1000:03d}Z",'
+                   f'"params":[],"remote_ip":"{ip}",'
+                   f'"user_id":null,"username":null,"ua":"curl/8.0","duration_s":0.01}}\n')
+        else:
+            request = f', request: "{method} {url} HTTP/1.1"' if url else ''
+            # 每10行有一行带伪造"client: "的referrer（攻击者可控），统计时必须取nginx自己写的client字段
+            referrer = f', referrer: "http://evil.example/client: 198.51.100.{i % 250}"' if i % 10 == 9 else ''
+            yield (f'{log_time:%Y/%m/%d %H:%M:%S} [error] 2817#0: *{i} open() '
+                   f'"/opt/gitlab/embedded/service/gitlab-rails/public/favicon.ico" failed '
+                   f'(2: No such file or directory), client: {ip}, server: gitlab.example.com'
+                   f'{request}, host: "gitlab.example.com"{referrer}\n')
+
+
+def generate_logs(log_dir, lines, ips, urls, days, files, gz_files, rng, now=None, log_format='nginx_error'):
+    """按时间先后把日志分到各文件：最早的在编号最大的.gz归档中，最新的在gitlab_error.log（或对应格式的文件）中
+
+    返回生成的文件路径列表
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    now = now or datetime.datetime.now()
+    start_time = now - datetime.timedelta(days=days)
+    total_files = files + gz_files
+    prefix = FORMAT_FILES[log_format]
+    names = [f'{prefix}.log'] + [f'{prefix}.log.{k}' for k in range(1, files)]
+    names += [f'{prefix}.log.{k}.gz' for k in range(files, total_files)]
+    span = (now - start_time) / total_files
+    per_file = lines // total_files
+    paths = []
+    for index, name in enumerate(names):
+        # index越大越早
+        file_end = now - span * index
+        count = per_file + (lines % total_files if index == 0 else 0)
+        path = os.path.join(log_dir, name)
+        open_func = gzip.open if name.endswith('.gz') else open
+        with open_func(path, 'wt', encoding='utf-8') as f:
+            f.writelines(log_lines(count, ips, urls, file_end - span, file_end, rng, log_format))
+        paths.append(path)
+    return paths
+
+
+def generate(out_dir, now=None, **params):
+    """生成整套数据，返回 (地理库目录, 日志目录, 日志文件列表)；now相同时各格式的日志时间完全对应"""
+    params = dict(DEFAULTS, **params)
+    rng = random.Random(params['seed'])
+    map_dir = os.path.join(out_dir, 'map')
+    log_dir = os.path.join(out_dir, 'logs')
+    ip_ranges, v6_ip_ranges = generate_geo(map_dir, params['ranges'], params['v6_ranges'], params['locations'], rng)
+    ips = sample_ips(ip_ranges, v6_ip_ranges, params['ips'], params['v6_ratio'], params['miss_ratio'], rng)
+    # 少数URL的查询参数里带有"client:"，检查解析时不会把它当作客户端IP
+    urls = [f"/group{i % 100}/project{i}/-/raw/main/file{i}.txt" + ('?q=client:9.9.9.9' if i % 50 == 49 else '')
+            for i in range(params['urls'])]
+    log_files = generate_logs(log_dir, params['lines'], ips, urls, params['days'],
+                              params['files'], params['gz_files'], rng, now, params['log_format'])
+    return map_dir, log_dir, log_files
+
+
+def add_arguments(parser):
+    for name, default in DEFAULTS.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=type(default), default=default)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成基准测试用的合成日志和地理库')
+    parser.add_argument('out_dir')
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+    out_dir = args.pop('out_dir')
+    map_dir, log_dir, log_files = generate(out_dir, **args)
+    print(f"地理库: {map_dir}")
+    for path in log_files:
+        print(f"日志: {path} ({os.path.getsize(path) / 1048576:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
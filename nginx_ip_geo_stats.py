@@ -3,38 +3,80 @@ import re
 import gzip
 import struct
 import socket
+import bisect
 import datetime
-from collections import defaultdict, OrderedDict
-# 添加新的依赖
-import matplotlib
-matplotlib.use('Agg')  # 非交互式后端，适合服务器环境
-import matplotlib.pyplot as plt
-import seaborn as sns
-import pandas as pd
-from flask import Flask, render_template, make_response, app
+import mmap
+import pickle
+import queue
+import zlib
+import hashlib
+import heapq
+import hmac
+import json
+import logging
+import sys
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict, deque, OrderedDict
 from io import BytesIO
 import base64
-import folium
-from folium import plugins
 import platform  # 添加导入platform模块
 import threading
 import time
-# 在generate_charts函数中修改字体设置部分
-# 替换原有的字体设置代码
-# 设置中文字体
-plt.rcParams['axes.unicode_minus'] = False  # 解决负号显示问题
-
-# 跨平台字体设置
-system = platform.system()
-if system == 'Windows':
-    plt.rcParams["font.family"] = ["SimHei", "Microsoft YaHei", "SimSun"]
-elif system == 'Linux':
-    # 在Linux系统中尝试使用常见的中文字体
-    cn_fonts = ['Noto Sans CJK SC', 'WenQuanYi Micro Hei', 'SimHei', 'DejaVu Sans']
-    plt.rcParams["font.family"] = cn_fonts
-else:
-    # 其他系统使用默认字体
-    plt.rcParams["font.family"] = ['sans-serif']
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+# 绘图库（matplotlib、seaborn、folium）和Flask导入较慢、占内存较多，只解析日志的进程用不到，
+# 分别在第一次生成图表（load_plotting / load_folium）和创建Web应用（build_app）时才导入
+plt = sns = folium = plugins = None
+PLOTTING_LOCK = threading.Lock()
+
+
+def load_folium():
+    """第一次生成地图时导入folium（js渲染方式下只需要地图库，不导入matplotlib）"""
+    global folium, plugins
+    if plugins is not None:
+        return
+    with PLOTTING_LOCK:
+        if plugins is not None:
+            return
+        import folium as folium_module
+        from folium import plugins as folium_plugins
+        folium = folium_module
+        plugins = folium_plugins  # 最后赋值：其他线程看到plugins不为None时folium已就绪
+
+
+def load_plotting():
+    """第一次以png方式生成图表时导入绘图库并设置字体"""
+    global plt, sns
+    load_folium()
+    if plt is not None:
+        return
+    with PLOTTING_LOCK:
+        if plt is not None:
+            return
+        import matplotlib
+        matplotlib.use('Agg')  # 非交互式后端，适合服务器环境
+        import matplotlib.pyplot as pyplot
+        import seaborn
+        # 设置中文字体
+        pyplot.rcParams['axes.unicode_minus'] = False  # 解决负号显示问题
+
+        # 跨平台字体设置
+        system = platform.system()
+        if system == 'Windows':
+            pyplot.rcParams["font.family"] = ["SimHei", "Microsoft YaHei", "SimSun"]
+        elif system == 'Linux':
+            # 在Linux系统中尝试使用常见的中文字体
+            cn_fonts = ['Noto Sans CJK SC', 'WenQuanYi Micro Hei', 'SimHei', 'DejaVu Sans']
+            pyplot.rcParams["font.family"] = cn_fonts
+        else:
+            # 其他系统使用默认字体
+            pyplot.rcParams["font.family"] = ['sans-serif']
+        sns = seaborn
+        plt = pyplot  # 最后赋值：其他线程看到plt不为None时其余模块都已就绪
+
+logger = logging.getLogger('nginx_ip_geo_stats')
 
 # 添加全局变量存储统计数据
 GLOBAL_STATS = None
@@ -43,6 +85,11 @@ GLOBAL_STATS = None
 # ========================
 # centos7环境
 LOG_DIR = "/var/log/gitlab/nginx/"  # 日志文件存放目录（包含 .log 和 .gz 文件）
+LOG_SOURCES = [  # 参与统计的日志：(文件名前缀, 日志格式（LOG_FORMATS中的名称）, 所在目录（None表示LOG_DIR）)，各来源合并统计
+    ('gitlab_error', 'nginx_error', None),
+    # ('gitlab_access', 'combined', None),  # 访问日志（量约为错误日志的百倍），与错误日志同时启用时同一请求可能计两次
+    # ('production_json', 'gitlab_json', "/var/log/gitlab/gitlab-rails/"),
+]
 BIN_INDEX_PATH = "map/dbip_index.bin"  # 二进制索引文件路径
 GEO_TEXT_PATH = "map/dbip_geo.txt"  # 地名文本文件路径
 # windows测试环境
@@ -56,6 +103,106 @@ TIME_GRANS = {  # 时间粒度定义（名称: 天数）
     "最近一月": 30,
     "历史情况": 365 * 10  # 足够大的天数覆盖所有历史
 }
+BUCKET_SECONDS = 3600  # 聚合时间桶粒度（秒），时间窗口起点按此对齐，需能整除一天
+ROLLUP_HOURLY_DAYS = 31  # 最近N天保留小时桶，更早的合并为天桶（应大于TIME_GRANS中除历史外的最大天数）
+DAY_SECONDS = 86400
+INCREMENTAL_REFRESH = True  # 增量模式：刷新时只解析日志新追加的内容
+STATE_PATH = "state/ingest_state.pkl"  # 增量检查点及已有统计的持久化文件
+READ_CHUNK_SIZE = 1024 * 1024  # 读取日志时每次读取（.gz为解压后）的字节数
+GZIP_READ_SIZE = 1024 * 1024  # 读取.gz归档时每次从文件读取的压缩数据字节数
+HEAD_CHECK_BYTES = 4096  # 用文件开头多少字节识别文件是否被替换
+INGEST_STATE_VERSION = 3
+SUMMARY_VERSION = 3  # 汇总结构或解析规则版本，变化时旧的检查点和归档缓存全部作废（3：支持IPv6客户端）
+SUMMARY_CACHE_ENABLED = True  # 缓存已轮转压缩的.gz归档的汇总，内容不变时不再重复解析
+SUMMARY_CACHE_DIR = "state/summary_cache"  # 归档汇总缓存目录（每个归档一个文件）
+SUMMARY_CACHE = {}  # 内存中的归档汇总缓存：缓存键 -> 缓存条目
+INGEST_STATE = None  # 内存中的检查点（避免每次刷新都反序列化）
+INGEST_WORKERS = 1  # 解析日志的进程数，大于1时用多进程并行解析多个文件或大段新增日志
+RANGE_SPLIT_BYTES = 64 * 1024 * 1024  # 并行模式下未压缩日志按此大小切分（按行边界对齐）
+ROLLUP_STORE = None  # 当前的时间桶汇总存储，用于查询任意时间范围
+GEO_INDEX = None  # 已加载的地理库（整个进程只加载一次，文件变化时重新加载）
+BIN_INDEX_MAGIC = b'GEOIDX02'  # 第2版索引文件的文件头标识（没有文件头的是只含IPv4的第1版）
+BIN_INDEX_HEADER = struct.Struct('<8sII16x')  # 文件头：标识、IPv4段数、IPv6段数，共32字节
+INGEST_LOCK = threading.Lock()  # 防止手动刷新与定时刷新同时读取同一文件
+STATS_GENERATION = 0  # 统计数据代数，每次刷新完成加1，用作图表缓存键的一部分
+CHART_PRERENDER = True  # 刷新完成后在后台预先渲染所有固定时间窗口的图表
+CHART_CACHE_LIMIT = 32  # 最多缓存多少份图表（含自定义时间范围）
+CHART_CACHE = OrderedDict()  # (时间范围名称, 统计代数) -> 图表
+CHART_CACHE_LOCK = threading.Lock()
+CHART_RENDER_LOCK = threading.Lock()  # matplotlib不是线程安全的，图表渲染串行执行
+MAP_MAX_POINTS = 2000  # 地图最多绘制的位置点数（按访问次数取前N个），0表示不限制
+CHART_RENDERER = "js"  # 图表渲染方式："js"页面只带各图表的Top N数据，由浏览器用内置脚本绘制；"png"由服务器用matplotlib渲染图片
+RANKINGS = {  # 排行榜名称（API路径）: 计数器
+    'urls': 'url_freq',
+    'ips': 'ip_freq',
+    'countries': 'country_freq',
+    'regions': 'region_freq',
+    'cities': 'city_freq'
+}
+API_PAGE_SIZE = 10  # 排行榜API默认每页条数
+API_MAX_PAGE_SIZE = 200  # 排行榜API每页最多条数
+RANKING_VIEW_SIZE = 1000  # 刷新时每个排行榜只选出前N名（部分选择，不做完整排序），API翻到之后的页或升序查看时再完整排序
+RANGE_STATS_CACHE_LIMIT = 8  # 最多缓存多少个自定义时间范围的统计结果（翻页时不必重新合并时间桶）
+RANGE_STATS_CACHE = OrderedDict()  # (起点, 终点, 统计代数) -> 统计结果
+FULL_RANKING_CACHE_LIMIT = 8  # 最多缓存多少个完整排名（翻到视图之外或升序查看时生成）
+FULL_RANKING_CACHE = OrderedDict()  # (统计代数, 时间窗口名称或(起点, 终点), 排行榜) -> 完整排名
+STATS_SNAPSHOT = None  # 当前发布的统计快照：同一代的窗口统计、时间桶存储和刷新时间，整体替换
+REFRESH_JOB = None  # 当前或最近一次后台刷新任务及其进度
+REFRESH_JOB_LOCK = threading.Lock()
+REFRESH_STATUS_PATH = "state/refresh_status.json"  # 多进程部署时刷新进度写入此文件，任一worker都能查询
+REFRESH_REQUEST_PATH = "state/refresh.request"  # 多进程部署时其他worker修改此文件通知负责刷新的worker
+REFRESH_POLL_SECONDS = 1  # 负责刷新的worker检查刷新请求的间隔
+IS_REFRESH_LEADER = False  # 本进程是否负责刷新（单进程运行时不使用）
+SHARED_SNAPSHOT = False  # gunicorn多进程部署时为True：各worker加载负责刷新的worker写入的快照文件
+SNAPSHOT_PATH = "state/stats_snapshot.pkl"  # 统计快照文件：每次刷新后写入，启动时先加载（多进程部署时各worker共享）
+SNAPSHOT_FORMAT = 1  # 快照文件格式版本，结构变化时加1，旧快照自动作废
+WARM_START = True  # 启动时先加载上次的统计快照立即提供服务，后台刷新完成后再替换
+SNAPSHOT_VERSION = None  # 本进程已加载的快照文件 (inode, 大小, 修改时间)
+SNAPSHOT_LOCK = threading.Lock()
+REFRESH_LOCK_PATH = "state/refresh.lock"  # 持有此文件锁的worker负责定时刷新，保证只刷新一份
+REFRESH_LEADER_RETRY = 30  # 其余worker每隔多少秒尝试接替（负责刷新的worker退出后锁自动释放）
+LOG_LEVEL = "INFO"  # 日志级别，设为DEBUG时输出抽样的IP地理信息
+GEO_LOG_SAMPLE = 1000  # DEBUG级别下每解析出多少个新IP输出一条地理信息
+TIMINGS = {'read': 0.0, 'parse': 0.0, 'geo_lookup': 0.0, 'aggregate': 0.0, 'lines': 0, 'bytes': 0}  # 本进程当前刷新各阶段的累计耗时、行数和字节数（工作进程中每个任务单独统计后返回）
+FILE_METRICS = {}  # 本次刷新中每个实际解析过的文件的耗时、行数和字节数
+CHART_METRICS = {'hits': 0, 'misses': 0, 'renders': 0, 'render_seconds': 0.0}
+APPROX_COUNTING = False  # 近似模式：URL和IP计数器只保留高频项，内存有上限（扫描器产生大量不同URL时使用）
+APPROX_TOP_K = 10000  # 近似模式下每个时间窗口统计的计数器保留的高频项数（表中最多暂存2倍）
+APPROX_BUCKET_TOP_K = 1000  # 近似模式下每个时间桶的计数器保留的高频项数（表中最多暂存2倍）
+APPROX_HISTORY_DAYS = 90  # 近似模式下只保留最近N天的时间桶（需大于ROLLUP_HOURLY_DAYS），更早的天桶丢弃，历史窗口只覆盖这N天
+# 近似模式的内存上限：时间桶起点最多 (ROLLUP_HOURLY_DAYS+1)×24 个小时桶 + APPROX_HISTORY_DAYS−ROLLUP_HOURLY_DAYS 个天桶
+# （默认768+59=827个），每个文件各自分桶，同一时段跨k个文件时乘以k（按天轮转的日志k通常为1~2）；
+# 每个桶的IP和URL计数器合计最多 2×2×APPROX_BUCKET_TOP_K 个键（默认全部约330万×k个），另各有最多一个
+# APPROX_SKETCH_DEPTH×APPROX_SKETCH_WIDTH×8字节的草图（默认64KB，全部约106MB×k）；合并天桶时IP地理信息只保留计数器中仍存在的IP
+APPROX_SKETCH_WIDTH = 2048  # 被淘汰项的Count-Min草图宽度，越宽误差越小
+APPROX_SKETCH_DEPTH = 4  # Count-Min草图行数，越多越不容易高估
+FLEET_ROLE = None  # 多节点部署角色：None为单机；"agent"解析本机日志并把增量汇总推送到COLLECTOR_URL；"collector"合并各agent的汇总
+COLLECTOR_URL = "http://127.0.0.1:5000/fleet/push"  # agent推送汇总的地址
+FLEET_TOKEN = ""  # agent与collector共享的令牌（Authorization: Bearer），collector模式必须设置，为空时拒绝启动
+AGENT_ID = socket.gethostname()  # agent在collector中的名称，每个节点须不同
+AGENT_PUSH_INTERVAL = 60  # agent每隔多少秒解析新增日志并推送一次
+AGENT_PUSH_TIMEOUT = 30  # 推送请求超时（秒）
+AGENT_STATE_PATH = "state/agent_state.pkl"  # agent上次推送成功的内容，重启后仍只推送增量
+AGENT_STATE = None  # agent上次推送成功的状态：序号、各时间桶的计数、已发送地理信息的IP
+FLEET_FORMAT = 1  # 推送数据格式版本
+FLEET = {}  # collector中各agent的汇总：agent名称 -> {'seq', 'summary', 'pushed', 'address', 'bytes', 'buckets'}
+FLEET_LOCK = threading.Lock()  # collector合并推送和发布统计串行执行
+FLEET_PUBLISH_INTERVAL = 5  # collector收到推送时只合并增量，最多每隔多少秒重新生成并发布一次全局统计
+FLEET_MAX_PUSH_BYTES = 256 * 1024 * 1024  # collector接受的单次推送解压后的最大字节数，超过时返回413
+FLEET_DIRTY = threading.Event()  # collector有尚未发布的推送
+DETECT_ENABLED = True  # 实时检测：持续读取日志新增的行，按滑动窗口统计每个IP的请求数，超过阈值时告警
+DETECT_RULES = [  # (规则名称, URL前缀（None表示该IP的所有请求）, 窗口秒数, 阈值)
+    ('login_bruteforce', '/users/sign_in', 60, 30),
+    ('ip_burst', None, 60, 600),
+]
+DETECT_POLL_SECONDS = 2  # 每隔多少秒读取一次日志新增的内容
+DETECT_MAX_KEYS = 100000  # 每条规则最多跟踪多少个IP的计数器，超过时淘汰最久未出现的（LRU）
+DETECT_ALERT_LIMIT = 1000  # 最多保留多少条告警
+DETECT_WEBHOOK_URL = ""  # 告警时POST JSON到此地址，为空时不发送
+DETECT_WEBHOOK_TIMEOUT = 5
+DETECT_ALERTS_PATH = "state/alerts.json"  # 多进程部署时负责检测的进程把告警写入此文件，任一worker都能查询
+DETECTOR = None  # 本进程的检测状态（由start_detector创建）
+WEBHOOK_QUEUE = queue.Queue(maxsize=1000)  # 待发送的告警，由单独的线程发送，不阻塞检测
 
 
 # 在文件开头添加
@@ -73,20 +220,49 @@ def auto_refresh():
         except Exception as e:
             print(f"自动刷新失败: {e}")
 
+def chart_series(stats):
+    """js渲染方式下各图表的数据：{图表名: {'labels': [...], 'values': [...]}}，只含Top N，嵌入页面由浏览器绘制"""
+    top_n = TOP_N
+    rankings = stats['rankings']
+    series = {}
+    ip_data = rankings['ips'][:top_n]
+    if ip_data:
+        labels, values = (list(column) for column in zip(*ip_data))
+        # 添加"其他"类别
+        other_count = stats['total'] - sum(values)
+        if other_count > 0:
+            labels.append('other')
+            values.append(other_count)
+        series['ip_pie'] = {'labels': labels, 'values': values}
+    for name, ranking in (('country_bar', 'countries'), ('url_bar', 'urls')):
+        data = rankings[ranking][:top_n]
+        if data:
+            labels, values = zip(*data)
+            series[name] = {'labels': list(labels), 'values': list(values)}
+    hour_data = sorted(stats['hour_freq'].items())
+    if hour_data:
+        series['hour_bar'] = {'labels': [f'{hour}:00' for hour, _ in hour_data],
+                              'values': [count for _, count in hour_data]}
+    return series
+
+
 def generate_charts(time_name, stats):
     charts = {}
     top_n = TOP_N
     total = stats['total']
     if total == 0:
         return charts
-
-    # 设置中文字体
-    plt.rcParams["font.family"] = ["SimHei", "Microsoft YaHei", "SimSun"]  # 仅保留Windows兼容字体
-    plt.rcParams['axes.unicode_minus'] = False  # 解决负号显示问题
+    if CHART_RENDERER == 'js':
+        # 柱状图和饼图由浏览器绘制，服务器只生成地图
+        charts['series'] = chart_series(stats)
+        load_folium()
+        generate_map(charts, stats)
+        return charts
+    load_plotting()
 
     # 1. IP访问频次饼图
     plt.figure(figsize=(10, 6))
-    ip_data = sorted(stats['ip_freq'].items(), key=lambda x: -x[1])[:top_n]
+    ip_data = stats['rankings']['ips'][:top_n]
     if len(ip_data) > 0:
         ips, counts = zip(*ip_data)
         # 添加"其他"类别
@@ -105,7 +281,7 @@ def generate_charts(time_name, stats):
 
     # 2. 国家/地区访问频次柱状图
     plt.figure(figsize=(12, 6))
-    country_data = sorted(stats['country_freq'].items(), key=lambda x: -x[1])[:top_n]
+    country_data = stats['rankings']['countries'][:top_n]
     if len(country_data) > 0:
         countries, counts = zip(*country_data)
         country_labels = [f'{country}' for country, _ in country_data]
@@ -120,6 +296,45 @@ def generate_charts(time_name, stats):
         plt.close()
 
     # 3. 生成地图
+    generate_map(charts, stats)
+
+    # 4. 访问时段分布柱状图
+    plt.figure(figsize=(12, 6))
+    hour_data = sorted(stats['hour_freq'].items(), key=lambda x: x[0])
+    if len(hour_data) > 0:
+        hours, counts = zip(*hour_data)
+        hour_labels = [f'{hour}:00' for hour in hours]
+        sns.barplot(x=hour_labels, y=list(counts))
+        # plt.title(f'{time_name} 访问时段分布')
+        plt.xlabel('hour')
+        plt.ylabel('times')
+        plt.xticks(rotation=45)  # 旋转x轴标签以避免重叠
+        buf = BytesIO()
+        plt.savefig(buf, format='png', bbox_inches='tight')
+        buf.seek(0)
+        charts['hour_bar'] = base64.b64encode(buf.getvalue()).decode('utf-8')
+        plt.close()
+
+        # 5. URL访问频次柱状图
+    plt.figure(figsize=(12, 8))
+    url_data = stats['rankings']['urls'][:top_n]
+    if len(url_data) > 0:
+        urls, counts = zip(*url_data)
+        # 截断过长的URL以便显示
+        url_labels = [url[:50] + '...' if len(url) > 50 else url for url in urls]
+        sns.barplot(x=list(counts), y=url_labels)
+        plt.xlabel('访问次数')
+        plt.ylabel('URL路径')
+        buf = BytesIO()
+        plt.savefig(buf, format='png', bbox_inches='tight')
+        buf.seek(0)
+        charts['url_bar'] = base64.b64encode(buf.getvalue()).decode('utf-8')
+        plt.close()
+    return charts
+
+
+def generate_map(charts, stats):
+    """生成访问来源地图（folium热力图+聚合标记），HTML存入charts['map']"""
     if 'geo_data' in stats and stats['geo_data']:
         # 创建基础地图 - 使用全球视角
         m = folium.Map(
@@ -143,82 +358,88 @@ def generate_charts(time_name, stats):
         #     subdomains=['1', '2', '3', '4'],  # 子域名后缀（与URL中的 "0{s}" 组合为 "01~04"）
         #     control_scale=True
         # )
-        # 准备热力图数据
-        heat_data = []
-        marker_data = []
-
-        # 收集所有IP的地理位置数据
-        for ip, locations in stats['geo_data'].items():
-            for location in locations:
-                lat = location['latitude']
-                lon = location['longitude']
-                count = location['count']
-
-                # 添加到热力图数据
-                heat_data.append([lat, lon, count])
-
-                # 添加到标记数据
-                marker_data.append({
-                    'location': [lat, lon],
-                    'ip': ip,
-                    'count': count,
-                    'country': location['country'],
-                    'region': location['region'],
-                    'city': location['city']
-                })
+        # 按访问次数取前N个位置点（部分选择，不对所有位置排序），地图大小只与位置数有关
+        if MAP_MAX_POINTS:
+            locations = heapq.nlargest(MAP_MAX_POINTS, stats['geo_data'].items(), key=lambda x: x[1]['count'])
+        else:
+            locations = sorted(stats['geo_data'].items(), key=lambda x: x[1]['count'], reverse=True)
 
         # 添加热力图层
+        heat_data = [[lat, lon, location['count']] for (lat, lon), location in locations]
         if heat_data:
             plugins.HeatMap(heat_data).add_to(m)
 
-        # 添加标记层
-        for marker in marker_data:
+        # 添加标记层，相邻的标记在缩小时聚合显示
+        cluster = plugins.MarkerCluster().add_to(m)
+        for (lat, lon), location in locations:
             folium.CircleMarker(
-                location=marker['location'],
-                radius=max(marker['count'] / 10, 5),  # 气泡大小代表访问次数
-                popup=f"IP: {marker['ip']}<br>访问次数: {marker['count']}<br>国家/地区: {marker['country']}<br>地区: {marker['region']}<br>城市: {marker['city']}",
+                location=[lat, lon],
+                radius=max(location['count'] / 10, 5),  # 气泡大小代表访问次数
+                popup=f"IP数: {location['ip_count']}<br>访问次数: {location['count']}<br>最多访问IP: {location['top_ip']}（{location['top_count']}次）<br>国家/地区: {location['country']}<br>地区: {location['region']}<br>城市: {location['city']}",
                 color='red',
                 fill=True,
                 fillColor='red',
                 fillOpacity=0.6
-            ).add_to(m)
+            ).add_to(cluster)
 
         # 保存地图到HTML字符串
         charts['map'] = m._repr_html_()
 
-    # 4. 访问时段分布柱状图
-    plt.figure(figsize=(12, 6))
-    hour_data = sorted(stats['hour_freq'].items(), key=lambda x: x[0])
-    if len(hour_data) > 0:
-        hours, counts = zip(*hour_data)
-        hour_labels = [f'{hour}:00' for hour in hours]
-        sns.barplot(x=hour_labels, y=list(counts))
-        # plt.title(f'{time_name} 访问时段分布')
-        plt.xlabel('hour')
-        plt.ylabel('times')
-        plt.xticks(rotation=45)  # 旋转x轴标签以避免重叠
-        buf = BytesIO()
-        plt.savefig(buf, format='png', bbox_inches='tight')
-        buf.seek(0)
-        charts['hour_bar'] = base64.b64encode(buf.getvalue()).decode('utf-8')
-        plt.close()
 
-        # 5. URL访问频次柱状图
-    plt.figure(figsize=(12, 8))
-    url_data = sorted(stats['url_freq'].items(), key=lambda x: -x[1])[:top_n]
-    if len(url_data) > 0:
-        urls, counts = zip(*url_data)
-        # 截断过长的URL以便显示
-        url_labels = [url[:50] + '...' if len(url) > 50 else url for url in urls]
-        sns.barplot(x=list(counts), y=url_labels)
-        plt.xlabel('访问次数')
-        plt.ylabel('URL路径')
-        buf = BytesIO()
-        plt.savefig(buf, format='png', bbox_inches='tight')
-        buf.seek(0)
-        charts['url_bar'] = base64.b64encode(buf.getvalue()).decode('utf-8')
-        plt.close()
+def get_charts(time_name, stats, generation):
+    """返回缓存的图表；未缓存时渲染并缓存，同一份图表只渲染一次"""
+    key = (time_name, generation)
+    charts = cached_charts(key)
+    if charts is not None:
+        CHART_METRICS['hits'] += 1
+        return charts
+    with CHART_RENDER_LOCK:
+        charts = cached_charts(key)
+        if charts is None:
+            CHART_METRICS['misses'] += 1
+            started = time.perf_counter()
+            charts = generate_charts(time_name, stats)
+            CHART_METRICS['renders'] += 1
+            CHART_METRICS['render_seconds'] += time.perf_counter() - started
+            with CHART_CACHE_LOCK:
+                if generation == STATS_GENERATION:
+                    CHART_CACHE[key] = charts
+                    while len(CHART_CACHE) > CHART_CACHE_LIMIT:
+                        CHART_CACHE.popitem(last=False)
+        else:
+            CHART_METRICS['hits'] += 1  # 等待期间已由其他请求渲染完成
     return charts
+
+
+def cached_charts(key):
+    """取缓存的图表，命中时移到LRU末尾（最近使用），超出上限时先淘汰最久未使用的"""
+    with CHART_CACHE_LOCK:
+        charts = CHART_CACHE.get(key)
+        if charts is not None:
+            CHART_CACHE.move_to_end(key)
+        return charts
+
+
+def evict_stale_charts(generation):
+    """清除旧代数据的图表和自定义时间范围统计"""
+    with CHART_CACHE_LOCK:
+        for key in [key for key in CHART_CACHE if key[1] != generation]:
+            del CHART_CACHE[key]
+        for key in [key for key in RANGE_STATS_CACHE if key[2] != generation]:
+            del RANGE_STATS_CACHE[key]
+        for key in [key for key in FULL_RANKING_CACHE if key[0] != generation]:
+            del FULL_RANKING_CACHE[key]
+
+
+def prerender_charts(generation, time_stats):
+    """后台依次渲染各固定时间窗口的图表，页面请求直接取用渲染好的结果"""
+    for time_name, stats in time_stats.items():
+        if generation != STATS_GENERATION:
+            return  # 已有更新的统计数据，放弃渲染旧数据
+        try:
+            get_charts(time_name, stats, generation)
+        except Exception as e:
+            print(f"预渲染图表出错: {time_name}，{str(e)}")
 # ========================
 # 1. 工具函数：IP和时间处理
 # ========================
@@ -230,144 +451,1264 @@ def ip_to_int(ip_str):
         return None
 
 
-def parse_log_time(log_line):
-    """从日志行提取时间戳（适配格式：2025/09/03 01:16:09）"""
-    # 正则匹配：2025/09/03 01:16:09
-    time_pattern = re.compile(r'^(\d{4}/\d{2}/\d{2}\s+\d{2}:\d{2}:\d{2})')
-    match = time_pattern.search(log_line)
-    if not match:
-        return None  # 未找到时间戳
-    time_str = match.group(1)
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'  # ::ffff:a.b.c.d
+
+
+def split_ip_families(ip_strs):
+    """按地址族拆分IP字符串，无效IP丢弃；IPv4映射的IPv6地址（::ffff:a.b.c.d）按IPv4查询
+
+    返回 (IPv4字符串列表, IPv4整数数组, IPv6字符串列表, IPv6高64位数组, IPv6低64位数组)
+    """
+    v4_strs, v4_ints, v6_strs, v6_packed = [], [], [], []
+    for ip_str in ip_strs:
+        if ':' not in ip_str:
+            ip_int = ip_to_int(ip_str)
+            if ip_int is not None:
+                v4_strs.append(ip_str)
+                v4_ints.append(ip_int)
+            continue
+        try:
+            packed = socket.inet_pton(socket.AF_INET6, ip_str)
+        except (OSError, ValueError):
+            continue
+        if packed[:12] == IPV4_MAPPED_PREFIX:
+            v4_strs.append(ip_str)
+            v4_ints.append(int.from_bytes(packed[12:], 'big'))
+        else:
+            v6_strs.append(ip_str)
+            v6_packed.append(packed)
+    # 16字节地址整体按大端拆成两个64位整数，一次转换完成
+    halves = np.frombuffer(b''.join(v6_packed), dtype='>u8').reshape(-1, 2).astype(np.uint64)
+    return v4_strs, np.array(v4_ints, dtype=np.uint32), v6_strs, halves[:, 0], halves[:, 1]
+
+
+LOG_FILE_PATTERN = re.compile(r'\.(log|gz|log\.\d+)$')  # 当前日志、压缩归档及未压缩的轮转文件
+# nginx错误日志：单条正则一次提取时间（分钟前缀、秒）、客户端IP（IPv4或IPv6）、请求URL，IP和URL可缺失。
+# 对整块未解码的数据用findall一次取出所有行的字段：每行从换行符开始匹配，正则以字面字符开头，可快速定位行首；
+# [^,\n]和[^ \n]都不跨行，结果与逐行匹配相同。
+# client取行内第一个", client: IP, server: "（nginx固定的字段顺序），request取其后第一个", request: "，
+# 请求URL和referrer中伪造的"client: "不会被当作客户端IP，也不会让URL丢失。
+# 按逗号逐段向后查找（每段用字符类一次跳过），比逐字的非贪婪匹配快得多
+LINE_PATTERN_BYTES = re.compile(
+    rb'\n(\d{4}/\d{2}/\d{2} \d{2}:\d{2}):(\d{2})'
+    rb'(?:[^,\n]*(?:,(?! client: )[^,\n]*)*, client: (\d+\.\d+\.\d+\.\d+|[0-9A-Fa-f]*:[0-9A-Fa-f:.]+), server: )?'
+    rb'(?:[^,\n]*(?:,(?! request: ")[^,\n]*)*, request: "(?:GET|POST|PUT|DELETE|HEAD|OPTIONS|PATCH) ([^ \n]+))?'
+)
+# 访问日志（combined格式：IP - 用户 [03/Sep/2025:01:16:09 +0800] "GET /path HTTP/1.1" 状态码 ...）。
+# 时间在IP之后，用前瞻先取出时间，捕获顺序与错误日志相同，解析循环不必为每行调整字段顺序；时区偏移忽略（按本地时间）。
+# 按字段结构从行首匹配（地址、ident、用户名各为一个不含空格的字段，之后才是时间和请求），
+# 用户名等客户端可控的字段中即使带有"["也不会被当作时间；字段结构不符的行整行跳过
+ACCESS_PATTERN_BYTES = re.compile(
+    rb'\n(?=\S+ \S+ \S+ \[(\d\d/\w\w\w/\d{4}:\d\d:\d\d):(\d\d)[^\]\n]*\] ")'
+    rb'(?:(\d+\.\d+\.\d+\.\d+|[0-9A-Fa-f]*:[0-9A-Fa-f:.]+) |\S+ )\S+ \S+ \[[^\]\n]*\] "(?:[A-Z]+ ([^ "\n]+))?'
+)
+# GitLab的JSON日志（production_json.log的path、workhorse的uri）。键的先后不固定，三个字段都用前瞻在行内查找；
+# 前瞻用贪婪匹配从行尾回溯，比逐字向后查找快（顶层键每行只出现一次，结果相同）
+JSON_PATTERN_BYTES = re.compile(
+    rb'\n(?=[^\n]*"time":"(\d{4}-\d\d-\d\dT\d\d:\d\d):(\d\d))'
+    rb'(?=[^\n]*"remote_ip":"(\d+\.\d+\.\d+\.\d+|[0-9A-Fa-f]*:[0-9A-Fa-f:.]+)")?'
+    rb'(?=[^\n]*"(?:path|uri)":"([^"\n]+))?'
+)
+MONTHS = {name.encode('ascii'): number for number, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+MINUTE_CACHE = {}  # 分钟前缀 -> (该分钟起始秒数, 小时)，无效时间为False
+MINUTE_CACHE_LIMIT = 100000
+EPOCH = datetime.datetime(1970, 1, 1)  # 日志时间按本地时间直接换算为秒数（UTC记录的JSON日志先换算为本地时间）
+
+
+def parse_minute(minute_prefix):
+    """按固定偏移切片解析分钟前缀（2025/09/03 01:16），返回(该分钟起始秒数, 小时)，结果按前缀缓存"""
+    minute = MINUTE_CACHE.get(minute_prefix)
+    if minute is not None:
+        return minute
     try:
-        # 解析为datetime对象（格式：年/月/日 时:分:秒）
-        return datetime.datetime.strptime(time_str, "%Y/%m/%d %H:%M:%S")
+        log_minute = datetime.datetime(int(minute_prefix[0:4]), int(minute_prefix[5:7]), int(minute_prefix[8:10]),
+                                       int(minute_prefix[11:13]), int(minute_prefix[14:16]))
     except ValueError as e:
-        print(f"时间解析失败：{time_str}，错误：{e}")
-        return None
+        print(f"时间解析失败：{minute_prefix}，错误：{e}")
+        log_minute = None
+    return cache_minute(minute_prefix, log_minute)
+
+
+def parse_json_minute(minute_prefix):
+    """解析JSON日志的分钟前缀（2025-09-03T01:16，切片偏移与parse_minute相同）
 
+    GitLab的JSON日志按UTC记录（时间以Z结尾），换算为本地时间，与错误日志、访问日志的同一时刻落在同一个时间桶；
+    换算按分钟前缀缓存，半小时时差的时区同样正确
+    """
+    minute = MINUTE_CACHE.get(minute_prefix)
+    if minute is not None:
+        return minute
+    try:
+        log_minute = datetime.datetime(int(minute_prefix[0:4]), int(minute_prefix[5:7]), int(minute_prefix[8:10]),
+                                       int(minute_prefix[11:13]), int(minute_prefix[14:16]),
+                                       tzinfo=datetime.timezone.utc).astimezone().replace(tzinfo=None)
+    except ValueError as e:
+        print(f"时间解析失败：{minute_prefix}，错误：{e}")
+        log_minute = None
+    return cache_minute(minute_prefix, log_minute)
 
-def is_in_time_range(log_time, days):
-    """判断日志时间是否在最近N天内"""
-    if not log_time:
-        return False
-    delta = datetime.datetime.now() - log_time
-    return delta.days < days
+
+def parse_clf_minute(minute_prefix):
+    """解析访问日志的分钟前缀（03/Sep/2025:01:16），返回值和缓存方式与parse_minute相同"""
+    minute = MINUTE_CACHE.get(minute_prefix)
+    if minute is not None:
+        return minute
+    try:
+        log_minute = datetime.datetime(int(minute_prefix[7:11]), MONTHS[minute_prefix[3:6]], int(minute_prefix[0:2]),
+                                       int(minute_prefix[12:14]), int(minute_prefix[15:17]))
+    except (KeyError, ValueError) as e:
+        print(f"时间解析失败：{minute_prefix}，错误：{e}")
+        log_minute = None
+    return cache_minute(minute_prefix, log_minute)
+
+
+def cache_minute(minute_prefix, log_minute):
+    minute = ((log_minute - EPOCH) // datetime.timedelta(seconds=1), log_minute.hour) if log_minute else False
+    if len(MINUTE_CACHE) >= MINUTE_CACHE_LIMIT:
+        MINUTE_CACHE.clear()
+    MINUTE_CACHE[minute_prefix] = minute
+    return minute
+
+
+LOG_FORMATS = {}  # 日志格式名称 -> {'name', 'pattern', 'minute'}，由register_log_format注册
+
+
+def register_log_format(name, pattern, minute):
+    """注册一种日志格式，解析、统计、增量读取和实时检测各环节共用
+
+    pattern: 字节正则，每行从换行符开始匹配，依次捕获分钟前缀、秒、客户端IP、URL（IP和URL可缺失）；
+    minute: 把分钟前缀解析为(该分钟起始秒数, 小时)的函数，无效时间返回False，结果须存入MINUTE_CACHE。
+    多进程解析时工作进程须能导入同样的注册（在模块中注册，不要只在运行时注册）
+    """
+    if pattern.groups != 4:
+        raise ValueError(f"日志格式 {name} 的正则须有4个捕获组，实际为{pattern.groups}个")
+    LOG_FORMATS[name] = {'name': name, 'pattern': pattern, 'minute': minute}
+
+
+register_log_format('nginx_error', LINE_PATTERN_BYTES, parse_minute)
+register_log_format('combined', ACCESS_PATTERN_BYTES, parse_clf_minute)
+register_log_format('gitlab_json', JSON_PATTERN_BYTES, parse_json_minute)
+
+
+def log_format_for(file_path):
+    """按文件名前缀找到日志文件的格式（前缀较长的来源优先）"""
+    filename = os.path.basename(file_path)
+    for prefix, format_name, _ in sorted(LOG_SOURCES, key=lambda source: -len(source[0])):
+        if filename.startswith(prefix):
+            return LOG_FORMATS[format_name]
+    return LOG_FORMATS['nginx_error']
 
 
 # ========================
-# 2. 加载二进制索引（复用之前的高效加载逻辑）
+# 2. 加载二进制索引（mmap映射，整个进程只加载一次）
 # ========================
+class GeoLines:
+    """按行号访问mmap映射的地名文本，只在取用时解码对应行，不为每行创建字符串对象"""
+
+    def __init__(self, buf):
+        self._buf = buf
+        newlines = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == ord('\n'))
+        ends = newlines + 1
+        if len(buf) and (not len(ends) or ends[-1] != len(buf)):
+            ends = np.append(ends, len(buf))  # 最后一行没有换行符
+        self._ends = ends
+        self._starts = np.concatenate(([0], ends[:-1])) if len(ends) else ends
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, line_no):
+        return self._buf[int(self._starts[line_no]):int(self._ends[line_no])].decode('utf-8', errors='ignore')
+
+
+def geo_index_version():
+    """地理库版本（索引和地名文件的大小+修改时间），地理库更新后旧的汇总全部作废"""
+    parts = []
+    for path in (BIN_INDEX_PATH, GEO_TEXT_PATH):
+        st = os.stat(path)
+        parts.append(f"{st.st_size}:{st.st_mtime_ns}")
+    return '|'.join(parts)
+
+
+def map_file(path):
+    """只读映射整个文件，空文件返回空bytes（mmap不支持长度为0的映射）"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_bin_index(path, v4_ranges, v6_ranges=()):
+    """写入第2版索引文件（供地理库转换工具使用），先写临时文件再改名替换
+
+    v4_ranges: [(起始IP, 结束IP, 地名行号)]，IP为整数；v6_ranges同样格式，IP为128位整数。
+    文件结构（小端）：文件头，IPv4段（起始IP、结束IP、行号三列uint32），按8字节对齐后
+    IPv6段（起始高64位、起始低64位、结束高64位、结束低64位四列uint64，行号一列uint32），各段按起始IP排序
+    """
+    v4 = np.array(sorted(v4_ranges), dtype=np.uint32).reshape(-1, 3)
+    v6 = sorted(v6_ranges)
+    low_mask = (1 << 64) - 1
+    v6_columns = [
+        np.array([start >> 64 for start, _, _ in v6], dtype='<u8'),
+        np.array([start & low_mask for start, _, _ in v6], dtype='<u8'),
+        np.array([end >> 64 for _, end, _ in v6], dtype='<u8'),
+        np.array([end & low_mask for _, end, _ in v6], dtype='<u8'),
+        np.array([offset for _, _, offset in v6], dtype='<u4')
+    ]
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(BIN_INDEX_HEADER.pack(BIN_INDEX_MAGIC, len(v4), len(v6)))
+        for column in v4.T:
+            f.write(column.astype('<u4').tobytes())
+        f.write(b'\x00' * (-f.tell() % 8))
+        for column in v6_columns:
+            f.write(column.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_v1_index(bin_data):
+    """第1版索引：无文件头，每条记录12字节（起始IP、结束IP、地名行号，均为大端uint32），只含IPv4"""
+    records = np.frombuffer(bin_data, dtype='>u4', count=len(bin_data) // 12 * 3).reshape(-1, 3)
+    # searchsorted需要连续的本机字节序数组，起始IP单独转换一份，其余两列保持映射视图
+    starts = records[:, 0].astype(np.uint32)
+    if len(starts) > 1 and np.any(starts[1:] < starts[:-1]):
+        # 索引文件未按起始IP排序时才排序（会复制整个索引）
+        order = np.argsort(starts, kind='stable')
+        records = records[order]
+        starts = starts[order]
+    empty = np.zeros(0, dtype=np.uint64)
+    return {'v4': (starts, records[:, 1], records[:, 2]),
+            'v6': (empty, empty, empty, empty, np.zeros(0, dtype=np.uint32))}
+
+
+def read_v2_index(bin_data):
+    """第2版索引：各列直接作为映射视图使用（小端机器上无需复制），写入时已排序"""
+    magic, v4_count, v6_count = BIN_INDEX_HEADER.unpack_from(bin_data)
+    position = BIN_INDEX_HEADER.size
+    columns = []
+    for dtype, count in [('<u4', v4_count)] * 3 + [('<u8', v6_count)] * 4 + [('<u4', v6_count)]:
+        if dtype == '<u8':
+            position += -position % 8
+        size = np.dtype(dtype).itemsize * count
+        if position + size > len(bin_data):
+            raise ValueError("索引文件不完整")
+        columns.append(np.frombuffer(bin_data, dtype=dtype, count=count, offset=position))
+        position += size
+    v4_starts, v6_start_hi, v6_start_lo = columns[0], columns[3], columns[4]
+    if np.any(v4_starts[1:] < v4_starts[:-1]) or np.any(
+            (v6_start_hi[1:] < v6_start_hi[:-1])
+            | ((v6_start_hi[1:] == v6_start_hi[:-1]) & (v6_start_lo[1:] < v6_start_lo[:-1]))):
+        raise ValueError("索引文件未按起始IP排序")
+    return {'v4': tuple(columns[:3]), 'v6': tuple(columns[3:])}
+
+
 def load_bin_index():
-    """加载二进制索引和地名文本"""
-    with open(GEO_TEXT_PATH, 'r', encoding='utf-8') as f:
-        geo_lines = f.readlines()
-    with open(BIN_INDEX_PATH, 'rb') as f:
-        bin_data = f.read()
-    ip_segments = []
-    for i in range(0, len(bin_data), 12):
-        start_ip = struct.unpack(">I", bin_data[i:i + 4])[0]
-        end_ip = struct.unpack(">I", bin_data[i + 4:i + 8])[0]
-        geo_offset = struct.unpack(">I", bin_data[i + 8:i + 12])[0]
-        ip_segments.append((start_ip, end_ip, geo_offset))
-    ip_segments.sort(key=lambda x: x[0])
-    return ip_segments, geo_lines
+    """加载二进制索引和地名文本
+
+    两个文件都用mmap映射，索引记录直接以数组视图访问，不逐条创建Python对象。
+    加载结果缓存在进程内，只有文件大小或修改时间变化时才重新映射。
+    更新地理库时应先写临时文件再改名替换，不要原地覆盖正在映射的文件。
+    """
+    global GEO_INDEX
+    version = geo_index_version()
+    if GEO_INDEX is not None and GEO_INDEX['version'] == version:
+        return GEO_INDEX['ip_index'], GEO_INDEX['geo_lines']
+
+    geo_lines = GeoLines(map_file(GEO_TEXT_PATH))
+    bin_data = map_file(BIN_INDEX_PATH)
+    # ip_index：{'v4': (起始IP, 结束IP, 地名行号), 'v6': (起始高64位, 起始低64位, 结束高64位, 结束低64位, 地名行号)}
+    if bin_data[:len(BIN_INDEX_MAGIC)] == BIN_INDEX_MAGIC:
+        ip_index = read_v2_index(bin_data)
+    else:
+        ip_index = read_v1_index(bin_data)
+    GEO_INDEX = {'version': version, 'ip_index': ip_index, 'geo_lines': geo_lines}
+    print(f"地理库已加载：{len(ip_index['v4'][0])} 个IPv4段，{len(ip_index['v6'][0])} 个IPv6段，{len(geo_lines)} 个地点")
+    return ip_index, geo_lines
 
 
 # ========================
 # 3. 处理单个日志文件（支持.gz和.log）
 # ========================
-def process_log_file(file_path, time_days, ip_segments, geo_lines, stats):
-    """处理单个日志文件，按时间粒度统计IP和地理信息"""
-    # 打开文件（根据后缀判断是否解压）
-    open_func = gzip.open if file_path.endswith('.gz') else open
-    ip_pattern = re.compile(r'client:\s*(\d+\.\d+\.\d+\.\d+)')  # 提取客户端IP
-    url_pattern = re.compile(r'request: "(GET|POST|PUT|DELETE|HEAD|OPTIONS|PATCH) ([^ ]+)')  # 添加URL提取正则
-
-    with open_func(file_path, 'rt', encoding='utf-8', errors='ignore') as f:
-        for line_num, line in enumerate(f, 1):
-            # 1. 提取时间戳并过滤时间范围
-            log_time = parse_log_time(line)
-            if not is_in_time_range(log_time, time_days):
-                continue  # 不在目标时间范围内，跳过
-
-            # 添加时段统计
-            if log_time:
-                hour = log_time.hour
-                stats['hour_freq'][hour] += 1
-
-            # 2. 提取URL
-            url_match = url_pattern.search(line)
-            if url_match:
-                url = url_match.group(2)
-                stats['url_freq'][url] += 1
-
-            # 3. 提取客户端IP
-            ip_match = ip_pattern.search(line)
-            if not ip_match:
-                continue
-            ip_str = ip_match.group(1)
-            ip_int = ip_to_int(ip_str)
-            if not ip_int:
+FREQ_KEYS = ('ip_freq', 'country_freq', 'region_freq', 'city_freq', 'hour_freq', 'url_freq')
+APPROX_KEYS = ('ip_freq', 'url_freq')  # 近似模式下使用TopKCounter的计数器（基数可能无限增长）
+
+
+class TopKCounter(dict):
+    """近似计数器（Space-Saving）：键数超过2倍capacity时只保留计数最高的capacity个
+
+    被淘汰的计数累加到Count-Min草图；淘汰后再次出现的键从 min(草图估计, error) 起算。
+    error为淘汰过的最大计数：不在表中的键真实计数不超过error，表中计数与真实值相差不超过error
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.capacity = APPROX_TOP_K
+        self.error = 0
+        self.sketch = None  # 首次淘汰时才分配，大部分小时桶用不到
+
+    def __missing__(self, key):
+        if len(self) >= 2 * self.capacity:
+            self.prune()
+        if self.sketch is None:
+            return self.error
+        rows, cols = sketch_cells([key], self.sketch.shape[1])
+        return min(int(self.sketch[rows, cols].min()), self.error)
+
+    def prune(self):
+        """只保留计数最高的capacity个键，其余计入草图"""
+        kept = top_items(self, self.capacity)
+        if len(kept) == len(self):
+            return
+        kept_keys = {key for key, _ in kept}
+        evicted = [(key, count) for key, count in self.items() if key not in kept_keys]
+        self.clear()
+        self.update(kept)
+        self.error = max(self.error, max(count for _, count in evicted))
+        if self.sketch is None:
+            self.sketch = np.zeros((APPROX_SKETCH_DEPTH, APPROX_SKETCH_WIDTH), dtype=np.int64)
+        keys, counts = zip(*evicted)
+        rows, cols = sketch_cells(keys, self.sketch.shape[1])
+        np.add.at(self.sketch, (rows, cols), np.repeat(np.array(counts, dtype=np.int64), self.sketch.shape[0]))
+
+    def merge(self, other):
+        """累加另一个计数器（TopKCounter或普通dict），两边的误差上限相加"""
+        for key, count in other.items():
+            self[key] += count
+        self.error += getattr(other, 'error', 0)
+        sketch = getattr(other, 'sketch', None)
+        if sketch is not None:
+            if self.sketch is None:
+                self.sketch = sketch.copy()
+            else:
+                self.sketch += sketch
+        if len(self) > 2 * self.capacity:
+            self.prune()
+
+    def copy(self):
+        copied = TopKCounter(self)
+        copied.capacity = self.capacity
+        copied.error = self.error
+        copied.sketch = None if self.sketch is None else self.sketch.copy()
+        return copied
+
+
+def sketch_cells(keys, width):
+    """计算各键在Count-Min草图每一行中的位置，返回可直接用于numpy索引的(行号, 列号)
+
+    用blake2b而不是内置hash：结果跨进程稳定，工作进程和持久化的草图可以直接相加
+    """
+    depth = APPROX_SKETCH_DEPTH
+    digests = b''.join(hashlib.blake2b(str(key).encode('utf-8', 'surrogatepass'), digest_size=4 * depth).digest()
+                       for key in keys)
+    cols = (np.frombuffer(digests, dtype='<u4') % width).astype(np.intp)
+    rows = np.tile(np.arange(depth), len(keys))
+    return rows, cols
+
+
+def counting_mode():
+    """当前计数模式，写入检查点和归档缓存；模式或参数变化后旧汇总作废"""
+    if not APPROX_COUNTING:
+        return (SUMMARY_VERSION, 'exact')
+    return (SUMMARY_VERSION, 'approx', APPROX_TOP_K, APPROX_BUCKET_TOP_K, APPROX_HISTORY_DAYS,
+            APPROX_SKETCH_WIDTH, APPROX_SKETCH_DEPTH)
+
+
+def new_stats():
+    """创建单个时间窗口的空统计结构"""
+    stats = new_bucket(APPROX_TOP_K)
+    stats['geo_data'] = {}  # (纬度, 经度) -> 该位置的访问汇总
+    return stats
+
+
+def new_bucket(capacity=None):
+    """创建单个时间桶的空计数器；近似模式下IP/URL计数器保留capacity个高频项（默认APPROX_BUCKET_TOP_K）"""
+    bucket = {'total': 0}
+    for key in FREQ_KEYS:
+        if APPROX_COUNTING and key in APPROX_KEYS:
+            bucket[key] = TopKCounter()
+            bucket[key].capacity = capacity or APPROX_BUCKET_TOP_K
+        else:
+            bucket[key] = defaultdict(int)
+    return bucket
+
+
+def new_summary():
+    """创建单个日志文件的汇总：按小时分桶的计数器 + IP地理信息
+
+    汇总一旦发布（被ROLLUP_STORE引用）就不再原地修改，新增数据通过extend_summary生成新对象
+    """
+    return {
+        'buckets': {},  # 小时桶起始秒数 -> 计数器
+        'daily': {},  # 天桶起始秒数 -> 计数器（较早的小时桶合并而来）
+        'geo': {}  # IP -> (国家, 地区, 城市, 纬度, 经度)
+    }
+
+
+def compute_window_cutoffs(now=None):
+    """计算每个时间粒度的起始时间（每次刷新只计算一次），早于起始时间的记录不计入该窗口"""
+    if now is None:
+        now = datetime.datetime.now()
+    return OrderedDict(
+        (time_name, now - datetime.timedelta(days=days)) for time_name, days in TIME_GRANS.items()
+    )
+
+
+def lookup_v4(section, ip_ints):
+    """找到起始IP不大于目标IP的最后一个IP段，再检查是否在段内；返回 (是否命中, IP段下标)"""
+    starts, ends, _ = section
+    idx = np.searchsorted(starts, ip_ints, side='right') - 1
+    found = idx >= 0
+    found[found] = ip_ints[found] <= ends[idx[found]]
+    return found, idx
+
+
+def lookup_v6(section, his, los):
+    """128位地址按(高64位, 低64位)比较，返回 (是否命中, IP段下标)
+
+    先按高64位searchsorted；高64位与某些IP段起点相同的查询，再在这些IP段内按低64位向量化二分，
+    大多数IPv6段起点的高64位各不相同，因此通常只需一次searchsorted
+    """
+    start_hi, start_lo, end_hi, end_lo, _ = section
+    upper = np.searchsorted(start_hi, his, side='right')
+    lower = np.searchsorted(start_hi, his, side='left')
+    tied = np.flatnonzero(upper > lower)
+    if len(tied):
+        lo, hi, targets = lower[tied], upper[tied], los[tied]
+        active = lo < hi
+        while active.any():
+            mid = (lo + hi) // 2
+            go_right = np.zeros(len(tied), dtype=bool)
+            go_right[active] = start_lo[mid[active]] <= targets[active]
+            lo = np.where(active & go_right, mid + 1, lo)
+            hi = np.where(active & ~go_right, mid, hi)
+            active = lo < hi
+        upper[tied] = lo
+    idx = upper - 1
+    found = idx >= 0
+    hit, hit_his, hit_los = idx[found], his[found], los[found]
+    found[found] = (hit_his < end_hi[hit]) | ((hit_his == end_hi[hit]) & (hit_los <= end_lo[hit]))
+    return found, idx
+
+
+def process_chunk(data, end, summary, ip_hits, log_format=None):
+    """解析data[0:end]中的完整行并计入所属小时桶，data以换行符开头，end处为换行符或数据末尾
+
+    直接在未解码的整块数据上用findall取出各行字段，只解码URL和IP，不再为每行创建解码后的字符串；
+    log_format为LOG_FORMATS中的格式（默认nginx错误日志），各格式取出的字段相同，后续统计完全一样；
+    返回解析的行数
+    """
+    if log_format is None:
+        log_format = LOG_FORMATS['nginx_error']
+    parse_format_minute = log_format['minute']
+    buckets = summary['buckets']
+    whole_minutes = BUCKET_SECONDS % 60 == 0  # 桶按整分钟划分时，同一分钟的行都在同一个桶，不必逐行计算
+    current_minute = minute_start = hour = start = None
+    bucket_start = hour_freq = url_freq = bucket_ips = None
+    for minute_prefix, second, ip_bytes, url in log_format['pattern'].findall(data, 0, end):
+        if minute_prefix != current_minute:
+            minute = MINUTE_CACHE.get(minute_prefix)
+            if minute is None:
+                minute = parse_format_minute(minute_prefix)
+            if not minute:
                 continue
+            current_minute = minute_prefix
+            minute_start, hour = minute
+            start = minute_start - minute_start % BUCKET_SECONDS
+        if second > b'61':
+            continue
+        if not whole_minutes:
+            seconds = minute_start + int(second)
+            start = seconds - seconds % BUCKET_SECONDS
+        if start != bucket_start:
+            bucket = buckets.get(start)
+            if bucket is None:
+                bucket = buckets[start] = new_bucket()
+            bucket_start = start
+            hour_freq = bucket['hour_freq']
+            url_freq = bucket['url_freq']
+            bucket_ips = ip_hits.get(start)
+            if bucket_ips is None:
+                bucket_ips = ip_hits[start] = defaultdict(int)
+        hour_freq[hour] += 1
+        if url:
+            # 与文本模式一样忽略无效的UTF-8字节
+            url = url.decode('utf-8', 'ignore')
+            if url:
+                url_freq[url] += 1
+        if ip_bytes:
+            bucket_ips[ip_bytes.decode('ascii')] += 1
+    return data.count(b'\n', 0, end)
+
+
+def process_buffer(carry, chunk, summary, ip_hits, log_format=None):
+    """把新读到的数据接在上次剩下的不完整行（以换行符开头）之后，解析其中的完整行，返回新的不完整行
+
+    最后一个换行符之后的内容留到下次；文件结束时用空chunk调用并传入非空的carry即可解析最后一行
+    """
+    data = carry + chunk
+    end = data.rfind(b'\n') if chunk else len(data)
+    TIMINGS['lines'] += process_chunk(data, end, summary, ip_hits, log_format)
+    return data[end:]
+
+
+def resolve_ips(ip_strs, ip_index, geo_lines):
+    """批量查询IP地理信息：所有不重复的IP按地址族一次性用np.searchsorted定位所在IP段
+
+    返回 {IP: (国家, 地区, 城市, 纬度, 经度)}；命中IP段但地名格式不正确时为False，未命中的IP不在结果中
+    """
+    v4_strs, v4_ints, v6_strs, v6_his, v6_los = split_ip_families(ip_strs)
+    resolved = {}
+    geo_cache = {}  # 地名行号 -> 解析结果，同一地点只解析一次
+    lookups = []
+    if v4_strs:
+        lookups.append((v4_strs, ip_index['v4'], lookup_v4(ip_index['v4'], v4_ints)))
+    if v6_strs:
+        lookups.append((v6_strs, ip_index['v6'], lookup_v6(ip_index['v6'], v6_his, v6_los)))
+    for family_strs, section, (found, idx) in lookups:
+        offsets = section[-1]
+        for ip_str, geo_offset in zip(np.array(family_strs, dtype=object)[found], offsets[idx[found]].tolist()):
+            geo = geo_cache.get(geo_offset)
+            if geo is None:
+                # 解析地名信息（格式：国家|地区|城市|纬度|经度）
+                parts = geo_lines[geo_offset].strip().split('|')
+                if len(parts) == 5:
+                    country, region, city, latitude, longitude = parts
+                    geo = (country, region, city, float(latitude), float(longitude))
+                else:
+                    geo = False
+                geo_cache[geo_offset] = geo
+            resolved[ip_str] = geo
+    return resolved
+
 
-            # 4. 二分查找地理信息
-            left, right = 0, len(ip_segments) - 1
-            while left <= right:
-                mid = (left + right) // 2
-                start_ip, end_ip, geo_offset = ip_segments[mid]
-                if start_ip <= ip_int <= end_ip:
-                    # 解析地名信息（格式：国家|地区|城市|纬度|经度）
-                    geo_text = geo_lines[geo_offset]
-                    parts = geo_text.strip().split('|')
-                    if len(parts) == 5:
-                        country, region, city, latitude, longitude = parts
-                        # 更新统计数据（stats是按时间粒度区分的字典）
-                        stats['ip_freq'][ip_str] += 1
-                        stats['country_freq'][country] += 1
-                        # 使用元组作为键，以匹配模板中的解包方式
-                        stats['region_freq'][(region, region)] += 1  # 这里使用(region, region)是因为没有中英文区分
-                        stats['city_freq'][(city, city)] += 1  # 这里使用(city, city)是因为没有中英文区分
-                        # 添加地理位置信息到统计数据
-                        if 'geo_data' not in stats:
-                            stats['geo_data'] = defaultdict(list)
-                        print(f"IP: {ip_str}, 纬度: {latitude}, 经度: {longitude}, 国家/地区: {country}")
-
-                        stats['geo_data'][ip_str].append({
-                            'count': stats['ip_freq'][ip_str],
-                            'country': country,
-                            'region': region,
-                            'city': city,
-                            'latitude': float(latitude),
-                            'longitude': float(longitude)
-                        })
-                    stats['total'] += 1  # 总记录数
-                    break
-                elif ip_int < start_ip:
-                    right = mid - 1
+def apply_ip_hits(ip_hits, summary, ip_index, geo_lines, resolved=None):
+    """查询本批所有不重复IP的地理信息，把IP计数展开到各小时桶的IP/国家/地区/城市统计
+
+    ip_hits: {桶起始秒数: {IP: 次数}}；resolved为已查好的resolve_ips结果时不再重复查询
+    """
+    if not ip_hits:
+        return
+    started = time.perf_counter()
+    if resolved is None:
+        resolved = resolve_ips({ip_str for hits in ip_hits.values() for ip_str in hits}, ip_index, geo_lines)
+    aggregate_started = time.perf_counter()
+    TIMINGS['geo_lookup'] += aggregate_started - started
+    log_geo = logger.isEnabledFor(logging.DEBUG)
+    buckets = summary['buckets']
+    for bucket_start, hits in ip_hits.items():
+        bucket = buckets[bucket_start]
+        for ip_str, count in hits.items():
+            geo = resolved.get(ip_str)
+            if geo is None:
+                continue  # 不在任何IP段内
+            if geo:
+                country, region, city, latitude, longitude = geo
+                bucket['ip_freq'][ip_str] += count
+                bucket['country_freq'][country] += count
+                # 使用元组作为键，以匹配模板中的解包方式
+                bucket['region_freq'][(region, region)] += count  # 这里使用(region, region)是因为没有中英文区分
+                bucket['city_freq'][(city, city)] += count  # 这里使用(city, city)是因为没有中英文区分
+                if ip_str not in summary['geo']:
+                    summary['geo'][ip_str] = geo
+                    if log_geo and len(summary['geo']) % GEO_LOG_SAMPLE == 0:
+                        # 抽样输出，逐个输出会严重拖慢大日志的解析
+                        logger.debug("IP: %s, 纬度: %s, 经度: %s, 国家/地区: %s（每%d个新IP抽样一条）",
+                                     ip_str, latitude, longitude, country, GEO_LOG_SAMPLE)
+            bucket['total'] += count  # 总记录数
+    TIMINGS['aggregate'] += time.perf_counter() - aggregate_started
+
+
+def read_gzip_chunks(file_path):
+    """逐块解压.gz文件：每次读取GZIP_READ_SIZE字节压缩数据，产出不超过READ_CHUNK_SIZE的解压数据
+
+    支持多个gzip成员首尾相接的文件（如cat拼接的归档）；文件不完整时抛出EOFError
+    """
+    with open(file_path, 'rb') as f:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        in_member = False  # 是否有未解压完的成员
+        while True:
+            data = f.read(GZIP_READ_SIZE)
+            if not data:
+                break
+            while data:
+                in_member = True
+                chunk = decompressor.decompress(data, READ_CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                if decompressor.eof:
+                    # 一个成员结束，剩余数据属于下一个成员（末尾的0填充忽略）
+                    in_member = False
+                    data = decompressor.unused_data
+                    if not data.strip(b'\x00'):
+                        data = b''
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
                 else:
-                    left = mid + 1
+                    data = decompressor.unconsumed_tail
+        if in_member:
+            raise EOFError(f"压缩文件不完整：{file_path}")
+
+
+def read_log_chunks(file_path):
+    """逐块读取日志的原始字节（.gz边读边解压），不解码"""
+    if file_path.endswith('.gz'):
+        yield from read_gzip_chunks(file_path)
+        return
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def process_log_file(file_path, ip_index, geo_lines, summary):
+    """完整读取单个日志文件（按文件名确定日志格式），按小时分桶统计IP和地理信息"""
+    log_format = log_format_for(file_path)
+    ip_hits = {}
+    carry = b'\n'
+    chunks = read_log_chunks(file_path)
+    # 大块读取后直接在缓冲区中解析，分别统计读取（含解压）和解析的耗时
+    while True:
+        started = time.perf_counter()
+        chunk = next(chunks, None)
+        parse_started = time.perf_counter()
+        TIMINGS['read'] += parse_started - started
+        if chunk is None:
+            break
+        carry = process_buffer(carry, chunk, summary, ip_hits, log_format)
+        TIMINGS['parse'] += time.perf_counter() - parse_started
+        TIMINGS['bytes'] += len(chunk)
+    if len(carry) > 1:
+        process_buffer(carry, b'', summary, ip_hits, log_format)  # 最后一行没有换行符
+    apply_ip_hits(ip_hits, summary, ip_index, geo_lines)
+
+
+def read_line_range(file_path, start, end, summary, ip_hits, tail=b''):
+    """读取未压缩文件[start, end)范围的字节并逐行解析
+
+    tail为上次留下的不完整行，返回(实际读到的位置, 末尾不完整的行)
+    """
+    log_format = log_format_for(file_path)
+    position = start
+    carry = b'\n' + tail
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        while position < end:
+            started = time.perf_counter()
+            chunk = f.read(min(READ_CHUNK_SIZE, end - position))
+            parse_started = time.perf_counter()
+            TIMINGS['read'] += parse_started - started
+            if not chunk:
+                break
+            position += len(chunk)
+            carry = process_buffer(carry, chunk, summary, ip_hits, log_format)
+            TIMINGS['parse'] += time.perf_counter() - parse_started
+            TIMINGS['bytes'] += len(chunk)
+    return position, carry[1:]
+
+
+def tail_log_file(file_path, checkpoint, size, ip_index, geo_lines):
+    """从检查点偏移处读取未压缩日志新追加的内容，末尾不完整的行留到下次刷新"""
+    delta = new_summary()
+    ip_hits = {}
+    checkpoint['offset'], checkpoint['tail'] = read_line_range(
+        file_path, checkpoint['offset'], size, delta, ip_hits, checkpoint['tail'])
+    apply_ip_hits(ip_hits, delta, ip_index, geo_lines)
+    started = time.perf_counter()
+    checkpoint['summary'] = extend_summary(checkpoint['summary'], delta)
+    TIMINGS['aggregate'] += time.perf_counter() - started
+
+
+def merge_bucket(dst, bucket):
+    """把一个时间桶的计数累加到dst（窗口统计或另一个时间桶）"""
+    dst['total'] += bucket['total']
+    for key in FREQ_KEYS:
+        freq = dst[key]
+        if isinstance(freq, TopKCounter):
+            freq.merge(bucket[key])
+            continue
+        for item, count in bucket[key].items():
+            freq[item] += count
+
+
+def copy_bucket(bucket):
+    """复制一个时间桶的计数器"""
+    copied = {'total': bucket['total']}
+    for key in FREQ_KEYS:
+        freq = bucket[key]
+        copied[key] = freq.copy() if isinstance(freq, TopKCounter) else defaultdict(int, freq)
+    return copied
+
+
+def merge_summary(dst, src):
+    """把src文件汇总合并进尚未发布的dst；按解析顺序依次合并，结果与单进程顺序解析一致"""
+    for level in ('buckets', 'daily'):
+        buckets = dst[level]
+        for bucket_start, bucket in src[level].items():
+            if bucket_start in buckets:
+                merge_bucket(buckets[bucket_start], bucket)
+            else:
+                buckets[bucket_start] = bucket
+    for ip_str, geo in src['geo'].items():
+        dst['geo'].setdefault(ip_str, geo)
+
+
+def extend_summary(summary, delta):
+    """返回summary加上delta后的新汇总：只复制被delta触及的时间桶，其余桶与原汇总共享，原汇总保持不变"""
+    if not delta['buckets'] and not delta['daily']:
+        return summary
+    extended = {'buckets': dict(summary['buckets']), 'daily': dict(summary['daily']), 'geo': dict(summary['geo'])}
+    for level in ('buckets', 'daily'):
+        buckets = extended[level]
+        for bucket_start, bucket in delta[level].items():
+            if bucket_start in buckets:
+                merged = copy_bucket(buckets[bucket_start])
+                merge_bucket(merged, bucket)
+                buckets[bucket_start] = merged
+            else:
+                buckets[bucket_start] = bucket
+    for ip_str, geo in delta['geo'].items():
+        extended['geo'].setdefault(ip_str, geo)
+    return extended
+
+
+def compact_summary(summary, compact_before):
+    """把起始时间早于compact_before的小时桶合并为天桶，返回新汇总（无需合并时返回原对象）
+
+    近似模式下同时丢弃超出APPROX_HISTORY_DAYS的天桶，并只保留计数器中仍存在的IP的地理信息，使总内存有上限
+    """
+    old_starts = sorted(start for start in summary['buckets'] if start < compact_before)
+    expire_before = compact_before - (APPROX_HISTORY_DAYS - ROLLUP_HOURLY_DAYS) * DAY_SECONDS
+    expired = [start for start in summary['daily'] if start < expire_before] if APPROX_COUNTING else []
+    if not old_starts and not expired:
+        return summary
+    delta = new_summary()
+    for start in old_starts:
+        day_start = start - start % DAY_SECONDS
+        if APPROX_COUNTING and day_start < expire_before:
+            continue
+        day = delta['daily'].get(day_start)
+        if day is None:
+            day = delta['daily'][day_start] = new_bucket()
+        merge_bucket(day, summary['buckets'][start])
+    compacted = extend_summary(summary, delta)
+    if compacted is summary:
+        compacted = {'buckets': dict(summary['buckets']), 'daily': dict(summary['daily']), 'geo': summary['geo']}
+    for start in old_starts:
+        del compacted['buckets'][start]
+    for start in expired:
+        del compacted['daily'][start]
+    if APPROX_COUNTING:
+        live_ips = {ip_str for level in ('buckets', 'daily') for bucket in compacted[level].values()
+                    for ip_str in bucket['ip_freq']}
+        compacted['geo'] = {ip_str: geo for ip_str, geo in compacted['geo'].items() if ip_str in live_ips}
+    return compacted
 
 
 # ========================
-# 4. 主函数：遍历文件+多维度统计
+# 4. 增量读取：检查点管理
 # ========================
-def main():
-    global LAST_REFRESH_TIME  # 添加global声明
+def new_ingest_state(geo_version):
+    return {'version': INGEST_STATE_VERSION, 'geo_version': geo_version, 'counting': counting_mode(), 'files': {}}
+
+
+def load_ingest_state(geo_version):
+    """读取持久化的检查点，版本或地理库不一致时从头开始"""
+    global INGEST_STATE
+    state = INGEST_STATE
+    if state is None and os.path.exists(STATE_PATH):
+        try:
+            with open(STATE_PATH, 'rb') as f:
+                state = pickle.load(f)
+        except Exception as e:
+            print(f"检查点读取失败，将重新全量统计：{e}")
+            state = None
+    if (state is None or state.get('version') != INGEST_STATE_VERSION
+            or state.get('geo_version') != geo_version or state.get('counting') != counting_mode()):
+        state = new_ingest_state(geo_version)
+    INGEST_STATE = state
+    return state
+
+
+def write_pickle(path, obj):
+    """原子写入pickle文件（先写临时文件再改名），避免刷新中断留下半个文件"""
+    parent = os.path.dirname(path)
+    if parent and not os.path.exists(parent):
+        os.makedirs(parent)
+    tmp_path = f"{path}.{os.getpid()}.tmp"  # 多进程同时写同一文件时互不覆盖临时文件
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def save_ingest_state(state):
+    """持久化检查点文件"""
+    write_pickle(STATE_PATH, state)
+
+
+def read_head_crc(file_path, length):
+    """文件开头若干字节的校验值，用于识别inode被复用或文件被截断后重写"""
+    with open(file_path, 'rb') as f:
+        return zlib.crc32(f.read(length))
+
+
+def checkpoint_matches(checkpoint, file_path, st):
+    """判断检查点是否仍对应当前文件内容"""
+    if st.st_size < checkpoint['offset']:
+        return False  # 文件被截断（copytruncate）
+    return read_head_crc(file_path, checkpoint['head_len']) == checkpoint['head_crc']
+
+
+def new_checkpoint(inode):
+    return {
+        'inode': inode,
+        'path': None,
+        'size': 0,
+        'mtime': 0,
+        'offset': 0,
+        'tail': b'',
+        'head_len': 0,
+        'head_crc': zlib.crc32(b''),
+        'summary': new_summary()
+    }
+
+
+def ingest_log_files(log_files, state, ip_index, geo_lines, pool=None):
+    """按检查点增量读取未压缩的日志文件（.gz归档由load_archive_summaries处理）
+
+    检查点以(设备号, inode)为键：logrotate把.log改名为.1时inode不变，从原偏移继续读取；
+    .1被压缩为.gz后原inode消失，其汇总随之丢弃，改由.gz归档的汇总缓存提供。
+    """
+    files = {}
+    for file_path in log_files:
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            continue  # 文件在遍历期间被轮转删除
+        inode = (st.st_dev, st.st_ino)
+        checkpoint = state['files'].get(inode)
+        if checkpoint is not None and not checkpoint_matches(checkpoint, file_path, st):
+            checkpoint = None
+        if checkpoint is None:
+            checkpoint = new_checkpoint(inode)
+
+        start_offset = checkpoint['offset']
+        before = dict(TIMINGS)
+        if pool is not None and st.st_size - checkpoint['offset'] > RANGE_SPLIT_BYTES:
+            tail_log_file_parallel(file_path, checkpoint, st.st_size, pool)
+        else:
+            tail_log_file(file_path, checkpoint, st.st_size, ip_index, geo_lines)
+        if checkpoint['head_len'] < HEAD_CHECK_BYTES:
+            checkpoint['head_len'] = min(checkpoint['offset'], HEAD_CHECK_BYTES)
+            checkpoint['head_crc'] = read_head_crc(file_path, checkpoint['head_len'])
+        checkpoint['path'] = file_path
+        checkpoint['size'] = st.st_size
+        checkpoint['mtime'] = st.st_mtime_ns
+        files[inode] = checkpoint
+        track_progress(files_done=1, bytes_done=st.st_size, bytes_parsed=max(st.st_size - start_offset, 0))
+        if st.st_size > start_offset:
+            record_file_metrics(file_path, before)
+    # 已删除的文件（如压缩后被删除的.1）不再保留
+    state['files'] = files
+    return state
+
 
-    # 先执行统计
+# ========================
+# 5. 归档汇总缓存：轮转后的.gz文件内容不再变化，只需解析一次
+# ========================
+def archive_cache_key(st):
+    """归档缓存键：大小+修改时间+inode。logrotate给归档重新编号（.2.gz→.3.gz）时三者都不变，缓存依然命中"""
+    return f"{st.st_dev:x}-{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+
+
+def read_archive_cache(key):
+    """读取单个归档的汇总缓存，内存中没有时从磁盘加载"""
+    entry = SUMMARY_CACHE.get(key)
+    if entry is not None or not SUMMARY_CACHE_ENABLED:
+        return entry
+    cache_path = os.path.join(SUMMARY_CACHE_DIR, key + '.pkl')
+    if not os.path.exists(cache_path):
+        return None
     try:
-        refresh_stats_only()
-        # 第一次统计完成后更新最后刷新时间
-        LAST_REFRESH_TIME = datetime.datetime.now()
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e:
+        print(f"归档汇总缓存读取失败，将重新解析：{cache_path}，错误：{e}")
+        return None
+
+
+def load_archive_summaries(archive_files, geo_version, ip_index, geo_lines, compact_before, pool=None):
+    """返回每个.gz归档的时间桶汇总：命中缓存直接复用，未缓存、已变化或地理库更新后才重新解析"""
+    archives = []
+    for file_path in archive_files:
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            continue
+        key = archive_cache_key(st)
+        entry = read_archive_cache(key)
+        if entry is not None and (entry['geo_version'] != geo_version
+                                  or entry.get('summary_version') != counting_mode()):
+            entry = None
+        archives.append((file_path, st, key, entry))
+
+    # 只解析未命中缓存的归档（多进程模式下并行解析）
+    missing = [file_path for file_path, _, _, entry in archives if entry is None]
+    parsed = parse_files(missing, ip_index, geo_lines, pool)
+
+    summaries = []
+    live_keys = set()
+    for file_path, st, key, entry in archives:
+        before = dict(TIMINGS)
+        summary = next(parsed) if entry is None else entry['summary']
+        track_progress(files_done=1, bytes_done=st.st_size, bytes_parsed=st.st_size if entry is None else 0)
+        if entry is None:
+            record_file_metrics(file_path, before)
+        compacted = compact_summary(summary, compact_before)
+        if entry is None or compacted is not summary:
+            entry = {
+                'path': file_path,
+                'size': st.st_size,
+                'mtime': st.st_mtime_ns,
+                'geo_version': geo_version,
+                'summary_version': counting_mode(),
+                'summary': compacted
+            }
+            if SUMMARY_CACHE_ENABLED:
+                write_pickle(os.path.join(SUMMARY_CACHE_DIR, key + '.pkl'), entry)
+        entry['path'] = file_path
+        SUMMARY_CACHE[key] = entry
+        live_keys.add(key)
+        summaries.append(entry['summary'])
+    evict_archive_summaries(live_keys)
+    return summaries
+
+
+def evict_archive_summaries(live_keys):
+    """清除已删除归档的缓存（内存和磁盘）"""
+    for key in list(SUMMARY_CACHE):
+        if key not in live_keys:
+            del SUMMARY_CACHE[key]
+    if not os.path.isdir(SUMMARY_CACHE_DIR):
+        return
+    for filename in os.listdir(SUMMARY_CACHE_DIR):
+        if filename.endswith('.pkl') and filename[:-len('.pkl')] not in live_keys:
+            os.remove(os.path.join(SUMMARY_CACHE_DIR, filename))
+
+
+# ========================
+# 6. 并行解析：多进程处理多个文件或大文件的不同字节范围
+# ========================
+def create_ingest_pool():
+    """INGEST_WORKERS大于1时创建解析进程池，否则返回None（顺序解析）"""
+    if INGEST_WORKERS <= 1:
+        return None
+    config = (BIN_INDEX_PATH, GEO_TEXT_PATH, BUCKET_SECONDS, READ_CHUNK_SIZE, GZIP_READ_SIZE, LOG_SOURCES,
+              APPROX_COUNTING, APPROX_TOP_K, APPROX_BUCKET_TOP_K, APPROX_SKETCH_WIDTH, APPROX_SKETCH_DEPTH)
+    return ProcessPoolExecutor(max_workers=INGEST_WORKERS, initializer=init_ingest_worker, initargs=(config,))
+
+
+def init_ingest_worker(config):
+    """工作进程初始化：同步配置并加载地理库
+
+    fork启动时直接继承父进程已映射的索引；spawn启动时各自mmap同一文件，共享系统页缓存，索引不经pickle传输
+    """
+    global BIN_INDEX_PATH, GEO_TEXT_PATH, BUCKET_SECONDS, READ_CHUNK_SIZE, GZIP_READ_SIZE, LOG_SOURCES
+    global APPROX_COUNTING, APPROX_TOP_K, APPROX_BUCKET_TOP_K, APPROX_SKETCH_WIDTH, APPROX_SKETCH_DEPTH
+    (BIN_INDEX_PATH, GEO_TEXT_PATH, BUCKET_SECONDS, READ_CHUNK_SIZE, GZIP_READ_SIZE, LOG_SOURCES,
+     APPROX_COUNTING, APPROX_TOP_K, APPROX_BUCKET_TOP_K, APPROX_SKETCH_WIDTH, APPROX_SKETCH_DEPTH) = config
+    load_bin_index()
+
+
+def parse_file_task(file_path):
+    """工作进程：完整解析单个文件，返回(小时桶汇总, 各阶段耗时)"""
+    global TIMINGS
+    TIMINGS = new_timings()
+    ip_index, geo_lines = load_bin_index()
+    summary = new_summary()
+    process_log_file(file_path, ip_index, geo_lines, summary)
+    return summary, TIMINGS
+
+
+def parse_range_task(file_path, start, end, head):
+    """工作进程：解析未压缩文件[start, end)范围内的行，返回(汇总, 读到的位置, 末尾不完整的行, 各阶段耗时)"""
+    global TIMINGS
+    TIMINGS = new_timings()
+    ip_index, geo_lines = load_bin_index()
+    summary = new_summary()
+    ip_hits = {}
+    position, tail = read_line_range(file_path, start, end, summary, ip_hits, head)
+    apply_ip_hits(ip_hits, summary, ip_index, geo_lines)
+    return summary, position, tail, TIMINGS
+
+
+def parse_files(file_paths, ip_index, geo_lines, pool=None):
+    """完整解析多个文件，按输入顺序逐个产出各自的汇总（调用方可据此更新进度）"""
+    if pool is not None and len(file_paths) > 1:
+        for summary, timings in pool.map(parse_file_task, file_paths):
+            add_timings(timings)
+            yield summary
+        return
+    for file_path in file_paths:
+        summary = new_summary()
+        process_log_file(file_path, ip_index, geo_lines, summary)
+        yield summary
+
+
+def split_line_ranges(file_path, start, end, step):
+    """把[start, end)切成约step字节的若干段，切分点对齐到行首"""
+    bounds = [start]
+    with open(file_path, 'rb') as f:
+        position = start + step
+        while position < end:
+            f.seek(position)
+            f.readline()
+            position = f.tell()
+            if position >= end:
+                break
+            bounds.append(position)
+            position += step
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def tail_log_file_parallel(file_path, checkpoint, size, pool):
+    """把新追加的大段日志按行边界切分后并行解析，再按顺序合并进检查点的汇总"""
+    ranges = split_line_ranges(file_path, checkpoint['offset'], size, RANGE_SPLIT_BYTES)
+    starts = [start for start, _ in ranges]
+    ends = [end for _, end in ranges]
+    heads = [checkpoint['tail']] + [b''] * (len(ranges) - 1)
+    results = pool.map(parse_range_task, [file_path] * len(ranges), starts, ends, heads)
+    delta = new_summary()
+    for (summary, position, tail, timings), end in zip(results, ends):
+        add_timings(timings)
+        started = time.perf_counter()
+        merge_summary(delta, summary)
+        TIMINGS['aggregate'] += time.perf_counter() - started
+        checkpoint['offset'], checkpoint['tail'] = position, tail
+        if position < end:
+            break  # 文件在读取期间被截断，剩余部分下次刷新时再处理
+    started = time.perf_counter()
+    checkpoint['summary'] = extend_summary(checkpoint['summary'], delta)
+    TIMINGS['aggregate'] += time.perf_counter() - started
+
+
+# ========================
+# 7. 时间桶汇总存储：任意时间范围都由时间桶合并得到，无需重新扫描日志
+# ========================
+def rollup_compact_cutoff(now=None):
+    """早于该时间（按天对齐）的小时桶合并为天桶"""
+    if now is None:
+        now = datetime.datetime.now()
+    return to_day(now - datetime.timedelta(days=ROLLUP_HOURLY_DAYS))
+
+
+def to_epoch(log_time):
+    """本地时间→秒数（与日志时间的换算方式一致）"""
+    return (log_time - EPOCH) // datetime.timedelta(seconds=1)
+
+
+def to_day(log_time):
+    """本地时间→所在天桶的起始秒数"""
+    seconds = to_epoch(log_time)
+    return seconds - seconds % DAY_SECONDS
+
+
+def build_rollup_store(summaries):
+    """按起始时间为各文件汇总的时间桶建立有序索引（只引用不复制），供任意时间范围查询"""
+    store = {'geo': {}}
+    for level in ('buckets', 'daily'):
+        index = defaultdict(list)
+        for summary in summaries:
+            for bucket_start, bucket in summary[level].items():
+                index[bucket_start].append(bucket)
+        starts = sorted(index)
+        store[level] = (starts, [index[start] for start in starts])
+    for summary in summaries:
+        store['geo'].update(summary['geo'])
+    return store
+
+
+def query_rollup(store, start, end=None):
+    """合并[start, end)范围内的时间桶，返回与固定时间窗口相同结构的统计结果
+
+    小时桶范围的起点按小时对齐，天桶范围的起点按天对齐；耗时只与范围内的桶数有关
+    """
+    stats = new_stats()
+    for level, align in (('buckets', BUCKET_SECONDS), ('daily', DAY_SECONDS)):
+        starts, buckets = store[level]
+        lo = bisect.bisect_left(starts, start - start % align)
+        hi = len(starts) if end is None else bisect.bisect_left(starts, end)
+        for same_start in buckets[lo:hi]:
+            for bucket in same_start:
+                merge_bucket(stats, bucket)
+    if APPROX_COUNTING:
+        stats['approx_error'] = {key: stats[key].error for key in APPROX_KEYS}
+    stats['rankings'] = build_rankings(stats)
+
+    # 按经纬度汇总地理位置信息，同一位置的多个IP合并为一个点
+    geo_points = store['geo']
+    geo_data = stats['geo_data']
+    for ip_str, count in stats['ip_freq'].items():
+        country, region, city, latitude, longitude = geo_points[ip_str]
+        location = geo_data.get((latitude, longitude))
+        if location is None:
+            geo_data[(latitude, longitude)] = {
+                'count': count,
+                'ip_count': 1,
+                'top_ip': ip_str,
+                'top_count': count,
+                'country': country,
+                'region': region,
+                'city': city
+            }
+            continue
+        location['count'] += count
+        location['ip_count'] += 1
+        if count > location['top_count']:
+            location['top_ip'] = ip_str
+            location['top_count'] = count
+    return stats
+
+
+def ranking_label(key):
+    """排行榜显示名称：地区/城市的键是(英文, 中文)元组，两者相同时只显示一个"""
+    if isinstance(key, tuple):
+        return key[0] if key[0] == key[1] else f"{key[0]} ({key[1]})"
+    return key
+
+
+def top_items(freq, k):
+    """按次数从高到低取计数器的前k项，结果（包括同次数项的先后）与完整排序后取前k项相同
+
+    键多于k个时先用np.partition找出第k大的次数，只对入选的项排序，n个键耗时约O(n + k log k)
+    """
+    if len(freq) <= k:
+        return sorted(freq.items(), key=lambda x: -x[1])
+    counts = np.fromiter(freq.values(), dtype=np.int64, count=len(freq))
+    kth = counts[np.argpartition(counts, len(counts) - k)[len(counts) - k]]
+    indexes = np.flatnonzero(counts > kth)
+    # 次数等于第k大的项按插入顺序补足k项，与稳定排序一致
+    indexes = np.concatenate((indexes, np.flatnonzero(counts == kth)[:k - len(indexes)]))
+    indexes = indexes[np.lexsort((indexes, -counts[indexes]))]
+    keys = list(freq)
+    return [(keys[i], int(counts[i])) for i in indexes]
+
+
+def build_rankings(stats):
+    """刷新时为各排行榜选出前RANKING_VIEW_SIZE名，页面、图表、控制台报告和API的前几页都直接切片"""
+    size = max(RANKING_VIEW_SIZE, TOP_N, 1)
+    return {
+        name: [(ranking_label(key), count) for key, count in top_items(stats[freq_key], size)]
+        for name, freq_key in RANKINGS.items()
+    }
+
+
+def full_ranking(stats, name, scope=None):
+    """完整排名：API翻到视图之外或升序查看时才生成，之后的翻页直接切片
+
+    已发布的统计快照不可修改，完整排名按scope（统计代数, 时间窗口）存入FULL_RANKING_CACHE；scope为None时不缓存
+    """
+    key = None if scope is None else scope + (name,)
+    if key is not None:
+        with CHART_CACHE_LOCK:
+            ranking = FULL_RANKING_CACHE.get(key)
+            if ranking is not None:
+                FULL_RANKING_CACHE.move_to_end(key)
+                return ranking
+    freq = stats[RANKINGS[name]]
+    ranking = [(ranking_label(item), count) for item, count in sorted(freq.items(), key=lambda x: -x[1])]
+    if key is not None:
+        with CHART_CACHE_LOCK:
+            if key[0] == STATS_GENERATION:
+                FULL_RANKING_CACHE[key] = ranking
+                while len(FULL_RANKING_CACHE) > FULL_RANKING_CACHE_LIMIT:
+                    FULL_RANKING_CACHE.popitem(last=False)
+    return ranking
+
+
+def ranking_page(stats, name, page, size, order='desc', scope=None):
+    """取排行榜的一页，在预先选出的视图内时耗时只与每页条数有关；scope见full_ranking"""
+    ranking = stats['rankings'][name]
+    count = len(stats[RANKINGS[name]])
+    start = (page - 1) * size
+    if len(ranking) < count and (order == 'asc' or start + size > len(ranking)):
+        ranking = full_ranking(stats, name, scope)
+    if order == 'asc':
+        indexes = range(count - 1 - start, max(count - 1 - start - size, -1), -1)
+    else:
+        indexes = range(start, min(start + size, len(ranking)))
+    total = stats['total']
+    return {
+        'ranking': name,
+        'page': page,
+        'size': size,
+        'sort': order,
+        'count': count,
+        'pages': (count + size - 1) // size,
+        'total': total,
+        'items': [
+            {
+                'rank': index + 1,
+                'name': ranking[index][0],
+                'count': ranking[index][1],
+                'ratio': round(ranking[index][1] / total * 100, 2) if total else 0
+            }
+            for index in indexes
+        ]
+    }
+
+
+def get_range_stats(snapshot, start, end):
+    """自定义时间范围的统计结果，同一范围翻页时复用"""
+    generation = snapshot['generation']
+    key = (start, end, generation)
+    with CHART_CACHE_LOCK:
+        stats = RANGE_STATS_CACHE.get(key)
+        if stats is not None:
+            RANGE_STATS_CACHE.move_to_end(key)
+            return stats
+    stats = query_rollup(snapshot['store'], to_epoch(start), to_epoch(end) if end else None)
+    with CHART_CACHE_LOCK:
+        if generation == STATS_GENERATION:
+            RANGE_STATS_CACHE[key] = stats
+            while len(RANGE_STATS_CACHE) > RANGE_STATS_CACHE_LIMIT:
+                RANGE_STATS_CACHE.popitem(last=False)
+    return stats
+
+
+def build_window_stats(store, cutoffs):
+    """由时间桶生成每个固定时间粒度的统计结果（窗口起点按小时对齐）"""
+    return OrderedDict(
+        (time_name, query_rollup(store, to_epoch(cutoff))) for time_name, cutoff in cutoffs.items()
+    )
+
+
+# ========================
+# 8. 主函数：遍历文件+多维度统计
+# ========================
+def main():
+    setup_logging()
+
+    if WARM_START and load_snapshot():
+        # 先用上次的快照提供服务，后台刷新完成后自动替换
+        print(f"已加载 {LAST_REFRESH_TIME} 的统计快照，后台刷新中")
+        start_refresh()
+    else:
+        # 先执行统计
+        job = start_refresh()
+        job['done'].wait()
+        if job['status'] != 'done' or STATS_SNAPSHOT is None:
+            print(f"GLOBAL_STATS 初始化失败: {job['error'] or '没有可统计的日志或地理库加载失败'}")
+            return  # 初始化失败时直接返回
         print("GLOBAL_STATS 初始化成功")
         print(f"首次数据刷新完成于 {LAST_REFRESH_TIME}")
-    except Exception as e:
-        print(f"GLOBAL_STATS 初始化失败: {e}")
-        return  # 初始化失败时直接返回
 
     # 启动自动刷新线程（在Web服务器之前）
     refresh_thread = threading.Thread(target=auto_refresh, daemon=True)
     refresh_thread.start()
+    start_detector()
 
     # 启动Web服务器
     start_web_server()
@@ -384,102 +1725,257 @@ def main():
 
         # 1. IP访问频次Top N
         print("\n[IP访问频次 Top 20]")
-        for ip, cnt in sorted(stats['ip_freq'].items(), key=lambda x: -x[1])[:TOP_N]:
+        for ip, cnt in stats['rankings']['ips'][:TOP_N]:
             print(f"  {ip}: {cnt}次 (占比：{cnt / stats['total']:.2%})" if stats['total'] else f"  {ip}: {cnt}次")
 
         # 2. 国家频次Top N（中英文）
         print("\n[国家/地区频次 Top 20]")
-        for (en, cn), cnt in sorted(stats['country_freq'].items(), key=lambda x: -x[1])[:TOP_N]:
-            print(f"  {en} ({cn}): {cnt}次 (占比：{cnt / stats['total']:.2%})" if stats[
-                'total'] else f"  {en} ({cn}): {cnt}次")
+        for name, cnt in stats['rankings']['countries'][:TOP_N]:
+            print(f"  {name}: {cnt}次 (占比：{cnt / stats['total']:.2%})" if stats[
+                'total'] else f"  {name}: {cnt}次")
 
         # 3. 地区频次Top N（中英文）
         print("\n[地区频次 Top 20]")
-        for (en, cn), cnt in sorted(stats['region_freq'].items(), key=lambda x: -x[1])[:TOP_N]:
-            print(f"  {en} ({cn}): {cnt}次")
+        for name, cnt in stats['rankings']['regions'][:TOP_N]:
+            print(f"  {name}: {cnt}次")
 
         # 4. 城市频次Top N（中英文）
         print("\n[城市频次 Top 20]")
-        for (en, cn), cnt in sorted(stats['city_freq'].items(), key=lambda x: -x[1])[:TOP_N]:
-            print(f"  {en} ({cn}): {cnt}次")
+        for name, cnt in stats['rankings']['cities'][:TOP_N]:
+            print(f"  {name}: {cnt}次")
 
     print("\n" + "=" * 100)
     print("统计完成！")
 
 
 # 添加新函数：启动Flask Web服务器
-def start_web_server():
+def build_app():
+    """创建Flask应用并注册页面路由（开发服务器和gunicorn共用）"""
+    from flask import Flask, render_template, request, jsonify
     app = Flask(__name__)
 
     @app.route('/')
     def index():
         # 默认显示当日统计
         default_time_name = '最近一天'
-        if default_time_name not in GLOBAL_STATS:
+        snapshot = STATS_SNAPSHOT  # 整个请求只读取这一份快照
+        if snapshot is None or default_time_name not in snapshot['stats']:
             return "暂无统计数据", 404
 
-        stats = GLOBAL_STATS[default_time_name]
+        generation = snapshot['generation']
+        stats = snapshot['stats'][default_time_name]
         try:
-            charts = generate_charts(default_time_name, stats)
+            charts = get_charts(default_time_name, stats, generation)
         except Exception as e:
             charts = {}
             print(f"生成图表时出错: {str(e)}")
 
-        last_refresh_time = LAST_REFRESH_TIME.strftime('%Y-%m-%d %H:%M:%S') if LAST_REFRESH_TIME else '从未刷新'
+        last_refresh_time = snapshot['refresh_time'].strftime('%Y-%m-%d %H:%M:%S')
 
         return render_template('stats.html',
                                time_name=default_time_name,
                                stats=stats,
                                charts=charts,
                                top_n=TOP_N,
+                               api_base='/api/' + urllib.parse.quote(default_time_name),
+                               api_params='',
                                last_refresh_time=last_refresh_time,
-                               time_periods=GLOBAL_STATS.keys())
+                               time_periods=snapshot['stats'].keys())
 
     @app.route('/stats/<time_name>')
     def show_stats(time_name):
-        if time_name not in GLOBAL_STATS:
+        snapshot = STATS_SNAPSHOT
+        if snapshot is None or time_name not in snapshot['stats']:
             return "无效的时间范围", 404
 
-        stats = GLOBAL_STATS[time_name]
+        generation = snapshot['generation']
+        stats = snapshot['stats'][time_name]
         try:
-            charts = generate_charts(time_name, stats)
+            charts = get_charts(time_name, stats, generation)
+        except Exception as e:
+            charts = {}
+            print(f"生成图表时出错: {str(e)}")
+
+        last_refresh_time = snapshot['refresh_time'].strftime('%Y-%m-%d %H:%M:%S')
+
+        return render_template('stats.html',
+                               time_name=time_name,
+                               stats=stats,
+                               charts=charts,
+                               top_n=TOP_N,
+                               api_base='/api/' + urllib.parse.quote(time_name),
+                               api_params='',
+                               last_refresh_time=last_refresh_time,
+                               time_periods=snapshot['stats'].keys())
+
+    @app.route('/stats')
+    def show_custom_range():
+        # 自定义时间范围：/stats?from=2025-09-01&to=2025-09-07T12:00
+        snapshot = STATS_SNAPSHOT
+        if snapshot is None:
+            return "暂无统计数据", 404
+        try:
+            start = parse_range_param(request.args.get('from', ''))
+            end = parse_range_param(request.args.get('to', ''), is_end=True)
+        except ValueError:
+            return "无效的时间范围，格式示例：/stats?from=2025-09-01&to=2025-09-07T12:00", 400
+        if start is None:
+            return "请提供起始时间参数 from", 400
+
+        time_name = f"{request.args.get('from')} 至 {request.args.get('to') or '现在'}"
+        generation = snapshot['generation']
+        stats = get_range_stats(snapshot, start, end)
+        try:
+            charts = get_charts(time_name, stats, generation)
         except Exception as e:
             charts = {}
             print(f"生成图表时出错: {str(e)}")
 
-        last_refresh_time = LAST_REFRESH_TIME.strftime('%Y-%m-%d %H:%M:%S') if LAST_REFRESH_TIME else '从未刷新'
+        last_refresh_time = snapshot['refresh_time'].strftime('%Y-%m-%d %H:%M:%S')
 
         return render_template('stats.html',
                                time_name=time_name,
                                stats=stats,
                                charts=charts,
                                top_n=TOP_N,
+                               api_base='/api/range',
+                               api_params=urllib.parse.urlencode({'from': request.args.get('from', ''),
+                                                                  'to': request.args.get('to', '')}) + '&',
                                last_refresh_time=last_refresh_time,
-                               time_periods=GLOBAL_STATS.keys())
+                               time_periods=snapshot['stats'].keys())
+
+    @app.route('/api/<time_name>/<ranking>')
+    def api_ranking(time_name, ranking):
+        # 排行榜分页：/api/最近一天/urls?page=1&size=10&sort=desc
+        snapshot = STATS_SNAPSHOT
+        if snapshot is None or time_name not in snapshot['stats']:
+            return jsonify({'error': '无效的时间范围'}), 404
+        return ranking_response(snapshot['stats'][time_name], ranking, (snapshot['generation'], time_name))
+
+    @app.route('/api/range/<ranking>')
+    def api_range_ranking(ranking):
+        # 自定义时间范围的排行榜分页：/api/range/urls?from=2025-09-01&to=2025-09-07&page=1
+        snapshot = STATS_SNAPSHOT
+        if snapshot is None:
+            return jsonify({'error': '暂无统计数据'}), 404
+        try:
+            start = parse_range_param(request.args.get('from', ''))
+            end = parse_range_param(request.args.get('to', ''), is_end=True)
+        except ValueError:
+            return jsonify({'error': '无效的时间范围'}), 400
+        if start is None:
+            return jsonify({'error': '请提供起始时间参数 from'}), 400
+        return ranking_response(get_range_stats(snapshot, start, end), ranking, (snapshot['generation'], (start, end)))
+
+    def ranking_response(stats, ranking, scope):
+        if ranking not in RANKINGS:
+            return jsonify({'error': f"无效的排行榜，可选：{', '.join(RANKINGS)}"}), 404
+        try:
+            page = int(request.args.get('page', 1))
+            size = int(request.args.get('size', API_PAGE_SIZE))
+        except ValueError:
+            return jsonify({'error': 'page和size必须是整数'}), 400
+        order = request.args.get('sort', 'desc')
+        if page < 1 or not 1 <= size <= API_MAX_PAGE_SIZE or order not in ('desc', 'asc'):
+            return jsonify({'error': f"参数范围：page>=1，1<=size<={API_MAX_PAGE_SIZE}，sort为desc或asc"}), 400
+        return jsonify(ranking_page(stats, ranking, page, size, order, scope))
 
     @app.route('/refresh')
     def refresh_data():
+        # 刷新在后台进行，重复点击会并入正在进行的刷新
+        request_refresh()
+        return REFRESH_PAGE
+
+    @app.route('/refresh/status')
+    def refresh_status_view():
+        return jsonify(current_refresh_status())
+
+    @app.route('/fleet/push', methods=['POST'])
+    def fleet_push():
+        # collector接收agent推送的增量汇总（gzip压缩的JSON）
+        if FLEET_ROLE != 'collector':
+            return jsonify({'error': '未启用collector模式'}), 404
+        if not FLEET_TOKEN or not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {FLEET_TOKEN}'):
+            return jsonify({'error': '令牌无效'}), 403
         try:
-            refresh_stats_only()
-            global LAST_REFRESH_TIME
-            LAST_REFRESH_TIME = datetime.datetime.now()
-            return "数据刷新成功！<a href='/'>返回首页</a>"
-        except Exception as e:
-            return f"数据刷新失败: {str(e)}"
+            body = None
+            if (request.content_length or 0) <= FLEET_MAX_PUSH_BYTES:
+                body = request.get_data()
+                if request.headers.get('Content-Encoding') == 'gzip':
+                    body = decompress_push(body)
+            if body is None or len(body) > FLEET_MAX_PUSH_BYTES:
+                return jsonify({'error': f'推送数据超过 {FLEET_MAX_PUSH_BYTES} 字节'}), 413
+            payload = json.loads(body)
+        except (zlib.error, EOFError, ValueError):
+            return jsonify({'error': '无法解析推送数据'}), 400
+        if not isinstance(payload, dict) or payload.get('header') != fleet_header():
+            return jsonify({'error': '推送格式、计数模式或时间桶大小与collector不一致', 'expected': fleet_header()}), 400
+        try:
+            seq = receive_fleet_push(payload, request.remote_addr, len(request.get_data()))
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': f'推送数据不完整: {e}'}), 400
+        if seq is None:
+            return jsonify({'error': '序号与collector记录不符，请重新发送完整汇总'}), 409
+        return jsonify({'seq': seq})
+
+    @app.route('/alerts')
+    def alerts_view():
+        # 实时检测的告警（新的在前）：/alerts?after=告警编号&limit=100
+        try:
+            after = int(request.args.get('after', 0))
+            limit = int(request.args.get('limit', 100))
+        except ValueError:
+            return jsonify({'error': 'after和limit必须是整数'}), 400
+        if limit < 1:
+            return jsonify({'error': 'limit必须大于0'}), 400
+        return jsonify(current_alerts(after, limit))
+
+    @app.route('/assets/charts.js')
+    def charts_script():
+        # 内置的图表脚本，不依赖外部CDN；内容只随程序版本变化，浏览器可长期缓存
+        return CHARTS_JS, 200, {'Content-Type': 'application/javascript; charset=utf-8',
+                                'Cache-Control': 'public, max-age=86400'}
+
+    @app.route('/metrics')
+    def metrics():
+        # Prometheus文本格式的监控指标
+        return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
     # 创建简单的HTML模板
     create_templates()
+    return app
+
+
+def start_web_server():
+    """单进程开发服务器（直接运行脚本时使用）"""
+    app = build_app()
 
     print("\n启动Web服务器...")
     print("访问 http://0.0.0.0:5000 查看可视化结果")
     app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
 
+def parse_range_param(value, is_end=False):
+    """解析自定义时间范围参数（2025-09-01 / 2025-09-01T12:00 / 2025-09-01 12:00:00），空值返回None
+
+    结束时间只给出日期时包含当天整天；带时区偏移的时间（2025-09-01T00:00+08:00）换算为本机本地时间，
+    与日志时间的口径一致
+    """
+    value = value.strip()
+    if not value:
+        return None
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    if is_end and len(value) == 10:
+        parsed += datetime.timedelta(days=1)
+    return parsed
+
+
 # 添加新函数：创建HTML模板
 # 添加新函数：创建HTML模板
 def create_templates():
     # 创建templates目录
     template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
-    if not os.path.exists(template_dir):
-        os.makedirs(template_dir)
+    os.makedirs(template_dir, exist_ok=True)
 
     # 创建index.html
     index_html = '''<!DOCTYPE html>
@@ -500,8 +1996,7 @@ def create_templates():
     {% endfor %}
 </body>
 </html>'''
-    with open(os.path.join(template_dir, 'index.html'), 'w', encoding='utf-8') as f:
-        f.write(index_html)
+    write_template(template_dir, 'index.html', index_html)
 
     # 创建stats.html
     stats_html = '''<!DOCTYPE html>
@@ -593,7 +2088,7 @@ def create_templates():
             height: 700px; /* 增加地图高度 */
             border-radius: 10px; 
         }
-        .chart-container img {
+        .chart-container img, .chart-container svg {
             max-width: 100%;
             border-radius: 10px;
         }
@@ -629,6 +2124,13 @@ def create_templates():
                 </a>
             {% endfor %}
         </div>
+        <form action="/stats" method="get" style="margin-top: 15px; display: flex; gap: 10px; align-items: center; flex-wrap: wrap;">
+            <span>自定义范围:</span>
+            <input type="datetime-local" name="from" required>
+            <span>至</span>
+            <input type="datetime-local" name="to">
+            <button type="submit" style="padding: 6px 15px; background-color: #007bff; color: white; border: none; border-radius: 5px;">查询</button>
+        </form>
     </div>
     <!-- 将刷新按钮和时间移到右上方 -->
     <div class="refresh-container">
@@ -651,7 +2153,12 @@ def create_templates():
 
         <!-- 图表区域 -->
         <div class="charts-section">
-            {% if charts.ip_pie %}
+            {% if charts.series and charts.series.ip_pie %}
+            <div class="chart-card">
+                <h3>IP访问分布</h3>
+                <div class="chart-container" data-chart="ip_pie"></div>
+            </div>
+            {% elif charts.ip_pie %}
             <div class="chart-card">
                 <h3>IP访问分布</h3>
                 <div class="chart-container">
@@ -660,7 +2167,12 @@ def create_templates():
             </div>
             {% endif %}
 
-            {% if charts.country_bar %}
+            {% if charts.series and charts.series.country_bar %}
+            <div class="chart-card">
+                <h3>国家/地区访问分布</h3>
+                <div class="chart-container" data-chart="country_bar"></div>
+            </div>
+            {% elif charts.country_bar %}
             <div class="chart-card">
                 <h3>国家/地区访问分布</h3>
                 <div class="chart-container">
@@ -672,7 +2184,12 @@ def create_templates():
         </div>
     </div>
     
-     {% if charts.hour_bar %}
+     {% if charts.series and charts.series.hour_bar %}
+        <div class="chart-card">
+            <h3>访问时段分布</h3>
+            <div class="chart-container" data-chart="hour_bar"></div>
+        </div>
+     {% elif charts.hour_bar %}
         <div class="chart-card">
             <h3>访问时段分布</h3>
             <div class="chart-container">
@@ -684,6 +2201,7 @@ def create_templates():
      <!-- 添加URL访问频次表格 -->
     <div class="dashboard-card">
         <h3>URL访问频次</h3>
+        {% if stats.approx_error %}<p>近似统计：只列出高频URL，计数误差不超过 ±{{ stats.approx_error.url_freq }}</p>{% endif %}
         <div id="url-table-container">
             <table id="url-table">
                 <thead>
@@ -694,17 +2212,7 @@ def create_templates():
                         <th>占比</th>
                     </tr>
                 </thead>
-                <tbody>
-                    {% set sorted_urls = stats['url_freq'].items() | sort(reverse=true, attribute='1') | list %}
-                    {% for url, count in sorted_urls %}
-                    <tr>
-                        <td>{{ loop.index }}</td>
-                        <td title="{{ url }}">{{ url[:80] }}{% if url|length > 80 %}...{% endif %}</td>
-                        <td>{{ count }}</td>
-                        <td>{{ "%.2f"|format(count / stats['total'] * 100) }}%</td>
-                    </tr>
-                    {% endfor %}
-                </tbody>
+                <tbody></tbody>
             </table>
         </div>
         <div id="pagination-controls" style="margin-top: 20px;">
@@ -717,9 +2225,9 @@ def create_templates():
     <!-- 表格部分保持原有结构 -->
     <div class="dashboard-card">
         <h3>IP访问频次 Top {{ top_n }}</h3>
-        {% if stats.ip_freq %}
-        {% set sorted_ips = stats.ip_freq.items() | sort(reverse=true, attribute='1') | list %}
-        {% set top_ips = sorted_ips[:top_n if top_n > 0 else 20] %}
+        {% if stats.approx_error %}<p>近似统计：计数误差不超过 ±{{ stats.approx_error.ip_freq }}</p>{% endif %}
+        {% if stats.rankings.ips %}
+        {% set top_ips = stats.rankings.ips[:top_n if top_n > 0 else 20] %}
         <table>
             <tr><th>IP地址</th><th>访问次数</th><th>占比</th></tr>
             {% for ip, cnt in top_ips %}
@@ -737,14 +2245,13 @@ def create_templates():
 
     <div class="dashboard-card">
         <h3>国家频次 Top {{ top_n }}</h3>
-        {% if stats.country_freq %}
-        {% set sorted_countries = stats.country_freq.items() | sort(reverse=true, attribute='1') | list %}
-        {% set top_countries = sorted_countries[:top_n if top_n > 0 else 20] %}
+        {% if stats.rankings.countries %}
+        {% set top_countries = stats.rankings.countries[:top_n if top_n > 0 else 20] %}
         <table>
             <tr><th>国家</th><th>访问次数</th><th>占比</th></tr>
-            {% for (en, cn), cnt in top_countries %}
+            {% for name, cnt in top_countries %}
             <tr>
-                <td>{{ en }} ({{ cn }})</td>
+                <td>{{ name }}</td>
                 <td>{{ cnt }}</td>
                 <td>{{ (cnt / stats.total * 100) | round(2) }}%</td>
             </tr>
@@ -757,14 +2264,13 @@ def create_templates():
 
     <div class="dashboard-card">
         <h3>地区频次 Top {{ top_n }}</h3>
-        {% if stats.region_freq %}
-        {% set sorted_regions = stats.region_freq.items() | sort(reverse=true, attribute='1') | list %}
-        {% set top_regions = sorted_regions[:top_n if top_n > 0 else 20] %}
+        {% if stats.rankings.regions %}
+        {% set top_regions = stats.rankings.regions[:top_n if top_n > 0 else 20] %}
         <table>
             <tr><th>地区</th><th>访问次数</th></tr>
-            {% for (en, cn), cnt in top_regions %}
+            {% for name, cnt in top_regions %}
             <tr>
-                <td>{{ en }} ({{ cn }})</td>
+                <td>{{ name }}</td>
                 <td>{{ cnt }}</td>
             </tr>
             {% endfor %}
@@ -776,14 +2282,13 @@ def create_templates():
 
     <div class="dashboard-card">
         <h3>城市频次 Top {{ top_n }}</h3>
-        {% if stats.city_freq %}
-        {% set sorted_cities = stats.city_freq.items() | sort(reverse=true, attribute='1') | list %}
-        {% set top_cities = sorted_cities[:top_n if top_n > 0 else 20] %}
+        {% if stats.rankings.cities %}
+        {% set top_cities = stats.rankings.cities[:top_n if top_n > 0 else 20] %}
         <table>
             <tr><th>城市</th><th>访问次数</th></tr>
-            {% for (en, cn), cnt in top_cities %}
+            {% for name, cnt in top_cities %}
             <tr>
-                <td>{{ en }} ({{ cn }})</td>
+                <td>{{ name }}</td>
                 <td>{{ cnt }}</td>
             </tr>
             {% endfor %}
@@ -798,100 +2303,1285 @@ def create_templates():
     </div>
 </body>
 
+{% if charts.series %}
+<script src="/assets/charts.js"></script>
+<script>
+    // 图表由浏览器根据服务器给出的Top N数据绘制
+    const chartSeries = {{ charts.series|tojson }};
+    const chartTypes = {ip_pie: 'pie', country_bar: 'hbar', url_bar: 'hbar', hour_bar: 'vbar'};
+    document.querySelectorAll('[data-chart]').forEach(container => {
+        const name = container.dataset.chart;
+        GeoCharts[chartTypes[name]](container, chartSeries[name]);
+    });
+</script>
+{% endif %}
 <script>
-    // URL表格分页功能
-    const table = document.getElementById('url-table');
-    const rows = table.querySelectorAll('tbody tr');
+    // URL表格分页功能：每页数据从排行榜API按需获取
+    const tbody = document.querySelector('#url-table tbody');
+    const apiBase = {{ api_base|tojson }};
+    const apiParams = {{ api_params|tojson }};
     const pageSize = 10; // 每页显示10行
     let currentPage = 1;
-    
+    let totalPages = 1;
+
     function showPage(page) {
-        const startIndex = (page - 1) * pageSize;
-        const endIndex = startIndex + pageSize;
-        
-        rows.forEach((row, index) => {
-            row.style.display = (index >= startIndex && index < endIndex) ? '' : 'none';
-        });
-        
-        document.getElementById('page-info').textContent = `第 ${page} 页`;
-        document.getElementById('prev-page').disabled = page === 1;
-        document.getElementById('next-page').disabled = endIndex >= rows.length;
+        fetch(`${apiBase}/urls?${apiParams}page=${page}&size=${pageSize}`)
+            .then(response => response.json())
+            .then(data => {
+                tbody.replaceChildren();
+                data.items.forEach(item => {
+                    const row = tbody.insertRow();
+                    row.insertCell().textContent = item.rank;
+                    const urlCell = row.insertCell();
+                    urlCell.title = item.name;
+                    urlCell.textContent = item.name.length > 80 ? item.name.slice(0, 80) + '...' : item.name;
+                    row.insertCell().textContent = item.count;
+                    row.insertCell().textContent = item.ratio.toFixed(2) + '%';
+                });
+                currentPage = page;
+                totalPages = Math.max(data.pages, 1);
+                document.getElementById('page-info').textContent = `第 ${page} 页 / 共 ${totalPages} 页`;
+                document.getElementById('prev-page').disabled = page === 1;
+                document.getElementById('next-page').disabled = page >= totalPages;
+            });
     }
-    
+
     document.getElementById('prev-page').addEventListener('click', () => {
         if (currentPage > 1) {
-            currentPage--;
-            showPage(currentPage);
+            showPage(currentPage - 1);
         }
     });
-    
+
     document.getElementById('next-page').addEventListener('click', () => {
-        if (currentPage * pageSize < rows.length) {
-            currentPage++;
-            showPage(currentPage);
+        if (currentPage < totalPages) {
+            showPage(currentPage + 1);
         }
     });
-    
+
     // 初始显示第一页
     showPage(1);
 </script>
 </html>'''
-    with open(os.path.join(template_dir, 'stats.html'), 'w', encoding='utf-8') as f:
-        f.write(stats_html)
+    write_template(template_dir, 'stats.html', stats_html)
+
+
+def write_template(template_dir, name, content):
+    """原子写入模板文件：多个worker同时启动时不会读到写了一半的模板"""
+    path = os.path.join(template_dir, name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+# 内置的图表脚本（js渲染方式）：用SVG绘制饼图和柱状图，数据格式为 {labels: [...], values: [...]}
+CHARTS_JS = r'''(function (global) {
+    'use strict';
+    var SVG_NS = 'http://www.w3.org/2000/svg';
+    var COLORS = ['#4e79a7', '#f28e2b', '#e15759', '#76b7b2', '#59a14f', '#edc948', '#b07aa1',
+                  '#ff9da7', '#9c755f', '#bab0ac', '#6ab0f3', '#d37295', '#8cd17d', '#f1ce63'];
+    var TEXT_COLOR = '#e0e0e0';
+
+    function node(name, attrs, parent) {
+        var element = document.createElementNS(SVG_NS, name);
+        Object.keys(attrs).forEach(function (key) { element.setAttribute(key, attrs[key]); });
+        if (parent) { parent.appendChild(element); }
+        return element;
+    }
+
+    function text(parent, x, y, content, attrs) {
+        var element = node('text', Object.assign({x: x, y: y, fill: TEXT_COLOR, 'font-size': 12}, attrs || {}), parent);
+        element.textContent = content;
+        return element;
+    }
+
+    function tooltip(element, content) {
+        node('title', {}, element).textContent = content;
+    }
+
+    function shorten(label, length) {
+        label = String(label);
+        return label.length > length ? label.slice(0, length) + '...' : label;
+    }
+
+    function canvas(container, width, height) {
+        var svg = node('svg', {viewBox: '0 0 ' + width + ' ' + height, width: '100%'});
+        container.replaceChildren(svg);
+        return svg;
+    }
+
+    // 饼图：左侧扇形，右侧图例（名称和占比）
+    function pie(container, data) {
+        var total = data.values.reduce(function (sum, value) { return sum + value; }, 0);
+        var radius = 140, cx = 160, cy = 160;
+        var svg = canvas(container, 600, Math.max(320, data.labels.length * 16 + 20));
+        var angle = -Math.PI / 2;
+        data.values.forEach(function (value, i) {
+            var color = COLORS[i % COLORS.length];
+            var share = total ? value / total : 0;
+            var label = data.labels[i] + ': ' + value.toLocaleString() + ' (' + (share * 100).toFixed(1) + '%)';
+            var slice;
+            if (share >= 1) {
+                slice = node('circle', {cx: cx, cy: cy, r: radius, fill: color}, svg);
+            } else {
+                var end = angle + share * 2 * Math.PI;
+                slice = node('path', {
+                    d: 'M' + cx + ',' + cy +
+                       'L' + (cx + radius * Math.cos(angle)) + ',' + (cy + radius * Math.sin(angle)) +
+                       'A' + radius + ',' + radius + ' 0 ' + (end - angle > Math.PI ? 1 : 0) + ' 1 ' +
+                       (cx + radius * Math.cos(end)) + ',' + (cy + radius * Math.sin(end)) + 'Z',
+                    fill: color, stroke: '#2d2d44'
+                }, svg);
+                angle = end;
+            }
+            tooltip(slice, label);
+            node('rect', {x: 330, y: 12 + i * 16, width: 10, height: 10, fill: color}, svg);
+            tooltip(text(svg, 346, 21 + i * 16, shorten(data.labels[i], 26) + ' ' + (share * 100).toFixed(1) + '%'), label);
+        });
+    }
+
+    // 横向柱状图：左侧名称，柱后标出次数
+    function hbar(container, data) {
+        var rowHeight = 22, labelWidth = 230, width = 600;
+        var max = Math.max.apply(null, data.values.concat([1]));
+        var svg = canvas(container, width, data.labels.length * rowHeight + 10);
+        data.values.forEach(function (value, i) {
+            var y = 5 + i * rowHeight;
+            var barWidth = (width - labelWidth - 70) * value / max;
+            tooltip(text(svg, labelWidth - 6, y + 15, shorten(data.labels[i], 32), {'text-anchor': 'end'}),
+                    String(data.labels[i]));
+            tooltip(node('rect', {x: labelWidth, y: y + 2, width: Math.max(barWidth, 1), height: rowHeight - 6,
+                                  fill: COLORS[0]}, svg), data.labels[i] + ': ' + value.toLocaleString());
+            text(svg, labelWidth + barWidth + 6, y + 15, value.toLocaleString());
+        });
+    }
+
+    // 纵向柱状图：用于访问时段分布
+    function vbar(container, data) {
+        var width = 600, height = 260, bottom = 40, top = 10;
+        var max = Math.max.apply(null, data.values.concat([1]));
+        var step = width / Math.max(data.labels.length, 1);
+        var svg = canvas(container, width, height);
+        data.values.forEach(function (value, i) {
+            var barHeight = (height - bottom - top) * value / max;
+            var x = i * step;
+            tooltip(node('rect', {x: x + step * 0.1, y: height - bottom - barHeight, width: step * 0.8,
+                                  height: Math.max(barHeight, 1), fill: COLORS[0]}, svg),
+                    data.labels[i] + ': ' + value.toLocaleString());
+            var label = text(svg, x + step / 2, height - bottom + 14, data.labels[i],
+                             {'text-anchor': 'end', 'font-size': 10});
+            label.setAttribute('transform', 'rotate(-45 ' + (x + step / 2) + ' ' + (height - bottom + 14) + ')');
+        });
+    }
+
+    global.GeoCharts = {pie: pie, hbar: hbar, vbar: vbar};
+})(window);
+'''
+
 
 def auto_refresh():
-    global LAST_REFRESH_TIME  # 添加global声明
     while True:
         time.sleep(REFRESH_INTERVAL)
-        try:
-            # 只执行统计功能，不启动Web服务器
-            refresh_stats_only()
-            LAST_REFRESH_TIME = datetime.datetime.now()
+        # 只执行统计功能，不启动Web服务器；与手动刷新共用同一个后台任务
+        job = start_refresh()
+        job['done'].wait()
+        if job['status'] == 'done':
             print(f"自动刷新完成于 {LAST_REFRESH_TIME}")
-        except Exception as e:
-            print(f"自动刷新失败: {e}")
+        else:
+            print(f"自动刷新失败: {job['error']}")
+
+
+def list_log_files():
+    """列出LOG_SOURCES中各来源的日志（含未压缩的轮转文件 .log.1 和压缩的 .gz），目录不存在的来源跳过"""
+    log_files = []
+    for prefix, _, directory in LOG_SOURCES:
+        directory = directory or LOG_DIR
+        try:
+            filenames = os.listdir(directory)
+        except FileNotFoundError:
+            if directory != LOG_DIR:
+                continue
+            raise
+        for filename in filenames:
+            if filename.startswith(prefix) and LOG_FILE_PATTERN.search(filename):
+                log_files.append(os.path.join(directory, filename))
+    return log_files
 
 
 # 添加新的统计函数，不包含Web服务器启动
 def refresh_stats_only():
-    global GLOBAL_STATS
+    global TIMINGS, FILE_METRICS
+    if FLEET_ROLE == 'collector':
+        refresh_fleet_stats()
+        return
+    refresh_started = time.perf_counter()
+    TIMINGS = new_timings()
+    FILE_METRICS = {}
+    collected = collect_summaries()
+    if collected is None:
+        return
+    summaries, geo_version, index_load_seconds = collected
+
+    # 步骤4：合并时间桶得到各时间粒度的统计
+    started = time.perf_counter()
+    store = build_rollup_store(summaries)
+    time_stats = build_window_stats(store, compute_window_cutoffs())
+    TIMINGS['aggregate'] += time.perf_counter() - started
+
+    # 更新全局统计数据
+    refresh_metrics = {
+        'seconds': time.perf_counter() - refresh_started,
+        'stages': {'index_load': index_load_seconds, 'read': TIMINGS['read'], 'parse': TIMINGS['parse'],
+                   'geo_lookup': TIMINGS['geo_lookup'], 'aggregate': TIMINGS['aggregate']},
+        'lines': TIMINGS['lines'],
+        'bytes': TIMINGS['bytes'],
+        'files': FILE_METRICS
+    }
+    publish_stats(store, time_stats, refresh_metrics=refresh_metrics, geo_version=geo_version)
+    print("[自动刷新] 统计完成！")
+
+
+def collect_summaries():
+    """解析本机日志（增量），返回 (各文件的时间桶汇总列表, 地理库版本, 加载索引耗时)；没有日志或索引加载失败时返回None"""
+    started = time.perf_counter()
     # 步骤1：加载二进制索引（仅加载一次）
     print("[自动刷新] 加载二进制索引和地名数据...")
     try:
-        ip_segments, geo_lines = load_bin_index()
+        ip_index, geo_lines = load_bin_index()
+        geo_version = geo_index_version()
     except Exception as e:
         print(f"❌ 索引加载失败：{e}")
-        return
+        return None
+    index_load_seconds = time.perf_counter() - started
 
     # 步骤2：遍历日志目录下的所有文件
-    log_files = []
-    for filename in os.listdir(LOG_DIR):
-        if filename.startswith('gitlab_error') and (filename.endswith('.log') or filename.endswith('.gz')):
-            log_files.append(os.path.join(LOG_DIR, filename))
-
+    log_files = list_log_files()
     if not log_files:
+        return None
+    track_progress(files_total=len(log_files), bytes_total=sum(file_size(file_path) for file_path in log_files))
+
+    # 步骤3：按检查点只读取新增内容，.gz归档复用汇总缓存，每个文件的记录按小时分桶
+    archive_files = [file_path for file_path in log_files if file_path.endswith('.gz')]
+    plain_files = [file_path for file_path in log_files if not file_path.endswith('.gz')]
+    with INGEST_LOCK:
+        if INCREMENTAL_REFRESH:
+            state = load_ingest_state(geo_version)
+        else:
+            state = new_ingest_state(geo_version)
+        compact_before = rollup_compact_cutoff()
+        pool = create_ingest_pool()
+        try:
+            ingest_log_files(plain_files, state, ip_index, geo_lines, pool)
+            started = time.perf_counter()
+            for checkpoint in state['files'].values():
+                checkpoint['summary'] = compact_summary(checkpoint['summary'], compact_before)
+            TIMINGS['aggregate'] += time.perf_counter() - started
+            if INCREMENTAL_REFRESH:
+                save_ingest_state(state)
+            summaries = [checkpoint['summary'] for checkpoint in state['files'].values()]
+            summaries += load_archive_summaries(archive_files, geo_version, ip_index, geo_lines,
+                                                compact_before, pool)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+    return summaries, geo_version, index_load_seconds
+
+
+def new_timings():
+    return dict.fromkeys(TIMINGS, 0)
+
+
+def add_timings(timings):
+    """累加工作进程返回的耗时"""
+    for key, value in timings.items():
+        TIMINGS[key] += value
+
+
+def record_file_metrics(file_path, before):
+    """记录单个文件的解析耗时（before为处理该文件前的累计值，工作进程的耗时已累加进来）"""
+    FILE_METRICS[file_path] = {
+        'seconds': sum(TIMINGS[key] - before[key] for key in ('read', 'parse', 'geo_lookup', 'aggregate')),
+        'lines': TIMINGS['lines'] - before['lines'],
+        'bytes': TIMINGS['bytes'] - before['bytes']
+    }
+
+
+def file_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except FileNotFoundError:
+        return 0
+
+
+def publish_stats(store, time_stats, refresh_time=None, refresh_metrics=None, geo_version=None):
+    """发布新的统计快照，清理旧图表并在后台预渲染新图表
+
+    页面只通过STATS_SNAPSHOT读取数据，一次赋值完成替换，不会读到新旧混合的数据；快照发布后不再修改
+    """
+    global STATS_SNAPSHOT, GLOBAL_STATS, ROLLUP_STORE, STATS_GENERATION, LAST_REFRESH_TIME
+    generation = STATS_GENERATION + 1
+    snapshot = {
+        'generation': generation,
+        'stats': time_stats,
+        'store': store,
+        'refresh_time': refresh_time or datetime.datetime.now(),
+        'metrics': refresh_metrics,
+        'geo_version': geo_version
+    }
+    STATS_GENERATION = generation
+    STATS_SNAPSHOT = snapshot
+    GLOBAL_STATS, ROLLUP_STORE, LAST_REFRESH_TIME = time_stats, store, snapshot['refresh_time']
+    evict_stale_charts(generation)
+    if CHART_PRERENDER:
+        threading.Thread(target=prerender_charts, args=(generation, time_stats), daemon=True).start()
+
+
+def refresh_and_publish():
+    """刷新统计并写入快照文件：重启时先加载快照，多进程部署时其他worker下次请求时加载"""
+    generation = STATS_GENERATION
+    refresh_stats_only()
+    if STATS_GENERATION != generation:
+        write_snapshot()
+
+
+# ========================
+# 9. 后台刷新任务：同一时间只有一个刷新，重复的刷新请求并入进行中的任务
+# ========================
+def start_refresh():
+    """已有刷新在进行时返回该任务，否则在后台启动新的刷新任务"""
+    global REFRESH_JOB
+    with REFRESH_JOB_LOCK:
+        job = REFRESH_JOB
+        if job is not None and job['status'] == 'running':
+            return job
+        job = {
+            'id': job['id'] + 1 if job else 1,
+            'status': 'running',
+            'started': time.time(),
+            'finished': None,
+            'error': None,
+            'files_total': 0,
+            'files_done': 0,
+            'bytes_total': 0,
+            'bytes_done': 0,
+            'bytes_parsed': 0,  # 实际解析的字节数（不含检查点之前和命中缓存的部分），用于估算剩余时间
+            'status_written': 0,
+            'done': threading.Event()
+        }
+        REFRESH_JOB = job
+    threading.Thread(target=run_refresh_job, args=(job,), daemon=True).start()
+    return job
+
+
+def run_refresh_job(job):
+    try:
+        refresh_and_publish()
+        job['status'] = 'done'
+    except Exception as e:
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        print(f"数据刷新失败: {e}")
+    finally:
+        job['finished'] = time.time()
+        write_refresh_status(job, force=True)
+        job['done'].set()
+
+
+def track_progress(files_total=0, bytes_total=0, files_done=0, bytes_done=0, bytes_parsed=0):
+    """累加刷新进度（不是由后台刷新任务调用时不做任何事）"""
+    job = REFRESH_JOB
+    if job is None or job['status'] != 'running':
+        return
+    job['files_total'] += files_total
+    job['bytes_total'] += bytes_total
+    job['files_done'] += files_done
+    job['bytes_done'] += bytes_done
+    job['bytes_parsed'] += bytes_parsed
+    write_refresh_status(job)
+
+
+def refresh_status(job):
+    """刷新任务状态：已完成文件数、已处理字节数和预计剩余秒数"""
+    if job is None:
+        return {'status': 'idle'}
+    elapsed = (job['finished'] or time.time()) - job['started']
+    eta = None
+    if job['status'] == 'running' and job['bytes_parsed'] and elapsed > 0:
+        eta = round(max(job['bytes_total'] - job['bytes_done'], 0) / (job['bytes_parsed'] / elapsed), 1)
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'error': job['error'],
+        'started': datetime.datetime.fromtimestamp(job['started']).strftime('%Y-%m-%d %H:%M:%S'),
+        'elapsed': round(elapsed, 1),
+        'eta': eta,
+        'files_total': job['files_total'],
+        'files_done': job['files_done'],
+        'bytes_total': job['bytes_total'],
+        'bytes_done': job['bytes_done']
+    }
+
+
+def write_refresh_status(job, force=False):
+    """多进程部署时把刷新进度写入状态文件（最多每秒一次）"""
+    if not SHARED_SNAPSHOT:
+        return
+    now = time.time()
+    if not force and now - job['status_written'] < 1:
+        return
+    job['status_written'] = now
+    status_dir = os.path.dirname(REFRESH_STATUS_PATH)
+    if status_dir:
+        os.makedirs(status_dir, exist_ok=True)  # 首次刷新时状态目录可能还不存在
+    tmp_path = f"{REFRESH_STATUS_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(refresh_status(job), f, ensure_ascii=False)
+    os.replace(tmp_path, REFRESH_STATUS_PATH)
+
+
+def current_refresh_status():
+    """多进程部署时由负责刷新的worker写状态文件，其他worker读取该文件"""
+    if SHARED_SNAPSHOT and not IS_REFRESH_LEADER:
+        try:
+            with open(REFRESH_STATUS_PATH, encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'status': 'idle'}
+    return refresh_status(REFRESH_JOB)
+
+
+def request_refresh():
+    """页面请求刷新：单进程时直接启动后台任务，多进程部署时通知负责刷新的worker"""
+    if SHARED_SNAPSHOT and not IS_REFRESH_LEADER:
+        with open(REFRESH_REQUEST_PATH, 'a'):
+            pass
+        os.utime(REFRESH_REQUEST_PATH)
         return
+    start_refresh()
 
-    # 步骤3：按时间粒度统计
-    time_stats = OrderedDict()
-    for time_name, days in TIME_GRANS.items():
-        stats = {
-            'total': 0,
-            'ip_freq': defaultdict(int),
-            'country_freq': defaultdict(int),
-            'region_freq': defaultdict(int),
-            'city_freq': defaultdict(int),
-            'hour_freq': defaultdict(int),
-            'url_freq': defaultdict(int),
-            'geo_data': defaultdict(list)
+
+def refresh_requested_at():
+    try:
+        return os.stat(REFRESH_REQUEST_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+REFRESH_PAGE = '''<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>数据刷新</title></head>
+<body style="font-family: Arial, sans-serif; padding: 40px;">
+    <p id="refresh-info">刷新已在后台开始……</p>
+    <a href="/">返回首页</a>
+    <script>
+        // 每秒查询一次刷新进度
+        function poll() {
+            fetch('/refresh/status').then(response => response.json()).then(job => {
+                const info = document.getElementById('refresh-info');
+                if (job.status === 'running') {
+                    const eta = job.eta === null ? '估算中' : `${job.eta}秒`;
+                    info.textContent = `正在刷新：文件 ${job.files_done}/${job.files_total}，`
+                        + `${(job.bytes_done / 1048576).toFixed(1)}/${(job.bytes_total / 1048576).toFixed(1)} MB，预计剩余 ${eta}`;
+                    setTimeout(poll, 1000);
+                } else if (job.status === 'failed') {
+                    info.textContent = `数据刷新失败: ${job.error}`;
+                } else if (job.status === 'done') {
+                    info.textContent = `数据刷新成功！用时 ${job.elapsed} 秒`;
+                } else {
+                    setTimeout(poll, 1000);
+                }
+            });
         }
-        for file_path in log_files:
-            process_log_file(file_path, days, ip_segments, geo_lines, stats)
-        time_stats[time_name] = stats
+        poll();
+    </script>
+</body>
+</html>'''
+
+
+# ========================
+# 10. 统计快照文件与多进程部署（gunicorn）：只有一个worker刷新，其余worker加载共享快照
+# ========================
+def snapshot_header(geo_version):
+    """快照的适用条件：格式、地理库版本、计数模式、时间桶大小或时间窗口变化后旧快照作废"""
+    return {
+        'format': SNAPSHOT_FORMAT,
+        'geo_version': geo_version,
+        'counting': counting_mode(),
+        'bucket_seconds': BUCKET_SECONDS,
+        'time_grans': list(TIME_GRANS)
+    }
+
+
+def write_snapshot():
+    """把当前统计快照写入快照文件"""
+    global SNAPSHOT_VERSION
+    snapshot = STATS_SNAPSHOT
+    if snapshot is None:
+        return
+    with SNAPSHOT_LOCK:
+        write_pickle(SNAPSHOT_PATH, {'header': snapshot_header(snapshot['geo_version']),
+                                     'refresh_time': snapshot['refresh_time'], 'stats': snapshot['stats'],
+                                     'store': snapshot['store'], 'metrics': snapshot['metrics']})
+        st = os.stat(SNAPSHOT_PATH)
+        SNAPSHOT_VERSION = (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def read_snapshot(f):
+    """读取快照文件，与当前地理库和配置不符时返回None"""
+    snapshot = pickle.load(f)
+    header = snapshot.get('header') if isinstance(snapshot, dict) else None
+    try:
+        geo_version = geo_index_version()
+    except OSError:
+        return None
+    if header != snapshot_header(geo_version):
+        return None
+    return snapshot
+
+
+def load_snapshot():
+    """启动时加载上次保存的统计快照，成功返回True"""
+    global SNAPSHOT_VERSION
+    with SNAPSHOT_LOCK:
+        try:
+            with open(SNAPSHOT_PATH, 'rb') as f:
+                st = os.fstat(f.fileno())
+                snapshot = read_snapshot(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"统计快照加载失败：{e}")
+            return False
+        if snapshot is None:
+            print("统计快照与当前地理库或配置不符，忽略")
+            return False
+        publish_stats(snapshot['store'], snapshot['stats'], snapshot['refresh_time'], snapshot['metrics'],
+                      snapshot['header']['geo_version'])
+        SNAPSHOT_VERSION = (st.st_ino, st.st_size, st.st_mtime_ns)
+        return True
+
+
+def sync_snapshot():
+    """每个请求前检查快照文件，有更新时加载（未变化时只需一次stat）"""
+    global SNAPSHOT_VERSION
+    try:
+        st = os.stat(SNAPSHOT_PATH)
+    except FileNotFoundError:
+        return
+    if (st.st_ino, st.st_size, st.st_mtime_ns) == SNAPSHOT_VERSION:
+        return
+    with SNAPSHOT_LOCK:
+        try:
+            with open(SNAPSHOT_PATH, 'rb') as f:
+                st = os.fstat(f.fileno())  # 以实际打开的文件为准，加载期间被替换也不会记错版本
+                version = (st.st_ino, st.st_size, st.st_mtime_ns)
+                if version == SNAPSHOT_VERSION:
+                    return
+                snapshot = read_snapshot(f)
+        except Exception as e:
+            print(f"统计快照加载失败：{e}")
+            return
+        SNAPSHOT_VERSION = version
+        if snapshot is None:
+            return  # 旧版本或地理库不符的快照，等负责刷新的worker写入新快照
+        publish_stats(snapshot['store'], snapshot['stats'], snapshot['refresh_time'], snapshot['metrics'],
+                      snapshot['header']['geo_version'])
+
+
+def refresh_leader():
+    """worker后台线程：抢到刷新锁的worker负责首次、定时和页面请求的刷新，其余worker等待接替"""
+    global IS_REFRESH_LEADER
+    import fcntl  # 仅类Unix系统可用（gunicorn同样只支持类Unix系统）
+    lock_dir = os.path.dirname(REFRESH_LOCK_PATH)
+    if lock_dir:
+        os.makedirs(lock_dir, exist_ok=True)
+    lock_file = open(REFRESH_LOCK_PATH, 'a')
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except OSError:
+            time.sleep(REFRESH_LEADER_RETRY)
+    IS_REFRESH_LEADER = True
+    print(f"[自动刷新] worker {os.getpid()} 负责定时刷新")
+    start_detector()  # 实时检测同样只在负责刷新的进程中运行
+    while True:
+        job = start_refresh()
+        job['done'].wait()
+        if job['status'] == 'done':
+            print(f"自动刷新完成于 {LAST_REFRESH_TIME}")
+        # 刷新期间收到的请求已并入本次刷新；之后等到定时刷新或其他worker请求刷新
+        requested = refresh_requested_at()
+        deadline = time.time() + REFRESH_INTERVAL
+        while time.time() < deadline and refresh_requested_at() == requested:
+            time.sleep(REFRESH_POLL_SECONDS)
+
+
+def create_app(refresh=True):
+    """gunicorn入口（应用工厂），例如：
+
+    gunicorn -w 4 -k gthread --threads 4 -b 0.0.0.0:5000 "nginx_ip_geo_stats:create_app()"
+
+    不要使用--preload：每个worker各自启动刷新线程，由文件锁选出一个worker刷新。
+    已单独运行 --headless 刷新进程时使用 create_app(refresh=False)：worker不争抢刷新锁，只加载快照，
+    页面上的刷新请求照常通过请求文件交给刷新进程。
+    只支持gthread或sync worker：刷新是CPU密集的纯Python循环，gevent协程在刷新期间不会让出，
+    负责刷新的worker会停止响应请求和心跳，被gunicorn当作超时杀掉
+    """
+    global SHARED_SNAPSHOT
+    SHARED_SNAPSHOT = True
+    setup_logging()
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        print("⚠️ 检测到gevent worker：刷新期间该worker无法响应请求，请改用 -k gthread 或 sync worker")
+    app = build_app()
+    app.before_request(sync_snapshot)
+    if refresh:
+        threading.Thread(target=refresh_leader, daemon=True).start()
+    return app
+
+
+def run_headless(once=False):
+    """无界面的刷新进程：只解析日志、写入统计快照，不导入Flask和绘图库
+
+    与gunicorn一起部署时由它持有刷新锁负责所有刷新，Web worker只加载快照；
+    once为True时刷新一次后退出（适合由cron等定时调用）
+    """
+    global SHARED_SNAPSHOT, CHART_PRERENDER
+    SHARED_SNAPSHOT = True
+    CHART_PRERENDER = False  # 图表由各Web worker自行渲染
+    setup_logging()
+    if once:
+        job = start_refresh()
+        job['done'].wait()
+        if job['status'] != 'done':
+            raise SystemExit(f"数据刷新失败: {job['error']}")
+        print(f"数据刷新完成于 {LAST_REFRESH_TIME}，快照已写入 {SNAPSHOT_PATH}")
+        return
+    refresh_leader()
+
+
+# ========================
+# 11. 监控指标：/metrics 输出Prometheus文本格式（不依赖prometheus_client）
+# ========================
+def setup_logging():
+    logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+
+def process_rss_bytes():
+    """当前进程的常驻内存（字节），非Linux系统返回None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def metric_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels.items():
+        # 标签值需要转义反斜杠、双引号和换行
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def render_metrics():
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        """samples: [(标签dict, 数值)]，数值为None的样本不输出"""
+        samples = [(labels, value) for labels, value in samples if value is not None]
+        if not samples:
+            return
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            lines.append(f'{name}{metric_labels(labels)} {value}')
+
+    snapshot = STATS_SNAPSHOT
+    refresh = (snapshot or {}).get('metrics')
+    if snapshot is not None:
+        metric('geo_stats_generation', 'gauge', 'Generation of the published statistics snapshot.',
+               [({}, snapshot['generation'])])
+        metric('geo_stats_last_refresh_timestamp_seconds', 'gauge', 'Time the published snapshot was computed.',
+               [({}, snapshot['refresh_time'].timestamp())])
+        # 各时间窗口每个计数器的基数（近似模式下为实际保留的条目数）
+        metric('geo_stats_freq_cardinality', 'gauge', 'Number of distinct keys per counter and time window.',
+               [({'window': time_name, 'counter': key}, len(stats[key]))
+                for time_name, stats in snapshot['stats'].items() for key in FREQ_KEYS])
+        metric('geo_stats_window_requests', 'gauge', 'Total log records per time window.',
+               [({'window': time_name}, stats['total']) for time_name, stats in snapshot['stats'].items()])
+    if refresh:
+        metric('geo_stats_refresh_duration_seconds', 'gauge', 'Wall time of the last refresh.',
+               [({}, refresh['seconds'])])
+        # 多进程解析时为各进程耗时之和，可能超过刷新的总耗时
+        metric('geo_stats_refresh_stage_seconds', 'gauge', 'Time spent per pipeline stage in the last refresh.',
+               [({'stage': stage}, seconds) for stage, seconds in refresh['stages'].items()])
+        metric('geo_stats_refresh_lines', 'gauge', 'Log lines parsed in the last refresh.', [({}, refresh['lines'])])
+        metric('geo_stats_refresh_bytes', 'gauge', 'Log bytes parsed in the last refresh.', [({}, refresh['bytes'])])
+        metric('geo_stats_refresh_lines_per_second', 'gauge', 'Parse throughput of the last refresh.',
+               [({}, refresh['lines'] / refresh['seconds'] if refresh['seconds'] else None)])
+        metric('geo_stats_refresh_bytes_per_second', 'gauge', 'Parse throughput of the last refresh.',
+               [({}, refresh['bytes'] / refresh['seconds'] if refresh['seconds'] else None)])
+        metric('geo_stats_file_parse_seconds', 'gauge', 'Time spent on each file parsed in the last refresh.',
+               [({'file': path}, item['seconds']) for path, item in refresh['files'].items()])
+        metric('geo_stats_file_lines', 'gauge', 'Lines parsed from each file in the last refresh.',
+               [({'file': path}, item['lines']) for path, item in refresh['files'].items()])
+    if FLEET:
+        # collector中各agent最近一次推送的情况
+        agents = list(FLEET.items())
+        metric('geo_stats_fleet_agent_last_push_timestamp_seconds', 'gauge', 'Time of the last push from each agent.',
+               [({'agent': agent_id}, agent['pushed']) for agent_id, agent in agents])
+        metric('geo_stats_fleet_agent_push_bytes', 'gauge', 'Compressed size of the last push from each agent.',
+               [({'agent': agent_id}, agent['bytes']) for agent_id, agent in agents])
+        metric('geo_stats_fleet_agent_push_buckets', 'gauge', 'Changed time buckets in the last push from each agent.',
+               [({'agent': agent_id}, agent['buckets']) for agent_id, agent in agents])
+    detector = DETECTOR
+    if detector is not None:
+        metric('geo_stats_detector_events_total', 'counter', 'Log lines checked by the streaming detector.',
+               [({}, detector['events'])])
+        metric('geo_stats_detector_seconds_total', 'counter', 'Time spent reading and checking new log lines.',
+               [({}, detector['seconds'])])
+        metric('geo_stats_detector_backlog_bytes', 'gauge', 'Unread log bytes at the start of the last poll.',
+               [({}, detector['backlog'])])
+        metric('geo_stats_detector_tracked_keys', 'gauge', 'Sliding-window counters currently tracked.',
+               [({}, sum(len(counter) for counter in detector['counters']))])
+        metric('geo_stats_detector_alerts_total', 'counter', 'Alerts raised by the streaming detector.',
+               [({}, detector['alert_id'])])
+    # 图表缓存为本进程的数据
+    chart = dict(CHART_METRICS)
+    lookups = chart['hits'] + chart['misses']
+    metric('geo_stats_chart_cache_hits_total', 'counter', 'Chart cache hits.', [({}, chart['hits'])])
+    metric('geo_stats_chart_cache_misses_total', 'counter', 'Chart cache misses.', [({}, chart['misses'])])
+    metric('geo_stats_chart_cache_hit_ratio', 'gauge', 'Chart cache hit ratio since process start.',
+           [({}, chart['hits'] / lookups if lookups else None)])
+    metric('geo_stats_chart_renders_total', 'counter', 'Chart sets rendered.', [({}, chart['renders'])])
+    metric('geo_stats_chart_render_seconds_total', 'counter', 'Time spent rendering charts.',
+           [({}, chart['render_seconds'])])
+    metric('geo_stats_chart_render_seconds_avg', 'gauge', 'Average time to render one chart set.',
+           [({}, chart['render_seconds'] / chart['renders'] if chart['renders'] else None)])
+    metric('process_resident_memory_bytes', 'gauge', 'Resident memory size in bytes.', [({}, process_rss_bytes())])
+    return '\n'.join(lines) + '\n'
+
+
+# ========================
+# 12. 多节点部署：各节点的agent解析本机日志，把汇总的增量推送给collector合并
+# ========================
+def fleet_header():
+    """agent与collector必须一致的设置，不一致时collector拒绝推送"""
+    return {'format': FLEET_FORMAT, 'counting': list(counting_mode()), 'bucket_seconds': BUCKET_SECONDS}
+
+
+def bucket_delta(new, old):
+    """两个时间桶的计数之差：{'total': 差值, 计数器名: [[键, 差值], ...]}，只含变化的项；没有变化时返回None"""
+    delta = {}
+    for key in FREQ_KEYS:
+        old_freq = old[key] if old is not None else {}
+        new_freq = new[key]
+        changes = [[item, count - old_freq.get(item, 0)] for item, count in new_freq.items()
+                   if count != old_freq.get(item, 0)]
+        changes += [[item, -count] for item, count in old_freq.items() if item not in new_freq]
+        if changes:
+            delta[key] = changes
+    total = new['total'] - (old['total'] if old is not None else 0)
+    if not delta and not total:
+        return None
+    delta['total'] = total
+    return delta
+
+
+def fleet_delta(summaries, state):
+    """比较本机各文件的汇总与上次推送的内容，返回 (变化的时间桶列表, 各时间桶的计数器列表, 合并后的计数)
+
+    汇总发布后不再原地修改：某个时间桶的计数器对象与上次推送时完全相同，则该时间桶没有变化，
+    只需比较对象身份；其余时间桶才重新合并并逐项求差
+    """
+    index = {}
+    for summary in summaries:
+        for level in ('buckets', 'daily'):
+            for bucket_start, bucket in summary[level].items():
+                index.setdefault((level, bucket_start), []).append(bucket)
+    pushed, pushed_parts = state['buckets'], state['parts']
+    changes = []
+    merged_buckets = {}
+    for key, parts in index.items():
+        old_parts = pushed_parts.get(key)
+        if old_parts is not None and len(old_parts) == len(parts) and all(
+                a is b for a, b in zip(old_parts, parts)):
+            merged_buckets[key] = pushed[key]
+            continue
+        merged = new_bucket()
+        for part in parts:
+            merge_bucket(merged, part)
+        delta = bucket_delta(merged, pushed.get(key))
+        if delta:
+            changes.append([key[0], key[1], delta])
+        merged_buckets[key] = merged
+    for key, merged in pushed.items():
+        if key not in index:
+            # 时间桶已消失（归档被删除或小时桶合并为天桶），计数全部减去
+            delta = bucket_delta(new_bucket(), merged)
+            if delta:
+                changes.append([key[0], key[1], delta])
+    return changes, index, merged_buckets
+
+
+def load_agent_state():
+    """读取上次推送成功的状态，推送地址、agent名称或设置变化时从完整汇总开始"""
+    global AGENT_STATE
+    if AGENT_STATE is not None:
+        return AGENT_STATE
+    state = None
+    if os.path.exists(AGENT_STATE_PATH):
+        try:
+            with open(AGENT_STATE_PATH, 'rb') as f:
+                state = pickle.load(f)
+        except Exception as e:
+            print(f"[agent] 推送状态读取失败，将重新推送完整汇总：{e}")
+    if state is None or state.get('target') != (COLLECTOR_URL, AGENT_ID, FLEET_FORMAT, counting_mode(), BUCKET_SECONDS):
+        state = {'seq': 0, 'buckets': {}, 'geo_sent': set()}
+    state['parts'] = {}  # 计数器对象只在本进程内可比较身份，重启后各时间桶都重新求差
+    AGENT_STATE = state
+    return state
+
+
+def save_agent_state(state):
+    write_pickle(AGENT_STATE_PATH, {'target': (COLLECTOR_URL, AGENT_ID, FLEET_FORMAT, counting_mode(), BUCKET_SECONDS),
+                                    'seq': state['seq'], 'buckets': state['buckets'], 'geo_sent': state['geo_sent']})
+
+
+def push_to_collector(summaries):
+    """把本机汇总相对上次推送的增量发送给collector，返回 (变化的时间桶数, 请求体字节数)
+
+    推送失败时状态不变，下次推送会带上这期间的全部增量；collector重启后丢失了本agent的数据
+    或序号不符时返回409，此时丢弃推送状态重新发送完整汇总
+    """
+    global AGENT_STATE
+    for attempt in range(2):
+        state = load_agent_state()
+        changes, parts, merged_buckets = fleet_delta(summaries, state)
+        # 首次出现的IP附带地理信息，collector按IP汇总地理位置
+        geo = {}
+        for _, _, delta in changes:
+            for ip_str, count in delta.get('ip_freq', ()):
+                if count > 0 and ip_str not in state['geo_sent'] and ip_str not in geo:
+                    geo[ip_str] = next(summary['geo'][ip_str] for summary in summaries if ip_str in summary['geo'])
+        payload = {'header': fleet_header(), 'agent': AGENT_ID, 'base': state['seq'], 'seq': state['seq'] + 1,
+                   'buckets': changes, 'geo': geo}
+        body = gzip.compress(json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        if FLEET_TOKEN:
+            headers['Authorization'] = f'Bearer {FLEET_TOKEN}'
+        request = urllib.request.Request(COLLECTOR_URL, data=body, headers=headers, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=AGENT_PUSH_TIMEOUT) as response:
+                response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 409 and state['seq'] and attempt == 0:
+                print("[agent] collector没有本节点的数据或序号不符，重新推送完整汇总")
+                AGENT_STATE = {'seq': 0, 'buckets': {}, 'parts': {}, 'geo_sent': set()}
+                continue
+            raise RuntimeError(f"collector返回 {e.code}: {e.read().decode('utf-8', 'ignore')}") from e
+        state['seq'] = payload['seq']
+        state['buckets'], state['parts'] = merged_buckets, parts
+        state['geo_sent'].update(geo)
+        save_agent_state(state)
+        return len(changes), len(body)
+
+
+def run_agent(once=False):
+    """agent：定期增量解析本机日志并推送增量汇总，不启动Web服务、不导入Flask和绘图库
+
+    once为True时解析并推送一次后退出（适合由cron等定时调用，推送状态保存在AGENT_STATE_PATH）
+    """
+    global TIMINGS, FILE_METRICS
+    setup_logging()
+    if APPROX_COUNTING:
+        raise SystemExit("agent模式只支持精确计数，请设置 APPROX_COUNTING = False")
+    if not once:
+        start_detector()  # 各节点就地检测，告警通过webhook发出
+    while True:
+        TIMINGS = new_timings()
+        FILE_METRICS = {}
+        try:
+            collected = collect_summaries()
+            if collected is None:
+                print("[agent] 没有可统计的日志或地理库加载失败")
+            else:
+                count, size = push_to_collector(collected[0])
+                print(f"[agent] 已推送 {count} 个变化的时间桶到 {COLLECTOR_URL}（{size} 字节）")
+        except Exception as e:
+            if once:
+                raise SystemExit(f"[agent] 推送失败：{e}")
+            print(f"[agent] 推送失败，下次推送时重试：{e}")
+        if once:
+            return
+        time.sleep(AGENT_PUSH_INTERVAL)
+
+
+def apply_fleet_push(agent, payload):
+    """把一次推送的增量合并进该agent的汇总，返回新汇总
+
+    写时复制：只复制被推送触及的时间桶，已发布的统计快照引用的旧汇总保持不变
+    """
+    summary = agent['summary'] if agent is not None and payload['base'] else new_summary()
+    levels = {'buckets': dict(summary['buckets']), 'daily': dict(summary['daily'])}
+    for level, bucket_start, delta in payload['buckets']:
+        buckets = levels[level]
+        old = buckets.get(bucket_start)
+        bucket = copy_bucket(old) if old is not None else new_bucket()
+        bucket['total'] += delta.get('total', 0)
+        for key in FREQ_KEYS:
+            freq = bucket[key]
+            for item, count in delta.get(key, ()):
+                if isinstance(item, list):
+                    item = tuple(item)  # 地区、城市的键是元组，JSON中为数组
+                count += freq.get(item, 0)
+                if count > 0:
+                    freq[item] = count
+                else:
+                    freq.pop(item, None)
+        if bucket['total'] > 0 or any(bucket[key] for key in FREQ_KEYS):
+            buckets[bucket_start] = bucket
+        else:
+            buckets.pop(bucket_start, None)
+    geo = summary['geo']
+    if payload['geo']:
+        geo = dict(geo)
+        geo.update((ip_str, tuple(location)) for ip_str, location in payload['geo'].items())
+    return {'buckets': levels['buckets'], 'daily': levels['daily'], 'geo': geo}
+
+
+def decompress_push(body):
+    """分块解压gzip压缩的推送数据，解压后超过FLEET_MAX_PUSH_BYTES时立即停止并返回None；数据不完整时抛出EOFError"""
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    parts = []
+    size = 0
+    while not decompressor.eof:
+        part = decompressor.decompress(body, READ_CHUNK_SIZE)
+        body = decompressor.unconsumed_tail
+        if not part and not body and not decompressor.eof:
+            raise EOFError("推送数据不完整")
+        size += len(part)
+        if size > FLEET_MAX_PUSH_BYTES:
+            return None
+        parts.append(part)
+    return b''.join(parts)
+
+
+def receive_fleet_push(payload, address, size):
+    """collector：合并一次推送的增量，返回该agent的新序号；序号不符时返回None
+
+    全局统计不在这里重新生成，由run_fleet_publisher最多每FLEET_PUBLISH_INTERVAL秒发布一次
+    """
+    with FLEET_LOCK:
+        agent_id = payload['agent']
+        agent = FLEET.get(agent_id)
+        if payload['base'] and (agent is None or agent['seq'] != payload['base']):
+            return None
+        FLEET[agent_id] = {
+            'seq': payload['seq'],
+            'summary': apply_fleet_push(agent, payload),
+            'pushed': time.time(),
+            'address': address,
+            'bytes': size,
+            'buckets': len(payload['buckets'])
+        }
+        if payload['buckets'] or payload['geo'] or not payload['base']:
+            FLEET_DIRTY.set()  # 日志没有变化的推送不需要重新发布
+        return payload['seq']
+
+
+def publish_fleet_stats():
+    """由各agent的汇总生成各时间窗口的统计并发布（调用方持有FLEET_LOCK）"""
+    started = time.perf_counter()
+    store = build_rollup_store([agent['summary'] for agent in FLEET.values()])
+    time_stats = build_window_stats(store, compute_window_cutoffs())
+    elapsed = time.perf_counter() - started
+    publish_stats(store, time_stats, refresh_metrics={'seconds': elapsed, 'stages': {'aggregate': elapsed},
+                                                      'lines': 0, 'bytes': 0, 'files': {}})
+
+
+def run_fleet_publisher():
+    """collector后台线程：有新推送时重新生成并发布全局统计，两次发布至少间隔FLEET_PUBLISH_INTERVAL秒，
+    间隔内的多次推送合并为一次发布"""
+    while True:
+        FLEET_DIRTY.wait()
+        FLEET_DIRTY.clear()
+        try:
+            with FLEET_LOCK:
+                publish_fleet_stats()
+        except Exception as e:
+            print(f"[collector] 发布统计失败：{e}")
+        time.sleep(FLEET_PUBLISH_INTERVAL)
+
+
+def init_collector():
+    """collector模式启动前检查令牌并启动发布线程"""
+    if not FLEET_TOKEN:
+        raise SystemExit("collector模式必须设置FLEET_TOKEN（agent推送时使用相同的令牌），否则任何人都能推送数据")
+    threading.Thread(target=run_fleet_publisher, daemon=True).start()
+
+
+def refresh_fleet_stats():
+    """collector的定时/手动刷新：不读取本机日志，只按当前时间重新生成各时间窗口"""
+    with FLEET_LOCK:
+        publish_fleet_stats()
+    print(f"[collector] 已合并 {len(FLEET)} 个agent的汇总")
+
+
+# ========================
+# 13. 实时检测：跟随日志新增的行，按滑动窗口统计每个IP（及URL前缀）的请求数，超过阈值时告警
+# ========================
+def new_detector():
+    rules = [(name, prefix.encode('utf-8') if prefix is not None else None, window, threshold)
+             for name, prefix, window, threshold in DETECT_RULES]
+    return {
+        'rules': rules,
+        # 每条规则一个计数器表：IP字节串 -> [当前窗口起始秒数, 当前窗口计数, 上一窗口计数, 上次告警的秒数]，
+        # 按最近进入新窗口的先后排序（LRU）
+        'counters': [OrderedDict() for _ in rules],
+        'alerts': deque(maxlen=DETECT_ALERT_LIMIT),
+        'alert_id': 0,
+        'offsets': {},  # (设备号, inode) -> (已读到的位置, 末尾不完整的行)
+        'started': False,  # 首轮读取时从文件末尾开始，启动前的旧日志不告警
+        'events': 0,
+        'seconds': 0.0,
+        'backlog': 0,  # 最近一轮开始时尚未读取的字节数，持续增长说明检测跟不上日志写入
+        'lock': threading.Lock()
+    }
+
+
+def detect_rule(counter, rows, parse_format_minute, name, prefix, window, threshold):
+    """按一条规则检测已解析的行，返回达到阈值的 (规则名, IP字节串, 前缀, 秒数, 估算次数, 窗口, 阈值) 列表"""
+    limit = DETECT_MAX_KEYS
+    whole_minutes = window % 60 == 0
+    raised = []
+    current_minute = minute_start = start = None
+    for minute_prefix, second, ip_bytes, url in rows:
+        if minute_prefix != current_minute:
+            minute = MINUTE_CACHE.get(minute_prefix)
+            if minute is None:
+                minute = parse_format_minute(minute_prefix)
+            if not minute:
+                continue
+            current_minute = minute_prefix
+            minute_start = minute[0]
+            # 窗口为整分钟时同一分钟的行都在同一窗口，只在需要精确估算时才解析秒数
+            start = minute_start - minute_start % window
+        seconds = None
+        if not whole_minutes:
+            seconds = minute_start + int(second)
+            start = seconds - seconds % window
+        entry = counter.get(ip_bytes)
+        if entry is None:
+            entry = counter[ip_bytes] = [start, 0, 0, None]
+            if len(counter) > limit:
+                counter.popitem(last=False)
+        elif start > entry[0]:
+            entry[2] = entry[1] if start - entry[0] == window else 0
+            entry[0] = start
+            entry[1] = 0
+            counter.move_to_end(ip_bytes)
+        entry[1] += 1
+        if entry[1] + entry[2] < threshold:
+            continue  # 估算值不超过两个窗口计数之和，未达到阈值时不必计算
+        if seconds is None:
+            seconds = minute_start + int(second)
+        estimate = entry[2] * (window - seconds + start) / window + entry[1]
+        if estimate >= threshold and (entry[3] is None or seconds - entry[3] >= window):
+            entry[3] = seconds  # 同一IP同一规则每个窗口最多告警一次
+            raised.append((name, ip_bytes, prefix, seconds, estimate, window, threshold))
+    return raised
+
+
+def detect_chunk(detector, data, end, log_format=None):
+    """检测data[0:end]中的完整行（data以换行符开头），返回新产生的告警列表
+
+    滑动窗口按"上一窗口计数×剩余比例+当前窗口计数"估算，每个请求每条规则只需常数次操作；
+    整块数据只匹配一次正则，每条规则再各自遍历一遍（有URL前缀的规则先筛出匹配的行）。
+    计数器进入新窗口时移到LRU末尾，每条规则超过DETECT_MAX_KEYS个IP时淘汰最久未出现的
+    """
+    if log_format is None:
+        log_format = LOG_FORMATS['nginx_error']
+    rows = [row for row in log_format['pattern'].findall(data, 0, end) if row[2]]
+    raised = []
+    for counter, (name, prefix, window, threshold) in zip(detector['counters'], detector['rules']):
+        rule_rows = rows if prefix is None else [row for row in rows if row[3].startswith(prefix)]
+        raised += detect_rule(counter, rule_rows, log_format['minute'], name, prefix, window, threshold)
+    raised.sort(key=lambda alert: alert[3])
+    detector['events'] += len(rows)
+    return [record_alert(detector, *alert) for alert in raised]
+
+
+def record_alert(detector, name, ip_bytes, prefix, seconds, estimate, window, threshold):
+    log_time = EPOCH + datetime.timedelta(seconds=seconds)
+    with detector['lock']:
+        detector['alert_id'] += 1
+        alert = {
+            'id': detector['alert_id'],
+            'rule': name,
+            'ip': ip_bytes.decode('ascii'),
+            'prefix': prefix.decode('utf-8') if prefix is not None else None,
+            'count': round(estimate),
+            'window': window,
+            'threshold': threshold,
+            'time': log_time.strftime('%Y-%m-%d %H:%M:%S')  # 触发告警的日志行时间
+        }
+        detector['alerts'].append(alert)
+    print(f"[检测] {alert['time']} {alert['ip']} 触发 {name}：{window}秒内约 {alert['count']} 次（阈值 {threshold}）")
+    if DETECT_WEBHOOK_URL:
+        try:
+            WEBHOOK_QUEUE.put_nowait(alert)
+        except queue.Full:
+            print("[检测] webhook队列已满，丢弃告警")
+    return alert
+
+
+def follow_log_files(detector):
+    """读取各未压缩日志自上次以来新增的内容并检测，返回新产生的告警列表
+
+    按inode记录读取位置：logrotate改名后继续读完原文件，新建的文件从头读取，文件被截断时从头读取
+    """
+    offsets = {}
+    pending = []
+    for file_path in list_log_files():
+        if file_path.endswith('.gz'):
+            continue
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            continue
+        inode = (st.st_dev, st.st_ino)
+        position, carry = detector['offsets'].get(inode, (None, b'\n'))
+        if position is None or st.st_size < position:
+            position, carry = (st.st_size if not detector['started'] else 0), b'\n'
+        offsets[inode] = (position, carry)
+        if st.st_size > position:
+            pending.append((file_path, inode, st.st_size))
+    detector['started'] = True
+    detector['backlog'] = sum(size - offsets[inode][0] for _, inode, size in pending)
+
+    raised = []
+    for file_path, inode, size in pending:
+        position, carry = offsets[inode]
+        log_format = log_format_for(file_path)
+        try:
+            with open(file_path, 'rb') as f:
+                f.seek(position)
+                while position < size:
+                    chunk = f.read(min(READ_CHUNK_SIZE, size - position))
+                    if not chunk:
+                        break
+                    position += len(chunk)
+                    data = carry + chunk
+                    end = data.rfind(b'\n')
+                    raised += detect_chunk(detector, data, end, log_format)
+                    carry = data[end:]
+        except FileNotFoundError:
+            pass  # 读取期间被轮转删除
+        offsets[inode] = (position, carry)
+    detector['offsets'] = offsets
+    return raised
+
+
+def run_detector():
+    detector = DETECTOR
+    while True:
+        started = time.perf_counter()
+        try:
+            raised = follow_log_files(detector)
+        except Exception as e:
+            raised = []
+            print(f"[检测] 读取日志失败：{e}")
+        detector['seconds'] += time.perf_counter() - started
+        if raised and SHARED_SNAPSHOT:
+            write_alerts(detector)
+        time.sleep(DETECT_POLL_SECONDS)
+
+
+def send_webhooks():
+    """逐条把告警POST到DETECT_WEBHOOK_URL，发送失败只输出提示"""
+    while True:
+        alert = WEBHOOK_QUEUE.get()
+        request = urllib.request.Request(DETECT_WEBHOOK_URL, data=json.dumps(alert, ensure_ascii=False).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=DETECT_WEBHOOK_TIMEOUT) as response:
+                response.read()
+        except Exception as e:
+            print(f"[检测] webhook发送失败：{e}")
+
+
+def start_detector():
+    """启动实时检测线程（每个进程最多一个）；多进程部署时只由负责刷新的进程调用"""
+    global DETECTOR
+    if not DETECT_ENABLED or DETECTOR is not None or FLEET_ROLE == 'collector':
+        return  # collector不读取本机日志
+    DETECTOR = new_detector()
+    threading.Thread(target=run_detector, daemon=True).start()
+    if DETECT_WEBHOOK_URL:
+        threading.Thread(target=send_webhooks, daemon=True).start()
+
+
+def detector_status(detector):
+    if detector is None:
+        return {'enabled': False, 'alerts': []}
+    with detector['lock']:
+        alerts = list(detector['alerts'])
+    return {
+        'enabled': True,
+        'rules': [{'name': name, 'prefix': prefix, 'window': window, 'threshold': threshold}
+                  for name, prefix, window, threshold in DETECT_RULES],
+        'events': detector['events'],
+        'tracked_keys': sum(len(counter) for counter in detector['counters']),
+        'backlog_bytes': detector['backlog'],
+        'alerts': alerts
+    }
+
+
+def write_alerts(detector):
+    """多进程部署时把告警写入文件，供其他worker的/alerts读取"""
+    alerts_dir = os.path.dirname(DETECT_ALERTS_PATH)
+    if alerts_dir:
+        os.makedirs(alerts_dir, exist_ok=True)
+    tmp_path = f"{DETECT_ALERTS_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(detector_status(detector), f, ensure_ascii=False)
+    os.replace(tmp_path, DETECT_ALERTS_PATH)
+
+
+def current_alerts(after=0, limit=100):
+    """编号大于after的告警，新的在前，最多limit条"""
+    if SHARED_SNAPSHOT and not IS_REFRESH_LEADER:
+        try:
+            with open(DETECT_ALERTS_PATH, encoding='utf-8') as f:
+                status = json.load(f)
+        except (FileNotFoundError, ValueError):
+            status = {'enabled': DETECT_ENABLED, 'alerts': []}
+    else:
+        status = detector_status(DETECTOR)
+    status['alerts'] = [alert for alert in status['alerts'] if alert['id'] > after][-limit:][::-1]
+    return status
 
-    # 更新全局统计数据
-    GLOBAL_STATS = time_stats
-    print("[自动刷新] 统计完成！")
 
 if __name__ == "__main__":
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description='GitLab Nginx错误日志IP地理统计')
+    parser.add_argument('--headless', action='store_true', help='只刷新统计并写入快照，不启动Web服务')
+    parser.add_argument('--agent', action='store_true', help='agent模式：解析本机日志并把增量汇总推送到COLLECTOR_URL')
+    parser.add_argument('--collector', action='store_true', help='collector模式：合并各agent推送的汇总，不读取本机日志')
+    parser.add_argument('--once', action='store_true', help='与--headless或--agent一起使用：刷新/推送一次后退出')
+    args = parser.parse_args()
+    if args.agent:
+        FLEET_ROLE = 'agent'
+        run_agent(args.once)
+    elif args.headless:
+        run_headless(args.once)
+    else:
+        if args.collector:
+            FLEET_ROLE = 'collector'
+            init_collector()
+        main()